@@ -0,0 +1,39 @@
+"""Benchmarks for django-requestlogs. Run from the repository root, e.g.
+
+    python -m benchmarks.serializer
+"""
+import timeit
+
+import django
+from django.conf import settings
+
+
+def setup():
+    if not settings.configured:
+        settings.configure(
+            DATABASES={
+                'default': {
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': ':memory:'
+                }
+            },
+            INSTALLED_APPS=(
+                'django.contrib.contenttypes',
+                'django.contrib.auth',
+            ),
+            MIDDLEWARE=['requestlogs.middleware.RequestLogsMiddleware'],
+            ROOT_URLCONF='benchmarks.urls',
+            SECRET_KEY='1234',
+        )
+        django.setup()
+
+
+def measure(func, number=2000, repeat=5):
+    """Return the best time per call in microseconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def report(results):
+    width = max(len(name) for name in results)
+    for name, usec in results.items():
+        print(f'{name:<{width}}  {usec:10.1f} us')
@@ -0,0 +1,34 @@
+"""Measure `IGNORE_PATHS` matching with a growing number of rules."""
+import re
+
+from . import measure, report, setup
+
+setup()
+
+from requestlogs.base import IgnorePaths  # noqa: E402
+
+
+def make_rules(count):
+    rules = []
+    for i in range(count):
+        rules.extend([
+            f'/exact/{i}/',
+            f'/prefix/{i}/*',
+            f'*.ext{i}',
+            re.compile(rf'/regex/{i}/\d+'),
+        ])
+    return rules
+
+
+def main():
+    paths = ['/api/v1/users/12345/orders/', '/prefix/7/file', '/a/b.ext3']
+    results = {}
+    for count in (1, 10, 100, 1000):
+        ignore = IgnorePaths(make_rules(count))
+        results[f'{count * 4} rules'] = measure(
+            lambda: [ignore(path) for path in paths], number=20000)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""Compare the `JSON_BACKEND` options when dumping a large response."""
+from . import measure, report, setup
+
+setup()
+
+from django.test import override_settings  # noqa: E402
+
+from requestlogs.encoders import _is_installed  # noqa: E402
+from requestlogs.storages import JsonDumpField  # noqa: E402
+
+
+def main():
+    data = {'items': [
+        {'id': i, 'name': f'item {i}', 'tags': ['a', 'b'], 'price': i / 3}
+        for i in range(1000)
+    ]}
+    results = {}
+    for backend in ('json', 'orjson', 'ujson', 'msgspec'):
+        if not _is_installed(backend):
+            continue
+        with override_settings(REQUESTLOGS={'JSON_BACKEND': backend}):
+            field = JsonDumpField()
+            results[f'dump 1000 items ({backend})'] = measure(
+                lambda: field.to_representation(data), number=50)
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""Measure the cost of `RequestLogsMiddleware` per request, and where it is
+spent. Run e.g.
+
+    python -m benchmarks.middleware
+    python -m benchmarks.middleware --save-baseline
+    python -m benchmarks.middleware --check
+
+The overhead of the middleware is compared to the same requests without the
+middleware. `--check` exits with an error if the relative overhead of a
+scenario has grown over the one in `baseline.json` (or `--baseline`) by more
+than the tolerance. The overhead depends on the machine, so the baseline is
+only meaningful when measured on the same machine, e.g. from the base commit
+in the same CI job.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from collections import defaultdict
+from unittest.mock import patch
+
+from . import setup
+
+setup()
+
+from django.core.files.uploadedfile import SimpleUploadedFile  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+
+from requestlogs.base import SETTINGS  # noqa: E402
+from requestlogs.storages import BaseStorage  # noqa: E402
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+REQUESTLOGS = {
+    'STORAGE_CLASS': 'benchmarks.urls.NullStorage',
+    'IGNORE_PATHS': ['/health'],
+}
+
+
+def upload():
+    return {'data': {'file': SimpleUploadedFile('file.bin', b'x' * 100000)}}
+
+
+# name: (method, path, function returning the keyword arguments)
+SCENARIOS = {
+    'tiny GET': ('get', '/items?count=1', dict),
+    'large list': ('get', '/items?count=1000', dict),
+    'file upload': ('post', '/upload', upload),
+    'ignored path': ('get', '/health', dict),
+    'authenticated': ('get', '/me', lambda: {'HTTP_AUTHORIZATION': 'token'}),
+}
+
+
+def run(scenario, requests):
+    """Return the latency of each request in seconds."""
+    method, path, get_kwargs = SCENARIOS[scenario]
+    send = getattr(Client(), method)
+    latencies = []
+    for _ in range(requests):
+        kwargs = get_kwargs()
+        started_at = time.perf_counter()
+        response = send(path, **kwargs)
+        latencies.append(time.perf_counter() - started_at)
+        assert response.status_code == 200, response.status_code
+    return latencies
+
+
+def measure_scenario(scenario, requests, warmup):
+    ret = {}
+    for middleware in (False, True):
+        with override_settings(
+                MIDDLEWARE=(['requestlogs.middleware.RequestLogsMiddleware']
+                            if middleware else []),
+                REQUESTLOGS=REQUESTLOGS):
+            run(scenario, warmup)
+            latencies = run(scenario, requests)
+        ret['with' if middleware else 'without'] = {
+            'median': statistics.median(latencies),
+            'p99': sorted(latencies)[int(len(latencies) * 0.99) - 1],
+            'throughput': len(latencies) / sum(latencies),
+        }
+    ret['overhead'] = (ret['with']['median'] / ret['without']['median']) - 1
+    return ret
+
+
+class StageTimer(object):
+    """Accumulates the time spent in the wrapped functions. The time of a
+    nested stage is subtracted from the stage around it."""
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.stack = []
+
+    def wrap(self, stage, func):
+        def wrapper(*args, **kwargs):
+            self.stack.append(0.0)
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started_at
+                nested = self.stack.pop()
+                self.totals[stage] += elapsed - nested
+                if self.stack:
+                    self.stack[-1] += elapsed
+        return wrapper
+
+
+def measure_stages(scenario, requests):
+    """Return the time per request in seconds spent in each stage."""
+    timer = StageTimer()
+    entry_class = SETTINGS['ENTRY_CLASS']
+    patches = [
+        patch.object(entry_class, '__init__', timer.wrap(
+            'entry construction', entry_class.__init__)),
+        patch.object(entry_class, 'skip_request', staticmethod(timer.wrap(
+            'skip checks', entry_class.skip_request))),
+        patch.object(entry_class, 'skip_entry', timer.wrap(
+            'skip checks', entry_class.skip_entry)),
+        patch.object(entry_class, 'collect', timer.wrap(
+            'handlers', entry_class.collect)),
+        patch.object(BaseStorage, 'prepare', timer.wrap(
+            'serialization', BaseStorage.prepare)),
+        patch.object(entry_class, 'store', timer.wrap(
+            'storage', entry_class.store)),
+    ]
+    with override_settings(
+            MIDDLEWARE=['requestlogs.middleware.RequestLogsMiddleware'],
+            REQUESTLOGS=REQUESTLOGS):
+        for p in patches:
+            p.start()
+        try:
+            run(scenario, requests)
+        finally:
+            for p in reversed(patches):
+                p.stop()
+    return {stage: total / requests for stage, total in timer.totals.items()}
+
+
+def print_results(results, stages):
+    width = max(len(name) for name in results)
+    print(f'{"":<{width}}  {"without":>10}  {"with":>10}  {"p99 with":>10}'
+          f'  {"req/s with":>10}  {"overhead":>8}')
+    for name, result in results.items():
+        print(f'{name:<{width}}'
+              f'  {result["without"]["median"] * 1e6:7.1f} us'
+              f'  {result["with"]["median"] * 1e6:7.1f} us'
+              f'  {result["with"]["p99"] * 1e6:7.1f} us'
+              f'  {result["with"]["throughput"]:10.0f}'
+              f'  {result["overhead"]:7.1%}')
+
+    for name, timings in stages.items():
+        print(f'\n{name}:')
+        for stage, seconds in timings.items():
+            print(f'  {stage:<20}  {seconds * 1e6:7.1f} us')
+
+
+def check(results, baseline, tolerance, slack):
+    """Return the scenarios whose overhead has grown over the baseline."""
+    failed = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        allowed = baseline[name]['overhead'] * (1 + tolerance) + slack
+        if result['overhead'] > allowed:
+            failed.append(
+                f'{name}: overhead {result["overhead"]:.1%}, '
+                f'baseline {baseline[name]["overhead"]:.1%}')
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--scenario', action='append',
+                        choices=list(SCENARIOS))
+    parser.add_argument('--no-stages', action='store_true',
+                        help='skip the per-stage timings')
+    parser.add_argument('--baseline', default=BASELINE_PATH,
+                        help='path of the baseline file')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true',
+                        help='fail if the overhead exceeds the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed relative growth of the overhead')
+    parser.add_argument('--slack', type=float, default=0.05,
+                        help='allowed absolute growth of the overhead')
+    args = parser.parse_args(argv)
+
+    scenarios = args.scenario or list(SCENARIOS)
+    results = {name: measure_scenario(name, args.requests, args.warmup)
+               for name in scenarios}
+    stages = {} if args.no_stages else {
+        name: measure_stages(name, args.requests) for name in scenarios}
+    print_results(results, stages)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({name: {'overhead': round(result['overhead'], 4)}
+                       for name, result in results.items()},
+                      f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.check:
+        with open(args.baseline) as f:
+            failed = check(results, json.load(f), args.tolerance, args.slack)
+        if failed:
+            print('\nOverhead over the baseline:\n  ' + '\n  '.join(failed))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
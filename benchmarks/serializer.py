@@ -0,0 +1,33 @@
+"""Compare `BaseStorage.prepare()` with and without `COMPILED_SERIALIZER`."""
+from . import measure, report, setup
+
+setup()
+
+from django.test import Client, override_settings  # noqa: E402
+
+from requestlogs.storages import BaseStorage  # noqa: E402
+from .urls import CollectingStorage  # noqa: E402
+
+
+def get_entry():
+    CollectingStorage.entries = []
+    with override_settings(REQUESTLOGS={
+            'STORAGE_CLASS': 'benchmarks.urls.CollectingStorage'}):
+        Client().post('/items?count=10', data={'name': 'x', 'password': 'y'})
+    entry, = CollectingStorage.entries
+    return entry
+
+
+def main():
+    entry = get_entry()
+    results = {}
+    for compiled in (False, True):
+        with override_settings(REQUESTLOGS={'COMPILED_SERIALIZER': compiled}):
+            storage = BaseStorage()
+            results[f'prepare (compiled={compiled})'] = measure(
+                lambda: storage.prepare(entry))
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import django
+if django.VERSION[0] < 2:
+    from django.conf.urls import url
+else:
+    from django.urls import re_path as url
+from django.contrib.auth import get_user_model
+from rest_framework.authentication import BaseAuthentication
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from requestlogs.storages import BaseStorage
+
+
+class ItemsView(APIView):
+    requestlogs_action_names = {
+        'get': 'list-items',
+        'post': 'create-item',
+    }
+
+    def get(self, request):
+        return Response({'items': [
+            {'id': i, 'name': f'item {i}', 'tags': ['a', 'b']}
+            for i in range(int(request.GET.get('count', 10)))
+        ]})
+
+    def post(self, request):
+        return Response({'status': 'ok'})
+
+
+class UploadView(APIView):
+    def post(self, request):
+        return Response({'size': request.data['file'].size})
+
+
+class TokenAuthentication(BaseAuthentication):
+    def authenticate(self, request):
+        if request.META.get('HTTP_AUTHORIZATION') == 'token':
+            return get_user_model()(pk=1, username='bench'), None
+
+
+class MeView(APIView):
+    authentication_classes = (TokenAuthentication,)
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        return Response({'username': request.user.username})
+
+
+urlpatterns = [
+    url(r'^items/?$', ItemsView.as_view()),
+    url(r'^upload/?$', UploadView.as_view()),
+    url(r'^me/?$', MeView.as_view()),
+    url(r'^health/?$', ItemsView.as_view()),
+]
+
+
+class CollectingStorage(BaseStorage):
+    entries = []
+
+    def store(self, entry):
+        self.entries.append(entry)
+
+
+class NullStorage(BaseStorage):
+    """Serializes the entries and throws them away."""
+
+    def store(self, entry):
+        self.prepare(entry)
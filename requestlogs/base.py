@@ -1,32 +1,163 @@
+import fnmatch
+import re
+
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.utils.module_loading import import_string
 from django.test.signals import setting_changed
 
+from .encoders import _is_installed, get_json_backend
+
 
 DEFAULT_SETTINGS = {
     'ATTRIBUTE_NAME': '_requestlog',
     'ENTRY_CLASS': 'requestlogs.entries.RequestLogEntry',
     'STORAGE_CLASS': 'requestlogs.storages.LoggingStorage',
     'SERIALIZER_CLASS': 'requestlogs.storages.BaseEntrySerializer',
+    'COMPILED_SERIALIZER': False,
+    'SNAPSHOT_ENTRIES': False,
     'SECRETS': ['password', 'password1', 'password2', 'token', 'HTTP_AUTHORIZATION'],
+    'SECRETS_CASE_INSENSITIVE': False,
+    'CAPTURE_HEADERS': None,
+    'EXCLUDE_HEADERS': [],
     'REQUEST_ID_ATTRIBUTE_NAME': 'request_id',
     'REQUEST_ID_HTTP_HEADER': None,
     'METHODS': ('GET', 'PUT', 'PATCH', 'POST', 'DELETE'),
     'JSON_ENSURE_ASCII': True,
+    'JSON_BACKEND': 'json',
     'IGNORE_USER_FIELD': None,
     'IGNORE_USERS': [],
     'IGNORE_PATHS': None,
+    'MAX_REQUEST_DATA_BYTES': None,
+    'MAX_RESPONSE_DATA_BYTES': None,
+    'CAPTURE_PAYLOADS': 'always',
+    'CAPTURE_PAYLOADS_STATUS': 400,
+    'CAPTURE_PAYLOADS_THRESHOLD': 1000,
+    'PHASE_TIMINGS': False,
+    'QUEUED_STORAGE_CLASS': 'requestlogs.storages.LoggingStorage',
+    'QUEUE_MAX_SIZE': 10000,
+    'QUEUE_OVERFLOW': 'block',
+    'QUEUE_WORKERS': 1,
+    'QUEUE_SHUTDOWN_TIMEOUT': 5,
+    'QUEUE_BATCH_SIZE': 1,
+    'QUEUE_BATCH_INTERVAL': 1000,
+    'DATABASE_MODEL': 'requestlogs_db.RequestLog',
+    'DATABASE_ALIAS': None,
+    'DATABASE_BATCH_SIZE': None,
+    'LOGGING_STORAGE_FORMAT': 'repr',
+    'METRICS_STORAGE_CLASS': None,
+    'METRICS_BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                        10),
+    'METRICS_MULTIPROCESS_DIRECTORY': None,
+    'INSTRUMENTATION': False,
+    'INSTRUMENTATION_DUMP_DIRECTORY': None,
+    'INSTRUMENTATION_DUMP_INTERVAL': 10,
+    'SAMPLING_RULES': None,
+    'SAMPLING_ADAPTIVE': False,
+    'SAMPLING_QUEUE_THRESHOLD': 0.5,
+    'SAMPLING_LATENCY_THRESHOLD': None,
+    'SAMPLING_MIN_FACTOR': 0.01,
+    'FILE_DIRECTORY': None,
+    'FILE_PREFIX': 'requestlogs',
+    'FILE_BUFFER_SIZE': 1024 * 1024,
+    'FILE_MAX_BYTES': None,
+    'FILE_ROTATE_INTERVAL': None,
+    'FILE_FSYNC': 'never',
+    'FILE_FSYNC_INTERVAL': 1,
+    'FILE_FLUSH_INTERVAL': 1,
+    'RING_BUFFER_PATH': None,
+    'RING_BUFFER_SLOTS': 4096,
+    'RING_BUFFER_SLOT_SIZE': 16 * 1024,
+    'COLLECTOR_STORAGE_CLASS': 'requestlogs.storages.LoggingStorage',
+    'COLLECTOR_BATCH_SIZE': 1000,
+    'COLLECTOR_BATCH_INTERVAL': 1000,
+    'NETWORK_ADDRESS': None,
+    'NETWORK_FORMAT': 'ndjson',
+    'NETWORK_CONNECTIONS': 1,
+    'NETWORK_TIMEOUT': 5,
+    'NETWORK_BACKOFF': 0.5,
+    'NETWORK_MAX_BACKOFF': 30,
+    'NETWORK_SPILL_DIRECTORY': None,
+    'NETWORK_SPILL_MAX_BYTES': 100 * 1024 * 1024,
 }
 
+QUEUE_OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest')
+FILE_FSYNC_POLICIES = ('never', 'batch', 'interval')
+LOGGING_STORAGE_FORMATS = ('repr', 'json')
+CAPTURE_PAYLOADS_MODES = ('always', 'tail')
+NETWORK_FORMATS = ('ndjson', 'msgpack')
 
-class IgnorePaths(object):
-    def __init__(self, paths):
+
+def _get_pattern_class():
+    try:
+        from re import Pattern
+    except ImportError:
+        # Python 3.6 `Pattern`:
+        from typing.re import Pattern
+    return Pattern
+
+
+def _build_trie(keys):
+    root = {}
+    for key in keys:
+        node = root
+        for c in key:
+            node = node.setdefault(c, {})
+        node[None] = True
+    return root
+
+
+def _trie_match(trie, chars):
+    """Whether any key of the trie is a prefix of `chars`."""
+    node = trie
+    if None in node:
+        return True
+    for c in chars:
+        node = node.get(c)
+        if node is None:
+            return False
+        if None in node:
+            return True
+    return False
+
+
+# Numbered back references and conditionals break when patterns are combined
+_group_references = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def _combine_patterns(patterns):
+    """Combine the patterns with equal flags into one alternation."""
+    by_flags = {}
+    separate = []
+    for pattern in patterns:
+        if (isinstance(pattern.pattern, str) and
+                not _group_references.search(pattern.pattern)):
+            by_flags.setdefault(pattern.flags, []).append(pattern)
+        else:
+            separate.append(pattern)
+
+    combined = []
+    for flags, group in by_flags.items():
+        if len(group) == 1:
+            combined.extend(group)
+            continue
         try:
-            from re import Pattern
-        except ImportError:
-            # Python 3.6 `Pattern`:
-            from typing.re import Pattern
+            combined.append(re.compile(
+                '|'.join(f'(?:{p.pattern})' for p in group), flags))
+        except re.error:
+            # e.g. the same group name used in several patterns
+            combined.extend(group)
+    return combined + separate
+
 
+class IgnorePaths(object):
+    """Matches paths against exact paths, leading and trailing wildcards and
+    regular expressions. The rules are compiled into a set, a prefix trie, a
+    trie of reversed suffixes and combined regular expressions, so that the
+    lookup time does not grow with the number of rules."""
+
+    def __init__(self, paths):
+        Pattern = _get_pattern_class()
         re_paths = set(p for p in paths if isinstance(p, Pattern))
         paths = set(paths) - re_paths
 
@@ -34,13 +165,127 @@ class IgnorePaths(object):
         trailing_wildcards = set(p for p in paths if p.endswith('*'))
         exacts = paths - leading_wildcards - trailing_wildcards
 
-        self.li = [s.__eq__ for s in exacts]
-        self.li.extend([lambda p: p.endswith(s[1:]) for s in leading_wildcards])
-        self.li.extend([lambda p: p.startswith(s[:-1]) for s in trailing_wildcards])
-        self.li.extend([s.match for s in re_paths])
+        self.exacts = frozenset(exacts)
+        self.prefixes = _build_trie(s[:-1] for s in trailing_wildcards)
+        self.suffixes = _build_trie(s[:0:-1] for s in leading_wildcards)
+        self.patterns = [p.match for p in _combine_patterns(re_paths)]
 
     def __call__(self, path):
-        return any(f(path) for f in self.li)
+        return (
+            path in self.exacts
+            or bool(self.prefixes) and _trie_match(self.prefixes, path)
+            or bool(self.suffixes) and _trie_match(
+                self.suffixes, reversed(path))
+            or any(match(path) for match in self.patterns)
+        )
+
+
+_glob_chars = re.compile(r'[*?[]')
+
+
+class Secrets(object):
+    """Matches keys against exact keys, glob patterns and regular
+    expressions, and replaces the values of the matching keys in nested
+    data. The globs and regular expressions are compiled into combined
+    regular expressions, and their results are cached per key."""
+
+    mask = '***'
+    max_cached_keys = 1024
+
+    def __init__(self, secrets, case_insensitive=False):
+        Pattern = _get_pattern_class()
+        flags = re.IGNORECASE if case_insensitive else 0
+        self.keys = tuple(secrets)
+        self.case_insensitive = case_insensitive
+
+        patterns = set(p for p in secrets if isinstance(p, Pattern))
+        keys = set(secrets) - patterns
+        globs = set(k for k in keys if _glob_chars.search(k))
+        patterns.update(
+            re.compile(fnmatch.translate(k), flags) for k in globs)
+
+        self.exacts = frozenset(
+            k.lower() if case_insensitive else k for k in keys - globs)
+        self.patterns = [p.match for p in _combine_patterns(patterns)]
+        self._matched = {}
+
+    def __bool__(self):
+        return bool(self.exacts or self.patterns)
+
+    def __iter__(self):
+        return iter(self.exacts)
+
+    def __contains__(self, key):
+        if not isinstance(key, str):
+            return key in self.exacts
+        if (key.lower() if self.case_insensitive else key) in self.exacts:
+            return True
+        if not self.patterns:
+            return False
+        try:
+            return self._matched[key]
+        except KeyError:
+            pass
+        matched = any(match(key) for match in self.patterns)
+        if len(self._matched) < self.max_cached_keys:
+            self._matched[key] = matched
+        return matched
+
+    def scrub(self, data):
+        """Return `data` with the values of the secret keys masked, at any
+        depth of nested dicts and lists. Only the dicts and lists which
+        contain secrets are copied; `data` itself is never modified."""
+        if not self:
+            return data
+        return self._scrub(data)
+
+    def _scrub(self, data):
+        if isinstance(data, dict):
+            changed = None
+            for key, value in data.items():
+                if key in self:
+                    new_value = self.mask
+                elif isinstance(value, (dict, list, tuple)):
+                    new_value = self._scrub(value)
+                else:
+                    continue
+                if new_value is not value:
+                    if changed is None:
+                        changed = {}
+                    changed[key] = new_value
+            if changed is None:
+                return data
+            # e.g. `QueryDict.copy()` returns a mutable copy
+            data = data.copy()
+            for key, value in changed.items():
+                data[key] = value
+            return data
+
+        if isinstance(data, (list, tuple)):
+            ret = None
+            for i, value in enumerate(data):
+                if not isinstance(value, (dict, list, tuple)):
+                    continue
+                new_value = self._scrub(value)
+                if new_value is not value:
+                    if ret is None:
+                        ret = list(data)
+                    ret[i] = new_value
+            return data if ret is None else ret
+
+        return data
+
+
+_unprefixed_headers = frozenset(('CONTENT_TYPE', 'CONTENT_LENGTH'))
+
+
+def get_meta_key(header):
+    """`'X-Forwarded-For'` -> `'HTTP_X_FORWARDED_FOR'`. Keys of
+    `request.META` are returned as is."""
+    key = header.upper().replace('-', '_')
+    if key.startswith('HTTP_') or key in _unprefixed_headers:
+        return key
+    return 'HTTP_' + key
 
 
 def populate_settings(_settings):
@@ -52,6 +297,42 @@ def populate_settings(_settings):
     _settings['STORAGE_CLASS'] = import_string(_settings['STORAGE_CLASS'])
     _settings['SERIALIZER_CLASS'] = import_string(
         _settings['SERIALIZER_CLASS'])
+    _settings['QUEUED_STORAGE_CLASS'] = import_string(
+        _settings['QUEUED_STORAGE_CLASS'])
+    _settings['COLLECTOR_STORAGE_CLASS'] = import_string(
+        _settings['COLLECTOR_STORAGE_CLASS'])
+    if _settings['METRICS_STORAGE_CLASS']:
+        _settings['METRICS_STORAGE_CLASS'] = import_string(
+            _settings['METRICS_STORAGE_CLASS'])
+    _settings['JSON_BACKEND'] = get_json_backend(_settings['JSON_BACKEND'])
+    _settings['METHODS'] = frozenset(m.upper() for m in _settings['METHODS'])
+    if not isinstance(_settings['SECRETS'], Secrets):
+        _settings['SECRETS'] = Secrets(
+            _settings['SECRETS'], _settings['SECRETS_CASE_INSENSITIVE'])
+
+    _settings['EXCLUDE_HEADERS'] = frozenset(
+        get_meta_key(h) for h in _settings['EXCLUDE_HEADERS'])
+    if _settings['CAPTURE_HEADERS'] is not None:
+        # A tuple, to keep the order of the stored headers stable
+        _settings['CAPTURE_HEADERS'] = tuple(dict.fromkeys(
+            key for key in map(get_meta_key, _settings['CAPTURE_HEADERS'])
+            if key not in _settings['EXCLUDE_HEADERS']))
+
+    if _settings['QUEUE_OVERFLOW'] not in QUEUE_OVERFLOW_POLICIES:
+        raise NotImplementedError('Such `QUEUE_OVERFLOW` not supported')
+    if _settings['FILE_FSYNC'] not in FILE_FSYNC_POLICIES:
+        raise NotImplementedError('Such `FILE_FSYNC` not supported')
+    if _settings['CAPTURE_PAYLOADS'] not in CAPTURE_PAYLOADS_MODES:
+        raise NotImplementedError('Such `CAPTURE_PAYLOADS` not supported')
+    if _settings['LOGGING_STORAGE_FORMAT'] not in LOGGING_STORAGE_FORMATS:
+        raise NotImplementedError(
+            'Such `LOGGING_STORAGE_FORMAT` not supported')
+    if _settings['NETWORK_FORMAT'] not in NETWORK_FORMATS:
+        raise NotImplementedError('Such `NETWORK_FORMAT` not supported')
+    if (_settings['NETWORK_FORMAT'] == 'msgpack' and
+            not _is_installed('msgpack')):
+        raise ImproperlyConfigured(
+            "`NETWORK_FORMAT` 'msgpack' requires msgpack to be installed")
 
     ignore_paths = _settings['IGNORE_PATHS']
     if callable(ignore_paths):
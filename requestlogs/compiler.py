@@ -0,0 +1,85 @@
+from django.test.signals import setting_changed
+from rest_framework import serializers
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+
+
+class NotCompilable(Exception):
+    pass
+
+
+class CompiledSerializer(object):
+    """Serializes entries like `serializer_class(entry).data`, but using a
+    flat extraction plan built once from the serializer's fields, instead of
+    constructing and binding the fields for every entry.
+
+    The output is a plain `dict` instead of `ReturnDict`."""
+
+    def __init__(self, serializer_class):
+        self.plan = self._compile(serializer_class())
+
+    def _compile(self, serializer):
+        if (type(serializer).to_representation is not
+                serializers.Serializer.to_representation):
+            raise NotCompilable(
+                f'{type(serializer).__name__} overrides `to_representation`')
+
+        plan = []
+        for field in serializer.fields.values():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.ListSerializer):
+                raise NotCompilable(f'`{field.field_name}` is a list')
+            children = (self._compile(field) if
+                        isinstance(field, serializers.Serializer) else None)
+            plan.append((field.field_name, field.get_attribute,
+                         field.to_representation, children))
+        return plan
+
+    def _run(self, plan, instance):
+        ret = {}
+        for field_name, get_attribute, to_representation, children in plan:
+            try:
+                attribute = get_attribute(instance)
+            except SkipField:
+                continue
+
+            check_for_none = (attribute.pk if isinstance(attribute, PKOnlyObject)
+                              else attribute)
+            if check_for_none is None:
+                ret[field_name] = None
+            elif children is not None:
+                ret[field_name] = self._run(children, attribute)
+            else:
+                ret[field_name] = to_representation(attribute)
+        return ret
+
+    def __call__(self, instance):
+        return self._run(self.plan, instance)
+
+
+_compiled = {}
+
+
+def compile_serializer(serializer_class):
+    """Return `CompiledSerializer` for the class, or `None` if the
+    serializer must be run as is. The result is cached."""
+    try:
+        return _compiled[serializer_class]
+    except KeyError:
+        pass
+
+    try:
+        compiled = CompiledSerializer(serializer_class)
+    except NotCompilable:
+        compiled = None
+    _compiled[serializer_class] = compiled
+    return compiled
+
+
+def clear_compiled(*args, **kwargs):
+    if kwargs['setting'] in ('REQUESTLOGS', 'REST_FRAMEWORK'):
+        _compiled.clear()
+
+
+setting_changed.connect(clear_compiled)
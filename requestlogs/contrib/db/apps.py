@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class RequestLogsDbConfig(AppConfig):
+    name = 'requestlogs.contrib.db'
+    label = 'requestlogs_db'
+    verbose_name = 'Request logs'
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-16 20:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RequestLog',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField(db_index=True)),
+                ('action_name', models.CharField(blank=True, db_index=True, max_length=255, null=True)),
+                ('execution_time', models.DurationField(null=True)),
+                ('ip_address', models.CharField(blank=True, max_length=45, null=True)),
+                ('user_id', models.CharField(blank=True, db_index=True, max_length=255, null=True)),
+                ('username', models.CharField(blank=True, max_length=255, null=True)),
+                ('request_id', models.CharField(blank=True, db_index=True, max_length=64, null=True)),
+                ('method', models.CharField(max_length=16)),
+                ('full_path', models.TextField()),
+                ('request_data', models.TextField(blank=True, null=True)),
+                ('query_params', models.TextField(blank=True, null=True)),
+                ('request_headers', models.TextField(blank=True, null=True)),
+                ('status_code', models.PositiveSmallIntegerField(null=True)),
+                ('response_data', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,5 @@
+from ...models import AbstractRequestLog
+
+
+class RequestLog(AbstractRequestLog):
+    pass
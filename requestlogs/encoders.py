@@ -0,0 +1,217 @@
+import functools
+import json
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.datastructures import MultiValueDict
+from django.utils.module_loading import import_string
+from rest_framework.utils.encoders import JSONEncoder
+
+
+_default = JSONEncoder().default
+_non_ascii = re.compile(r'[^\x00-\x7f]')
+
+
+def _escape_char(match):
+    c = ord(match.group())
+    if c > 0xffff:
+        c -= 0x10000
+        return '\\u{:04x}\\u{:04x}'.format(
+            0xd800 | (c >> 10), 0xdc00 | (c & 0x3ff))
+    return '\\u{:04x}'.format(c)
+
+
+def escape_non_ascii(s):
+    """Escape the output of an encoder the way `ensure_ascii=True` does.
+    Non-ASCII characters can only appear inside JSON strings, so the whole
+    document can be processed at once."""
+    return s if s.isascii() else _non_ascii.sub(_escape_char, s)
+
+
+def _plain(value):
+    # Fast encoders serialize dict subclasses by their internal storage,
+    # which for `QueryDict` holds lists of values.
+    if isinstance(value, MultiValueDict):
+        return dict(value.items())
+    return value
+
+
+TRUNCATED_MARKER = '...<truncated>'
+
+
+def _cut(s, max_bytes):
+    if s.isascii():
+        return s[:max_bytes]
+    return s.encode()[:max_bytes].decode(errors='ignore')
+
+
+def _exceeds(value, max_bytes):
+    """Whether `value` certainly encodes into more than `max_bytes`. Counts
+    a lower bound of the encoded size, and stops as soon as it passes the
+    limit, so the cost is bounded by the limit and not the value."""
+    stack = [value]
+    size = 0
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str):
+            size += len(value) + 2
+        elif isinstance(value, dict):
+            size += 1 + 2 * len(value)
+            if size <= max_bytes:
+                for k, v in value.items():
+                    stack.append(k)
+                    stack.append(v)
+        elif isinstance(value, (list, tuple)):
+            size += 1 + len(value)
+            if size <= max_bytes:
+                stack.extend(value)
+        else:
+            size += 1
+        if size > max_bytes:
+            return True
+    return False
+
+
+def dumps_limited(value, max_bytes, ensure_ascii, dumps=None):
+    """Encode `value` up to `max_bytes`. Returns the (possibly truncated)
+    string and whether it was truncated.
+
+    Unless the value is estimated to exceed the limit, it is encoded with
+    `dumps`, e.g. the `JSON_BACKEND`, and cut afterwards if needed.
+    Otherwise it is encoded chunk by chunk, stopping once the output
+    reaches `max_bytes` without encoding the rest of the value."""
+    if dumps is not None and not _exceeds(value, max_bytes):
+        ret = dumps(value, ensure_ascii)
+        size = len(ret) if ret.isascii() else len(ret.encode())
+        if size <= max_bytes:
+            return ret, False
+        return _cut(ret, max_bytes) + TRUNCATED_MARKER, True
+    encoder = JSONEncoder(ensure_ascii=ensure_ascii)
+    chunks = []
+    size = 0
+    for chunk in encoder.iterencode(value):
+        chunk_size = len(chunk) if chunk.isascii() else len(chunk.encode())
+        if size + chunk_size > max_bytes:
+            chunks.append(_cut(chunk, max_bytes - size))
+            chunks.append(TRUNCATED_MARKER)
+            return ''.join(chunks), True
+        chunks.append(chunk)
+        size += chunk_size
+    return ''.join(chunks), False
+
+
+class RawJSON(str):
+    """A string which already is an encoded JSON document, and which
+    `encode_structured` embeds as is."""
+
+    __slots__ = ()
+
+
+_compact_encoders = {
+    ensure_ascii: JSONEncoder(ensure_ascii=ensure_ascii,
+                              separators=(',', ':')).encode
+    for ensure_ascii in (True, False)
+}
+
+
+def encode_structured(value, ensure_ascii):
+    """Encode `value` as compact JSON, embedding the `RawJSON` strings in it
+    as nested documents instead of encoding them as strings."""
+    encode = _compact_encoders[ensure_ascii]
+
+    def _encode(value):
+        if isinstance(value, RawJSON):
+            return str.__str__(value)
+        if isinstance(value, dict):
+            return '{%s}' % ','.join(
+                f'{encode(str(k))}:{_encode(v)}' for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return '[%s]' % ','.join(_encode(v) for v in value)
+        return encode(value)
+
+    return _encode(value)
+
+
+def json_dumps(value, ensure_ascii):
+    return json.dumps(value, cls=JSONEncoder, ensure_ascii=ensure_ascii)
+
+
+def _fallback_to_json(dumps):
+    """Encode the values which the fast backend cannot handle, e.g. integers
+    wider than 64 bits, with DRF's encoder instead."""
+    @functools.wraps(dumps)
+    def wrapper(value, ensure_ascii):
+        try:
+            return dumps(value, ensure_ascii)
+        except (TypeError, OverflowError):
+            return json_dumps(value, ensure_ascii)
+    return wrapper
+
+
+@_fallback_to_json
+def orjson_dumps(value, ensure_ascii):
+    import orjson
+
+    # UTC datetimes end with "Z", as with DRF's encoder
+    ret = orjson.dumps(
+        _plain(value), default=_default,
+        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_UTC_Z,
+    ).decode()
+    return escape_non_ascii(ret) if ensure_ascii else ret
+
+
+@_fallback_to_json
+def ujson_dumps(value, ensure_ascii):
+    import ujson
+
+    return ujson.dumps(_plain(value), ensure_ascii=ensure_ascii,
+                       escape_forward_slashes=False, default=_default)
+
+
+_msgspec_encoder = None
+
+
+@_fallback_to_json
+def msgspec_dumps(value, ensure_ascii):
+    global _msgspec_encoder
+    if _msgspec_encoder is None:
+        import msgspec
+        _msgspec_encoder = msgspec.json.Encoder(
+            enc_hook=_default, decimal_format='number')
+
+    ret = _msgspec_encoder.encode(_plain(value)).decode()
+    return escape_non_ascii(ret) if ensure_ascii else ret
+
+
+JSON_BACKENDS = {
+    'json': json_dumps,
+    'orjson': orjson_dumps,
+    'ujson': ujson_dumps,
+    'msgspec': msgspec_dumps,
+}
+
+
+def _is_installed(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+def get_json_backend(backend):
+    """Resolve the `JSON_BACKEND` setting into a function taking the value
+    and `ensure_ascii`, and returning the encoded string."""
+    if callable(backend):
+        return backend
+    if backend == 'auto':
+        backend = next(
+            (name for name in ('orjson', 'msgspec', 'ujson')
+             if _is_installed(name)),
+            'json')
+    if backend not in JSON_BACKENDS:
+        return import_string(backend)
+    if backend != 'json' and not _is_installed(backend):
+        raise ImproperlyConfigured(
+            f'`JSON_BACKEND` {backend!r} requires {backend} to be installed')
+    return JSON_BACKENDS[backend]
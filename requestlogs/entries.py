@@ -1,15 +1,60 @@
 import datetime
 import time
 
-from django.utils import timezone
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject, cached_property, empty
 from rest_framework.request import Request
 
 from .base import SETTINGS
+from .instrumentation import instrumented
 from .logging import get_request_id
-from .utils import remove_secrets, get_client_ip
+from .policy import get_view_policy
+from .sampling import get_sampler, keep
+from .snapshots import EntrySnapshot, RequestSnapshot, ResponseSnapshot
+from .utils import remove_secrets, get_client_ip, limit_payload, to_primitive
+
+
+def get_timing_attribute_name():
+    return SETTINGS['ATTRIBUTE_NAME'] + '_timing'
+
+
+class RequestTiming(object):
+    """Clock readings of a request. `started_ns` and `started_at` are taken
+    by `RequestLogsMiddleware` when the request arrives; the view and render
+    phases only with `PHASE_TIMINGS`."""
+
+    __slots__ = ('started_ns', 'started_at', 'view_started_ns',
+                 'view_finished_ns', 'render_finished_ns', 'finished_ns')
+
+    def __init__(self, started_ns=None, started_at=None):
+        self.started_ns = (time.perf_counter_ns() if started_ns is None
+                           else started_ns)
+        self.started_at = time.time() if started_at is None else started_at
+        self.view_started_ns = None
+        self.view_finished_ns = None
+        self.render_finished_ns = None
+        self.finished_ns = None
+
+    def get_phases(self):
+        """Durations of the phases which were measured, in nanoseconds."""
+        phases = {}
+        if self.view_started_ns is not None and self.view_finished_ns:
+            phases['view'] = self.view_finished_ns - self.view_started_ns
+        if self.view_finished_ns is not None and self.render_finished_ns:
+            phases['render'] = self.render_finished_ns - self.view_finished_ns
+        return phases
+
+
+def _to_timedelta(ns):
+    return datetime.timedelta(microseconds=ns / 1000)
 
 
 class RequestHandler(object):
+    # Set by `RequestLogEntry.collect()`
+    max_data_bytes = None
+    capture_payload = True
+    secrets = None
+
     def __init__(self, request):
         self.request = request
 
@@ -17,47 +62,79 @@ class RequestHandler(object):
     def method(self):
         return self.request.method
 
-    @property
+    @cached_property
     def data(self):
-        return remove_secrets(self.request.POST)
+        if not self.capture_payload:
+            return None
+        return limit_payload(remove_secrets(self.request.POST, self.secrets),
+                             self.max_data_bytes)
 
-    @property
+    @cached_property
     def query_params(self):
-        return remove_secrets(self.request.GET)
+        return remove_secrets(self.request.GET, self.secrets)
 
     @property
     def path(self):
         return self.request.path
 
-    @property
+    @cached_property
     def full_path(self):
         return self.request.get_full_path()
 
     @property
     def request_id(self):
-        return get_request_id()
-    
-    @property
+        return (getattr(self.request, SETTINGS['REQUEST_ID_ATTRIBUTE_NAME'],
+                        None) or get_request_id())
+
+    def snapshot(self):
+        return RequestSnapshot(
+            method=self.method,
+            path=self.path,
+            full_path=self.full_path,
+            data=to_primitive(self.data),
+            query_params=to_primitive(self.query_params),
+            request_headers=self.request_headers,
+            request_id=self.request_id,
+        )
+
+    @cached_property
     def request_headers(self):
+        meta = self.request.META
+        capture = SETTINGS['CAPTURE_HEADERS']
+        if capture is not None:
+            items = ((k, meta[k]) for k in capture if k in meta)
+        else:
+            exclude = SETTINGS['EXCLUDE_HEADERS']
+            items = ((k, v) for k, v in meta.items()
+                     if k.startswith("HTTP_") and k not in exclude)
+
+        secrets = self.secrets or SETTINGS['SECRETS']
         headers = {
-            k: v if k not in SETTINGS['SECRETS'] else "*****"
-            for k, v in self.request.META.items()
-            if k.startswith("HTTP_")
+            k: v if k not in secrets else "*****"
+            for k, v in items
         }
         return headers
 
 
 class DRFRequestHandler(RequestHandler):
-    @property
+    @cached_property
     def data(self):
-        return remove_secrets(self.request.data)
+        if not self.capture_payload:
+            return None
+        return limit_payload(remove_secrets(self.request.data, self.secrets),
+                             self.max_data_bytes)
 
-    @property
+    @cached_property
     def query_params(self):
         return self.request.query_params
 
 
 class ResponseHandler(object):
+    # Set by `RequestLogEntry.collect()`
+    max_data_bytes = None
+    capture_payload = True
+    secrets = None
+
     def __init__(self, response):
         self.response = response
 
@@ -65,12 +142,19 @@ class ResponseHandler(object):
     def status_code(self):
         return self.response.status_code
 
-    @property
+    @cached_property
     def data(self):
-        data = getattr(self.response, 'data', None)
-        if isinstance(data, dict):
-            return remove_secrets(data)
-        return data
+        if not self.capture_payload:
+            return None
+        data = remove_secrets(getattr(self.response, 'data', None),
+                              self.secrets)
+        return limit_payload(data, self.max_data_bytes)
+
+    def snapshot(self):
+        return ResponseSnapshot(
+            status_code=self.status_code,
+            data=to_primitive(self.data),
+        )
 
 
 class RequestLogEntry(object):
@@ -82,17 +166,37 @@ class RequestLogEntry(object):
 
     # Private attributes to hold some context
     _user = None
+    _user_info = None
     _drf_request = None
 
+    # Set by `collect()`
+    status_code = None
+
     def __init__(self, request, view_func):
         self.django_request = request
         self.view_func = view_func
         self.view_class = getattr(view_func, 'cls', None)
         # TODO: How to get view_obj at this point?
         self.view_obj = None
-        self._initialized_at = time.time()
+        self.timing = getattr(request, get_timing_attribute_name(), None)
+        if self.timing is None:
+            # Created outside `RequestLogsMiddleware`
+            self.timing = RequestTiming()
 
+    @instrumented('finalize')
     def finalize(self, response):
+        if self.collect(response):
+            self.store()
+
+    @instrumented('finalize')
+    async def afinalize(self, response):
+        await self.aresolve_user()
+        if self.collect(response):
+            await self.astore()
+
+    def collect(self, response):
+        """Attach the request and response handlers to the entry. Return
+        `False` if the entry is to be skipped."""
         renderer_context = getattr(response, 'renderer_context', {})
 
         self.view_obj = renderer_context.get('view')
@@ -100,28 +204,142 @@ class RequestLogEntry(object):
         if not self.drf_request:
             self.drf_request = renderer_context.get('request')
 
+        self.timing.finished_ns = time.perf_counter_ns()
+        self.status_code = response.status_code
+
         if self.drf_request:
             self.request = self.drf_request_handler(self.drf_request)
         else:
             self.request = self.django_request_handler(self.django_request)
+        self.request.max_data_bytes = self.get_max_data_bytes('request')
+        self.request.secrets = self.policy.secrets
 
         self.response = self.response_handler(response)
+        self.response.max_data_bytes = self.get_max_data_bytes('response')
+        self.response.secrets = self.policy.secrets
 
         if self.skip_entry():
-            return
-
-        self.store()
-
+            return False
+
+        if not self.should_capture_payloads():
+            self.request.capture_payload = False
+            self.response.capture_payload = False
+        return True
+
+    async def aresolve_user(self):
+        """Load the user of `AuthenticationMiddleware` asynchronously, as the
+        lazy `request.user` cannot be evaluated in an async context."""
+        user = getattr(self.django_request, 'user', None)
+        if (self._user is None and isinstance(user, SimpleLazyObject) and
+                user._wrapped is empty and
+                hasattr(self.django_request, 'auser')):
+            self._user = await self.django_request.auser()
+
+    @cached_property
+    def policy(self):
+        return get_view_policy(self.view_func, self.view_class)
+
+    def get_storage_class(self):
+        return self.policy.storage_class or SETTINGS['STORAGE_CLASS']
+
+    @cached_property
+    def storage(self):
+        return self.get_storage_class()()
+
+    @instrumented('store')
     def store(self):
-        storage = SETTINGS['STORAGE_CLASS']()
-        storage.store(self)
-
+        self.storage.store(
+            self.snapshot() if SETTINGS['SNAPSHOT_ENTRIES'] else self)
+
+    @instrumented('store')
+    async def astore(self):
+        await self.storage.astore(
+            self.snapshot() if SETTINGS['SNAPSHOT_ENTRIES'] else self)
+
+    def get_max_data_bytes(self, name):
+        """Limit for the encoded request or response data, from the view's
+        `requestlogs_max_<name>_data_bytes` attribute or from the settings."""
+        limit = getattr(self.policy, f'max_{name}_data_bytes')
+        if limit is None:
+            limit = SETTINGS[f'MAX_{name.upper()}_DATA_BYTES']
+        return limit
+
+    def should_capture_payloads(self):
+        """Whether the request and response data are stored. With
+        `CAPTURE_PAYLOADS = 'tail'` only for failed or slow requests, and for
+        the views which set `requestlogs_capture_payloads = True`. Views
+        which set it to `False` never store them."""
+        if self.policy.capture_payloads is not None:
+            return self.policy.capture_payloads
+        if SETTINGS['CAPTURE_PAYLOADS'] == 'always':
+            return True
+        threshold = SETTINGS['CAPTURE_PAYLOADS_THRESHOLD']
+        return (
+            self.status_code >= SETTINGS['CAPTURE_PAYLOADS_STATUS']
+            or threshold is not None and
+            self.execution_time.total_seconds() * 1000 >= threshold
+        )
+
+    def snapshot(self):
+        """Copy the values needed by the serializer into an immutable
+        `EntrySnapshot`, which holds no references to the request, the
+        response or the view."""
+        return EntrySnapshot(
+            action_name=self.action_name,
+            execution_time=self.execution_time,
+            timestamp=self.timestamp,
+            phase_timings=self.phase_timings,
+            ip_address=self.ip_address,
+            user=self.user,
+            request=self.request.snapshot(),
+            response=self.response.snapshot(),
+        )
+
+    @classmethod
+    @instrumented('skip_request')
+    def skip_request(cls, request):
+        """Early check run by the middleware before the request is handled
+        and before any entry exists. Return `True` to leave the request out
+        of the requestlogs altogether."""
+        return (request.method.upper() not in SETTINGS['METHODS'] or
+                bool(SETTINGS['IGNORE_PATHS']) and
+                SETTINGS['IGNORE_PATHS'](request.path))
+
+    @instrumented('skip_entry')
     def skip_entry(self):
-        skip_checks = [skip_by_user, skip_by_path]
-        return any(skip_check(self) for skip_check in skip_checks)
+        """Run once the response is ready and the request and response
+        handlers are built. Their data is read only if the entry is kept."""
+        skip_checks = [skip_by_view, skip_by_user, skip_by_path]
+        if any(skip_check(self) for skip_check in skip_checks):
+            return True
+        # Observed before sampling, so that e.g. the metrics count all the
+        # requests
+        self.storage.observe(self)
+        return skip_by_sampling(self)
+
+    def get_user_key(self, field):
+        """Same as `self.user.get(field)`, without building the dict."""
+        user = self._user or getattr(self.django_request, 'user', None)
+        if not (user and user.is_authenticated):
+            return None
+        if field == 'id':
+            return user.pk
+        username_field = user.__class__.USERNAME_FIELD or 'username'
+        if field == username_field:
+            return getattr(user, username_field, None)
 
     @property
     def user(self):
+        if self._user_info is None:
+            self._user_info = self.get_user_info()
+        return self._user_info
+
+    @user.setter
+    def user(self, user):
+        self._user = user
+        self._user_info = None
+
+    def get_user_info(self):
         ret = {
             'id': None,
             'username': None,
@@ -137,10 +355,6 @@ class RequestLogEntry(object):
 
         return ret
 
-    @user.setter
-    def user(self, user):
-        self._user = user
-
     @property
     def drf_request(self):
         return self._drf_request
@@ -150,11 +364,11 @@ class RequestLogEntry(object):
         assert isinstance(drf_request, (Request, type(None)))
         self._drf_request = drf_request
 
-    @property
+    @cached_property
     def action_name(self):
         if not self.view_class:
             return None
-        action_names = getattr(self.view_class, 'requestlogs_action_names', {})
+        action_names = self.policy.action_names
         try:
             return action_names[self.view_obj.action]
         except (KeyError, AttributeError):
@@ -163,24 +377,51 @@ class RequestLogEntry(object):
             except KeyError:
                 pass
 
-    @property
+    @cached_property
     def ip_address(self):
         return get_client_ip(self.django_request)
 
     @property
     def timestamp(self):
-        return timezone.now()
+        """When the request arrived."""
+        if settings.USE_TZ:
+            return datetime.datetime.fromtimestamp(
+                self.timing.started_at, tz=datetime.timezone.utc)
+        return datetime.datetime.fromtimestamp(self.timing.started_at)
 
     @property
     def execution_time(self):
-        return datetime.timedelta(seconds=time.time() - self._initialized_at)
+        """From the arrival of the request until the response was ready, on
+        the monotonic clock."""
+        finished_ns = self.timing.finished_ns or time.perf_counter_ns()
+        return _to_timedelta(finished_ns - self.timing.started_ns)
+
+    @property
+    def phase_timings(self):
+        """Durations of the view and render phases with `PHASE_TIMINGS`."""
+        return {name: _to_timedelta(ns)
+                for name, ns in self.timing.get_phases().items()}
 
 
 def skip_by_user(entry):
     if SETTINGS['IGNORE_USER_FIELD']:
-        return entry.user.get(SETTINGS['IGNORE_USER_FIELD'], None) in SETTINGS['IGNORE_USERS']
+        return entry.get_user_key(SETTINGS['IGNORE_USER_FIELD']) in SETTINGS['IGNORE_USERS']
 
 
 def skip_by_path(entry):
     if SETTINGS['IGNORE_PATHS']:
-        return SETTINGS['IGNORE_PATHS'](entry.request.path)
+        return SETTINGS['IGNORE_PATHS'](entry.django_request.path)
+
+
+def skip_by_view(entry):
+    return entry.policy.skip
+
+
+def skip_by_sampling(entry):
+    sampler = get_sampler()
+    rate = entry.policy.sample_rate
+    if rate is None:
+        return sampler is not None and not sampler(entry)
+    if sampler is not None:
+        rate = sampler.adapt(rate)
+    return not keep(rate)
@@ -0,0 +1,230 @@
+import atexit
+import bisect
+import functools
+import glob
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+from django.dispatch import Signal
+
+from .base import SETTINGS
+
+
+logger = logging.getLogger(__name__)
+
+# Sent for every measured value while `INSTRUMENTATION` is on, with the
+# arguments `stage`, `value` and `unit` ('ns' or 'bytes').
+stage_measured = Signal()
+
+DURATION_BOUNDS = tuple(1000 * 2 ** i for i in range(21))  # 1 us - 1 s
+BYTES_BOUNDS = tuple(2 ** i for i in range(6, 25))  # 64 B - 16 MiB
+
+
+class Histogram(object):
+    """Counts of values in buckets with the given upper bounds, and one
+    more bucket for the larger values."""
+
+    def __init__(self, unit, bounds):
+        self.unit = unit
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """The upper bound of the bucket holding the `q` quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'unit': self.unit,
+            'bounds': list(self.bounds),
+            'buckets': list(self.buckets),
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['unit'], tuple(data['bounds']))
+        histogram.buckets = list(data['buckets'])
+        for key in ('count', 'sum', 'min', 'max'):
+            setattr(histogram, key, data[key])
+        return histogram
+
+
+class Aggregator(object):
+    """Histograms of the measured values per stage, for the current
+    process. With `INSTRUMENTATION_DUMP_DIRECTORY` set, a background thread
+    dumps them every `INSTRUMENTATION_DUMP_INTERVAL` seconds, so the
+    request threads never write the file."""
+
+    # Lower bound of the dump interval, so that the thread never spins
+    min_dump_interval = 0.1
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.dump_lock = threading.Lock()
+        self.dumper_pid = None
+
+    def record(self, stage, value, unit='ns'):
+        with self.lock:
+            try:
+                histogram = self.histograms[stage]
+            except KeyError:
+                histogram = self.histograms[stage] = Histogram(
+                    unit, DURATION_BOUNDS if unit == 'ns' else BYTES_BOUNDS)
+            histogram.add(value)
+        if stage_measured.receivers:
+            stage_measured.send(
+                sender=None, stage=stage, value=value, unit=unit)
+        if self.dumper_pid != os.getpid():
+            self.start_dumper()
+
+    def snapshot(self):
+        with self.lock:
+            return {stage: histogram.to_dict()
+                    for stage, histogram in self.histograms.items()}
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def start_dumper(self):
+        """Start the dumping thread of this process, unless it is running.
+        Threads do not survive a fork, so a forked child starts its own."""
+        if not SETTINGS['INSTRUMENTATION_DUMP_DIRECTORY']:
+            return
+        with self.lock:
+            if self.dumper_pid == os.getpid():
+                return
+            self.dumper_pid = os.getpid()
+        threading.Thread(target=self._run_dumper,
+                         name='requestlogs-instrumentation',
+                         daemon=True).start()
+
+    def _run_dumper(self):
+        while True:
+            time.sleep(max(SETTINGS['INSTRUMENTATION_DUMP_INTERVAL'],
+                           self.min_dump_interval))
+            self.dump()
+
+    def dump(self, directory=None):
+        """Write the histograms to `instrumentation-<pid>.json` in the
+        directory, for the `requestlogs_stats` command. Never raises on I/O
+        errors, which are logged."""
+        directory = directory or SETTINGS['INSTRUMENTATION_DUMP_DIRECTORY']
+        if not directory:
+            return
+        path = os.path.join(directory, f'instrumentation-{os.getpid()}.json')
+        with self.dump_lock:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(self.snapshot(), f)
+                os.replace(path + '.tmp', path)
+            except OSError:
+                logger.exception(
+                    'Failed to dump the instrumentation to %s', path)
+
+
+aggregator = Aggregator()
+atexit.register(aggregator.dump)
+
+
+def record(stage, value, unit='ns'):
+    aggregator.record(stage, value, unit)
+
+
+def load_dumps(directory):
+    """Merge the histograms dumped by the processes into the directory."""
+    ret = {}
+    for path in sorted(glob.glob(
+            os.path.join(directory, 'instrumentation-*.json'))):
+        with open(path) as f:
+            for stage, data in json.load(f).items():
+                histogram = Histogram.from_dict(data)
+                if stage in ret:
+                    ret[stage].merge(histogram)
+                else:
+                    ret[stage] = histogram
+    return ret
+
+
+def instrumented(stage):
+    """Record the duration of the decorated function or coroutine function
+    as `stage` when `INSTRUMENTATION` is on."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not SETTINGS['INSTRUMENTATION']:
+                    return await func(*args, **kwargs)
+                started_at = time.perf_counter_ns()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    record(stage, time.perf_counter_ns() - started_at)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not SETTINGS['INSTRUMENTATION']:
+                return func(*args, **kwargs)
+            started_at = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(stage, time.perf_counter_ns() - started_at)
+        return wrapper
+
+    return decorator
+
+
+def encoded_size(data):
+    """Approximate size in bytes of the serialized entry: the UTF-8 length
+    of its keys and strings, which include the dumped request and response
+    data."""
+    if isinstance(data, str):
+        return len(data) if data.isascii() else len(data.encode())
+    if isinstance(data, dict):
+        return sum(encoded_size(k) + encoded_size(v)
+                   for k, v in data.items())
+    if isinstance(data, (list, tuple)):
+        return sum(encoded_size(v) for v in data)
+    return 0
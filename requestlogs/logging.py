@@ -1,22 +1,59 @@
+import contextlib
+import contextvars
+import functools
 import logging
 import uuid
-import threading
 
 from .base import SETTINGS
 
-local = threading.local()
+request_id_var = contextvars.ContextVar('requestlogs_request_id', default='')
 
 
 def get_request_id():
-    return getattr(local, SETTINGS['REQUEST_ID_ATTRIBUTE_NAME'], '')
+    return request_id_var.get()
 
 
 def set_request_id(_uuid=None):
     _uuid = _uuid or uuid.uuid4().hex
-    setattr(local, SETTINGS['REQUEST_ID_ATTRIBUTE_NAME'], _uuid)
+    request_id_var.set(_uuid)
     return _uuid
 
 
+@contextlib.contextmanager
+def request_id_context(_uuid=None):
+    """Set the request id for the duration of the block, and restore the
+    previous one afterwards."""
+    _uuid = _uuid or uuid.uuid4().hex
+    token = request_id_var.set(_uuid)
+    try:
+        yield _uuid
+    finally:
+        request_id_var.reset(token)
+
+
+def bind_context(func):
+    """Wrap `func` to run in a copy of the current context (including the
+    request id), e.g. `executor.submit(bind_context(func), arg)`."""
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+def run_with_request_id(_uuid, func, *args, **kwargs):
+    with request_id_context(_uuid):
+        return func(*args, **kwargs)
+
+
+def bind_request_id(func):
+    """Like `bind_context`, but carries only the request id. The result can
+    be pickled (if `func` can), so it can be passed to process pools and
+    task queues."""
+    return functools.partial(run_with_request_id, get_request_id(), func)
+
+
 def validate_uuid(_uuid):
     try:
         val = uuid.UUID(_uuid, version=4)
@@ -0,0 +1,116 @@
+import logging
+import pickle
+import signal
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from requestlogs.base import SETTINGS
+from requestlogs.ringbuffer import RingBuffer
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Store the entries which `RingBufferStorage` writes to the ring '
+            'buffer, in batches, with `COLLECTOR_STORAGE_CLASS`. Run one '
+            'collector per host.')
+
+    # Seconds to wait for new entries when the buffer is empty
+    poll_interval = 0.01
+    # Seconds to wait before storing a batch again which failed to store
+    retry_interval = 1
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            help='Path of the ring buffer, instead of `RING_BUFFER_PATH`.')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Store the entries in the buffer and exit.')
+
+    def handle(self, *args, **options):
+        path = options['path'] or SETTINGS['RING_BUFFER_PATH']
+        if not path:
+            raise CommandError('Set `RING_BUFFER_PATH` or use --path')
+
+        ring_buffer = RingBuffer(
+            path, slots=SETTINGS['RING_BUFFER_SLOTS'],
+            slot_size=SETTINGS['RING_BUFFER_SLOT_SIZE'])
+        try:
+            ring_buffer.acquire_reader()
+        except OSError:
+            ring_buffer.close()
+            raise CommandError(f'Another collector is reading {path}')
+
+        self.stopping = False
+        if not options['once']:
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        storage = SETTINGS['COLLECTOR_STORAGE_CLASS']()
+        stored = 0
+        entries = []
+        try:
+            while True:
+                if not entries:
+                    batch = self.get_batch(
+                        ring_buffer, wait=not options['once'])
+                    if not batch:
+                        if options['once'] or self.stopping:
+                            break
+                        continue
+                    entries = self.load(batch)
+                if self.store(storage, entries):
+                    stored += len(entries)
+                    entries = []
+                elif options['once'] or self.stopping:
+                    logger.error('Dropped %d requestlog entries which failed '
+                                 'to store', len(entries))
+                    break
+                else:
+                    # The batch is kept and stored again
+                    time.sleep(self.retry_interval)
+        finally:
+            stats = ring_buffer.get_stats()
+            ring_buffer.close()
+
+        self.stdout.write(
+            f'Stored {stored} entries, {stats["dropped"]} dropped by the '
+            f'writers')
+
+    def stop(self, signum, frame):
+        # The entries left in the buffer are stored before exiting
+        self.stopping = True
+
+    def get_batch(self, ring_buffer, wait):
+        """Collect entries until the batch is full or, when waiting for
+        more, `COLLECTOR_BATCH_INTERVAL` has passed."""
+        batch_size = SETTINGS['COLLECTOR_BATCH_SIZE']
+        deadline = (time.monotonic() +
+                    SETTINGS['COLLECTOR_BATCH_INTERVAL'] / 1000)
+        batch = ring_buffer.get_many(batch_size)
+        while (wait and not self.stopping and len(batch) < batch_size and
+                time.monotonic() < deadline):
+            time.sleep(self.poll_interval)
+            batch.extend(ring_buffer.get_many(batch_size - len(batch)))
+        return batch
+
+    def load(self, batch):
+        entries = []
+        for data in batch:
+            try:
+                entries.append(pickle.loads(data))
+            except Exception:
+                logger.exception('Failed to load a requestlog entry')
+        return entries
+
+    def store(self, storage, entries):
+        """Return `False` if the entries failed to store."""
+        try:
+            storage.store_many(entries)
+        except Exception:
+            logger.exception('Failed to store requestlog entries')
+            return False
+        return True
@@ -0,0 +1,52 @@
+import json
+import os
+import sys
+import threading
+
+from django.core.management.base import BaseCommand
+
+from requestlogs.network import TCPReceiver, UnixReceiver
+
+
+class Command(BaseCommand):
+    help = ('Receive the entries sent by `NetworkStorage` and write them '
+            'as newline-delimited JSON. A reference receiver for local '
+            'testing.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=9020)
+        parser.add_argument(
+            '--unix', metavar='PATH',
+            help='Listen on a Unix socket instead of TCP.')
+        parser.add_argument(
+            '--output', metavar='FILE',
+            help='Append the entries to the file instead of stdout.')
+
+    def handle(self, *args, **options):
+        output = (open(options['output'], 'a') if options['output']
+                  else sys.stdout)
+        lock = threading.Lock()
+
+        def write(entries):
+            lines = ''.join(json.dumps(entry, ensure_ascii=False) + '\n'
+                            for entry in entries)
+            with lock:
+                output.write(lines)
+                output.flush()
+
+        if options['unix']:
+            server = UnixReceiver(options['unix'], write)
+        else:
+            server = TCPReceiver((options['host'], options['port']), write)
+        self.stderr.write(f'Receiving on {server.server_address}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if options['unix']:
+                os.unlink(options['unix'])
+            if output is not sys.stdout:
+                output.close()
@@ -0,0 +1,80 @@
+import glob
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from requestlogs.base import SETTINGS
+from requestlogs.instrumentation import Histogram, aggregator, load_dumps
+
+
+class Command(BaseCommand):
+    help = ('Show the stage timings and entry sizes recorded with '
+            '`INSTRUMENTATION`, merged from the processes which dumped them '
+            'to `INSTRUMENTATION_DUMP_DIRECTORY`.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--directory',
+            help='Directory of the dumps, instead of the setting.')
+        parser.add_argument(
+            '--json', action='store_true',
+            help='Output the histograms as JSON.')
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Delete the dumps after showing them.')
+
+    def handle(self, *args, **options):
+        directory = (options['directory'] or
+                     SETTINGS['INSTRUMENTATION_DUMP_DIRECTORY'])
+        if directory and not os.path.isdir(directory):
+            raise CommandError(f'No such directory: {directory}')
+
+        histograms = load_dumps(directory) if directory else {}
+        # Values recorded in this process, e.g. when called from a shell
+        for stage, data in aggregator.snapshot().items():
+            histogram = Histogram.from_dict(data)
+            if stage in histograms:
+                histograms[stage].merge(histogram)
+            else:
+                histograms[stage] = histogram
+
+        if options['json']:
+            self.stdout.write(json.dumps(
+                {stage: h.to_dict() for stage, h in histograms.items()},
+                indent=2, sort_keys=True))
+        elif not histograms:
+            self.stdout.write('No measurements')
+        else:
+            self.write_table(histograms)
+
+        if options['reset']:
+            aggregator.reset()
+            if directory:
+                for path in glob.glob(
+                        os.path.join(directory, 'instrumentation-*.json')):
+                    os.remove(path)
+
+    def format(self, value, unit):
+        if value is None:
+            return '-'
+        if unit == 'ns':
+            return f'{value / 1000:.1f} us'
+        return f'{value:.0f} B'
+
+    def write_table(self, histograms):
+        width = max(len(stage) for stage in histograms)
+        columns = ('count', 'mean', 'p50', 'p99', 'max')
+        self.stdout.write(f'{"stage":<{width}}' + ''.join(
+            f'{column:>14}' for column in columns))
+        for stage in sorted(histograms):
+            h = histograms[stage]
+            values = [
+                str(h.count),
+                self.format(h.sum / h.count if h.count else None, h.unit),
+                self.format(h.quantile(0.5), h.unit),
+                self.format(h.quantile(0.99), h.unit),
+                self.format(h.max, h.unit),
+            ]
+            self.stdout.write(f'{stage:<{width}}' + ''.join(
+                f'{value:>14}' for value in values))
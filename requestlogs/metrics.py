@@ -0,0 +1,222 @@
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+
+from django.test.signals import setting_changed
+
+from .base import SETTINGS
+
+
+class MmapValues(object):
+    """A file of named rows of `width` doubles, written by one process and
+    read by any. The file starts with the number of bytes in use, followed
+    by the rows: the length of the name, the name padded to 8 bytes and the
+    values. A row is written before the used size is updated, so readers
+    never see a partial row."""
+
+    initial_size = 64 * 1024
+
+    def __init__(self, path, width):
+        self.path = path
+        self.width = width
+        self.positions = {}
+        self.file = open(path, 'a+b')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < self.initial_size:
+            self.file.truncate(self.initial_size)
+            size = self.initial_size
+        self.capacity = size
+        self.mmap = mmap.mmap(self.file.fileno(), size)
+        self.used = struct.unpack_from('q', self.mmap, 0)[0] or 8
+        for name, position in self._rows(self.mmap, self.used, width):
+            self.positions[name] = position
+
+    @staticmethod
+    def _rows(buffer, used, width):
+        offset = 8
+        while offset < used:
+            length, = struct.unpack_from('i', buffer, offset)
+            name = bytes(buffer[offset + 4:offset + 4 + length]).decode()
+            offset += 4 + length
+            offset += -offset % 8
+            yield name, offset
+            offset += 8 * width
+
+    def _add_row(self, name):
+        encoded = name.encode()
+        header = 4 + len(encoded)
+        header += -(self.used + header) % 8
+        needed = header + 8 * self.width
+        if self.used + needed > self.capacity:
+            self.capacity = max(self.capacity * 2, self.used + needed)
+            self.mmap.close()
+            self.file.truncate(self.capacity)
+            self.mmap = mmap.mmap(self.file.fileno(), self.capacity)
+
+        struct.pack_into('i', self.mmap, self.used, len(encoded))
+        self.mmap[self.used + 4:self.used + 4 + len(encoded)] = encoded
+        position = self.used + header
+        self.mmap[position:position + 8 * self.width] = bytes(8 * self.width)
+        self.used = position + 8 * self.width
+        struct.pack_into('q', self.mmap, 0, self.used)
+        self.positions[name] = position
+        return position
+
+    def add(self, name, index, value):
+        position = self.positions.get(name)
+        if position is None:
+            position = self._add_row(name)
+        offset = position + 8 * index
+        current, = struct.unpack_from('d', self.mmap, offset)
+        struct.pack_into('d', self.mmap, offset, current + value)
+
+    @classmethod
+    def read(cls, path, width):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < 8:
+            return {}
+        used, = struct.unpack_from('q', data, 0)
+        return {
+            name: list(struct.unpack_from(f'{width}d', data, position))
+            for name, position in cls._rows(data, used, width)
+        }
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_float(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Metrics(object):
+    """Request counts and latency histograms per action name, method and
+    status class. With `directory`, the values are kept in a memory-mapped
+    file per process, and `collect()` sums the files of all the processes.
+    """
+
+    def __init__(self, buckets, directory=None):
+        self.buckets = tuple(sorted(buckets))
+        # The counts of the buckets, the count over the largest bucket and
+        # the sum of the durations
+        self.width = len(self.buckets) + 2
+        self.directory = directory
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.values = {}
+        self.file = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.file = MmapValues(
+                os.path.join(directory, f'metrics-{self.pid}.db'), self.width)
+
+    def observe(self, action_name, method, status_code, seconds):
+        name = json.dumps([action_name or '', method,
+                           f'{status_code // 100}xx'])
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            if self.file is not None:
+                self.file.add(name, index, 1)
+                self.file.add(name, self.width - 1, seconds)
+            else:
+                values = self.values.get(name)
+                if values is None:
+                    values = self.values[name] = [0.0] * self.width
+                values[index] += 1
+                values[-1] += seconds
+
+    def collect(self):
+        """Return the values per `(action_name, method, status)`."""
+        if self.file is None:
+            with self.lock:
+                rows = {name: list(values)
+                        for name, values in self.values.items()}
+        else:
+            rows = {}
+            for path in glob.glob(os.path.join(self.directory, 'metrics-*.db')):
+                for name, values in MmapValues.read(path, self.width).items():
+                    if name in rows:
+                        rows[name] = [a + b for a, b in zip(rows[name], values)]
+                    else:
+                        rows[name] = values
+        return {tuple(json.loads(name)): values
+                for name, values in rows.items()}
+
+    def exposition(self):
+        """The metrics in the Prometheus text format."""
+        rows = sorted(self.collect().items())
+        lines = [
+            '# HELP requestlogs_requests_total Requests by action, method '
+            'and status class.',
+            '# TYPE requestlogs_requests_total counter',
+        ]
+        for (action_name, method, status), values in rows:
+            labels = (f'action_name="{_escape(action_name)}",'
+                      f'method="{_escape(method)}",status="{status}"')
+            lines.append(
+                f'requestlogs_requests_total{{{labels}}} {sum(values[:-1]):.0f}')
+
+        lines.extend([
+            '# HELP requestlogs_request_duration_seconds Request duration by '
+            'action, method and status class.',
+            '# TYPE requestlogs_request_duration_seconds histogram',
+        ])
+        for (action_name, method, status), values in rows:
+            labels = (f'action_name="{_escape(action_name)}",'
+                      f'method="{_escape(method)}",status="{status}"')
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),),
+                                    values[:-1]):
+                cumulative += count
+                lines.append(
+                    f'requestlogs_request_duration_seconds_bucket{{{labels},'
+                    f'le="{_format_float(bound)}"}} {cumulative:.0f}')
+            lines.append(f'requestlogs_request_duration_seconds_sum'
+                         f'{{{labels}}} {_format_float(values[-1])}')
+            lines.append(f'requestlogs_request_duration_seconds_count'
+                         f'{{{labels}}} {cumulative:.0f}')
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """The `Metrics` of the current process. A forked process gets its own
+    file."""
+    global _metrics
+    if _metrics is None or _metrics.pid != os.getpid():
+        with _metrics_lock:
+            if _metrics is None or _metrics.pid != os.getpid():
+                _metrics = Metrics(
+                    SETTINGS['METRICS_BUCKETS'],
+                    SETTINGS['METRICS_MULTIPROCESS_DIRECTORY'])
+    return _metrics
+
+
+def reset_metrics(*args, **kwargs):
+    global _metrics
+    if kwargs['setting'] == 'REQUESTLOGS':
+        with _metrics_lock:
+            metrics, _metrics = _metrics, None
+        if metrics is not None and metrics.pid == os.getpid():
+            metrics.close()
+
+
+setting_changed.connect(reset_metrics)
@@ -1,32 +1,180 @@
+import time
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6, or Django < 3.0 which does not support async middleware
+    import asyncio
+    from asyncio import iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = getattr(asyncio.coroutines, '_is_coroutine', None)
+        return func
+
 from .base import SETTINGS
-from .logging import set_request_id, validate_uuid
+from .entries import RequestTiming, get_timing_attribute_name
+from .instrumentation import record
+from .logging import request_id_context, validate_uuid
 from . import get_requestlog_entry
 
 
-class RequestLogsMiddleware(object):
+def get_skip_attribute_name():
+    return SETTINGS['ATTRIBUTE_NAME'] + '_skip'
+
+
+class BaseMiddleware(object):
+    """Runs natively under both WSGI and ASGI: when the next handler is a
+    coroutine function, `__call__` switches to `__acall__`."""
+
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+
+class RequestLogsMiddleware(BaseMiddleware):
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if self.async_mode:
+            # Django runs a sync `process_view` in a thread when serving
+            # async requests.
+            self.process_view = self.aprocess_view
+            self.process_template_response = self.aprocess_template_response
 
     def process_view(self, request, view_func, view_args, view_kwargs):
+        if getattr(request, get_skip_attribute_name(), False):
+            return
+        if SETTINGS['PHASE_TIMINGS']:
+            timing = getattr(request, get_timing_attribute_name(), None)
+            if timing is not None:
+                timing.view_started_ns = time.perf_counter_ns()
         # DRF sets the `cls` attribute
         if getattr(view_func, 'cls', None):
             get_requestlog_entry(request=request, view_func=view_func)
 
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        RequestLogsMiddleware.process_view(
+            self, request, view_func, view_args, view_kwargs)
+
+    def process_template_response(self, request, response):
+        # Called between the view and the rendering of the response, which
+        # includes DRF responses
+        timing = getattr(request, get_timing_attribute_name(), None)
+        if timing is not None and SETTINGS['PHASE_TIMINGS']:
+            timing.view_finished_ns = time.perf_counter_ns()
+
+            def rendered(response):
+                timing.render_finished_ns = time.perf_counter_ns()
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    async def aprocess_template_response(self, request, response):
+        return RequestLogsMiddleware.process_template_response(
+            self, request, response)
+
+    def start_timing(self, request, started_ns, started_at):
+        setattr(request, get_timing_attribute_name(),
+                RequestTiming(started_ns, started_at))
+
+    def finish_view_timing(self, request):
+        # Responses which are not rendered have no render phase, and their
+        # view phase ends here
+        if SETTINGS['PHASE_TIMINGS']:
+            timing = getattr(request, get_timing_attribute_name())
+            if timing.view_started_ns and timing.view_finished_ns is None:
+                timing.view_finished_ns = time.perf_counter_ns()
+
+    def record_overhead(self, started_ns, response_started_ns,
+                        response_finished_ns):
+        """Record the time spent in the middleware, that is everything but
+        getting the response, with `INSTRUMENTATION`."""
+        if SETTINGS['INSTRUMENTATION']:
+            record('middleware', time.perf_counter_ns() - started_ns -
+                   (response_finished_ns - response_started_ns))
+
+    def get_request_id(self, request):
+        """The request id set by `RequestIdMiddleware`, which has reset the
+        request id of the context by the time the entry is finalized."""
+        return getattr(request, SETTINGS['REQUEST_ID_ATTRIBUTE_NAME'], None)
+
+    def finalize(self, request, response):
+        entry = get_requestlog_entry(request)
+        request_id = self.get_request_id(request)
+        if request_id is None:
+            entry.finalize(response)
+            return
+        with request_id_context(request_id):
+            entry.finalize(response)
+
+    async def afinalize(self, request, response):
+        entry = get_requestlog_entry(request)
+        request_id = self.get_request_id(request)
+        if request_id is None:
+            await entry.afinalize(response)
+            return
+        with request_id_context(request_id):
+            await entry.afinalize(response)
+
     def __call__(self, request):
+        # Read the clocks first, so that the time spent in requestlogs is
+        # included in the execution time
+        started_ns = time.perf_counter_ns()
+        started_at = time.time()
+        if self.async_mode:
+            return self.__acall__(request, started_ns, started_at)
+
+        # Ignored methods and paths are filtered before any entry exists
+        if SETTINGS['ENTRY_CLASS'].skip_request(request):
+            setattr(request, get_skip_attribute_name(), True)
+            return self.get_response(request)
+
+        self.start_timing(request, started_ns, started_at)
+        response_started_ns = time.perf_counter_ns()
         response = self.get_response(request)
+        response_finished_ns = time.perf_counter_ns()
+        self.finish_view_timing(request)
+        self.finalize(request, response)
+        self.record_overhead(
+            started_ns, response_started_ns, response_finished_ns)
+        return response
 
-        # handle only methods defined in the settings
-        if request.method.upper() in tuple(m.upper() for m in SETTINGS['METHODS']):
-            get_requestlog_entry(request).finalize(response)
+    async def __acall__(self, request, started_ns, started_at):
+        if SETTINGS['ENTRY_CLASS'].skip_request(request):
+            setattr(request, get_skip_attribute_name(), True)
+            return await self.get_response(request)
 
+        self.start_timing(request, started_ns, started_at)
+        response_started_ns = time.perf_counter_ns()
+        response = await self.get_response(request)
+        response_finished_ns = time.perf_counter_ns()
+        self.finish_view_timing(request)
+        await self.afinalize(request, response)
+        self.record_overhead(
+            started_ns, response_started_ns, response_finished_ns)
         return response
 
 
-class RequestIdMiddleware(object):
-    def __init__(self, get_response):
-        self.get_response = get_response
+class RequestIdMiddleware(BaseMiddleware):
+    def get_reused_request_id(self, request):
+        return validate_uuid(
+            request.META.get(SETTINGS['REQUEST_ID_HTTP_HEADER']))
 
     def __call__(self, request):
-        reuse_request_id = request.META.get(SETTINGS['REQUEST_ID_HTTP_HEADER'])
-        set_request_id(validate_uuid(reuse_request_id))
-        return self.get_response(request)
+        if self.async_mode:
+            return self.__acall__(request)
+
+        with request_id_context(self.get_reused_request_id(request)) as _uuid:
+            # Kept on the request for the middlewares which finish after the
+            # request id of the context has been reset
+            setattr(request, SETTINGS['REQUEST_ID_ATTRIBUTE_NAME'], _uuid)
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with request_id_context(self.get_reused_request_id(request)) as _uuid:
+            setattr(request, SETTINGS['REQUEST_ID_ATTRIBUTE_NAME'], _uuid)
+            return await self.get_response(request)
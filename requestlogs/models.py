@@ -0,0 +1,31 @@
+from django.db import models
+
+
+class AbstractRequestLog(models.Model):
+    """Fields of a stored requestlog entry.
+
+    There are no foreign keys or unique constraints besides the primary key,
+    so a concrete model can be backed by a table which is partitioned by
+    `timestamp` on the database level."""
+
+    id = models.BigAutoField(primary_key=True)
+    timestamp = models.DateTimeField(db_index=True)
+    action_name = models.CharField(
+        max_length=255, null=True, blank=True, db_index=True)
+    execution_time = models.DurationField(null=True)
+    ip_address = models.CharField(max_length=45, null=True, blank=True)
+    user_id = models.CharField(
+        max_length=255, null=True, blank=True, db_index=True)
+    username = models.CharField(max_length=255, null=True, blank=True)
+    request_id = models.CharField(
+        max_length=64, null=True, blank=True, db_index=True)
+    method = models.CharField(max_length=16)
+    full_path = models.TextField()
+    request_data = models.TextField(null=True, blank=True)
+    query_params = models.TextField(null=True, blank=True)
+    request_headers = models.TextField(null=True, blank=True)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response_data = models.TextField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
@@ -0,0 +1,384 @@
+import atexit
+import glob
+import io
+import json
+import logging
+import os
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .base import SETTINGS
+from .encoders import encode_structured
+
+
+logger = logging.getLogger(__name__)
+
+# A frame is the format of its entries, the length of the payload and the
+# payload: the entries as newline-delimited JSON or as consecutive msgpack
+# maps. The receiver acknowledges each frame with `ACK`.
+FRAME_HEADER = struct.Struct('!cI')
+FORMAT_CODES = {'ndjson': b'j', 'msgpack': b'm'}
+ACK = b'\x06'
+
+
+def encode_frame(entries, format='ndjson', ensure_ascii=True):
+    if format == 'msgpack':
+        import msgpack
+
+        payload = b''.join(msgpack.packb(data, default=str)
+                           for data in entries)
+    else:
+        payload = ''.join(encode_structured(data, ensure_ascii) + '\n'
+                          for data in entries).encode()
+    return FRAME_HEADER.pack(FORMAT_CODES[format], len(payload)) + payload
+
+
+def decode_payload(code, payload):
+    if code == FORMAT_CODES['msgpack']:
+        import msgpack
+
+        return list(msgpack.Unpacker(io.BytesIO(payload), raw=False))
+    return [json.loads(line) for line in payload.splitlines()]
+
+
+def read_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise ConnectionError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def read_frame(sock):
+    """Return the format code and the payload of the next frame."""
+    code, length = FRAME_HEADER.unpack(read_exactly(sock, FRAME_HEADER.size))
+    return code, read_exactly(sock, length)
+
+
+def connect(address, timeout):
+    """Connect to a `(host, port)` pair or to the path of a Unix socket."""
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    sock = socket.create_connection(tuple(address), timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class SpillBuffer(object):
+    """The frames which could not be sent, appended to the files
+    `spill-<time>-<pid>-<n>.frames` in `directory`, up to `max_bytes` in
+    total. A new file is started once the current one has reached
+    `file_max_bytes`, so that the frames can be resent a file at a time.
+    The file a process is appending to is locked, so that the processes
+    sharing the directory only resend the files which are complete.
+
+    The total size is kept in a counter, which is read from the directory
+    at start and again, at most once per `resync_interval` seconds, when
+    the buffer seems full (other processes may have resent files)."""
+
+    resync_interval = 1
+
+    def __init__(self, directory, max_bytes, file_max_bytes=1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.file_max_bytes = file_max_bytes
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.file = None
+        self.file_size = 0
+        self.files = 0
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+        self.size = self.get_size()
+        self.synced_at = time.monotonic()
+
+    def get_paths(self):
+        return sorted(glob.glob(
+            os.path.join(self.directory, 'spill-*.frames')))
+
+    def get_size(self):
+        size = 0
+        for path in self.get_paths():
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def _is_full(self, frame_size):
+        if self.size + frame_size <= self.max_bytes:
+            return False
+        now = time.monotonic()
+        if now - self.synced_at < self.resync_interval:
+            return True
+        self.size = self.get_size()
+        self.synced_at = now
+        return self.size + frame_size > self.max_bytes
+
+    def add(self, frame):
+        """Append the frame. Return `False` if it was dropped because the
+        buffer is full."""
+        with self.lock:
+            if self._is_full(len(frame)):
+                self.dropped += 1
+                return False
+            if self.file is not None and \
+                    self.file_size >= self.file_max_bytes:
+                self._close()
+            if self.file is None:
+                # `fcntl` is not available on Windows
+                import fcntl
+                self.files += 1
+                name = 'spill-{}-{}-{}.frames'.format(
+                    time.time_ns(), self.pid, self.files)
+                path = os.path.join(self.directory, name)
+                self.file = open(path, 'ab')
+                fcntl.flock(self.file, fcntl.LOCK_EX)
+                self.file_size = 0
+            self.file.write(frame)
+            self.file.flush()
+            self.file_size += len(frame)
+            self.size += len(frame)
+            return True
+
+    def _close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _sent(self, size):
+        with self.lock:
+            self.size = max(self.size - size, 0)
+
+    def drain(self, send, max_files=None):
+        """Pass the spilled frames to `send`, oldest first, and delete the
+        files which were sent. Stops at the first exception from `send`,
+        and keeps the frames which were not sent. Resends at most
+        `max_files` files; returns whether there are files left to
+        resend."""
+        import fcntl
+        # New frames go to a new file from now on
+        self.close()
+        drained = 0
+        for path in self.get_paths():
+            if max_files is not None and drained >= max_files:
+                return True
+            try:
+                f = open(path, 'r+b')
+            except FileNotFoundError:
+                continue
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Being written or drained by another process
+                    continue
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    # Drained by another process meanwhile
+                    continue
+                data = f.read()
+                offset = 0
+                try:
+                    while offset + FRAME_HEADER.size <= len(data):
+                        length = FRAME_HEADER.unpack_from(data, offset)[1]
+                        end = offset + FRAME_HEADER.size + length
+                        if end > len(data):
+                            # Cut off by a crash
+                            break
+                        send(data[offset:end])
+                        offset = end
+                except Exception:
+                    f.seek(0)
+                    f.write(data[offset:])
+                    f.truncate()
+                    self._sent(offset)
+                    raise
+                os.remove(path)
+                self._sent(len(data))
+                drained += 1
+        return False
+
+
+class NetworkSender(object):
+    """Sends frames to the receiver at `address` over a pool of up to
+    `connections` persistent connections, and waits for the receiver to
+    acknowledge each frame. After a failure no connection is attempted for
+    a backoff period, which doubles from `backoff` up to `max_backoff`
+    seconds, and the frames are spilled to `spill` meanwhile (or dropped
+    without it). The spilled frames are resent before the next frames,
+    `drain_files` spill files at a time, so that a single frame is never
+    held up for long."""
+
+    drain_files = 1
+
+    def __init__(self, address, connections=1, timeout=5, backoff=0.5,
+                 max_backoff=30, spill=None):
+        self.address = address
+        self.timeout = timeout
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+        self.spill = spill
+        self.pid = os.getpid()
+        self.semaphore = threading.BoundedSemaphore(connections)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.backoff = 0
+        self.retry_at = 0
+        self.dropped = 0
+        # Frames spilled by an earlier process are resent as well
+        self.drain_needed = spill is not None
+
+    def _send(self, frame):
+        with self.semaphore:
+            try:
+                sock = self.idle.pop()
+            except IndexError:
+                sock = connect(self.address, self.timeout)
+            try:
+                sock.sendall(frame)
+                if read_exactly(sock, 1) != ACK:
+                    raise ConnectionError('Unexpected acknowledgement')
+            except Exception:
+                sock.close()
+                raise
+            self.idle.append(sock)
+
+    def send(self, frame):
+        """Send the frame, or spill it if the receiver cannot be reached.
+        Return whether it was sent."""
+        if time.monotonic() < self.retry_at:
+            self.spill_frame(frame)
+            return False
+        try:
+            if self.drain_needed:
+                self.drain_needed = self.spill.drain(
+                    self._send, self.drain_files)
+            self._send(frame)
+        except OSError as e:
+            self.failed(e)
+            self.spill_frame(frame)
+            return False
+        self.backoff = 0
+        return True
+
+    def failed(self, error):
+        with self.lock:
+            self.backoff = min(max(self.backoff * 2, self.initial_backoff),
+                               self.max_backoff)
+            # Jitter spreads the reconnects of the worker processes
+            delay = self.backoff * random.uniform(0.5, 1)
+            self.retry_at = time.monotonic() + delay
+            self.close_idle()
+        logger.warning('Failed to send requestlog entries to %s (%s), '
+                       'retrying in %.1f s', self.address, error, delay)
+
+    def spill_frame(self, frame):
+        if self.spill is not None and self.spill.add(frame):
+            self.drain_needed = True
+        else:
+            self.dropped += 1
+
+    def close_idle(self):
+        while self.idle:
+            try:
+                self.idle.pop().close()
+            except IndexError:
+                break
+
+    def close(self):
+        self.close_idle()
+        if self.spill is not None:
+            self.spill.close()
+
+
+_network_sender = None
+_network_sender_lock = threading.Lock()
+
+
+def get_network_sender():
+    """The `NetworkSender` of the current process. A forked process opens
+    its own connections."""
+    global _network_sender
+    if _network_sender is None or _network_sender.pid != os.getpid():
+        with _network_sender_lock:
+            if _network_sender is None or _network_sender.pid != os.getpid():
+                address = SETTINGS['NETWORK_ADDRESS']
+                if not address:
+                    raise ImproperlyConfigured(
+                        '`NetworkStorage` requires `NETWORK_ADDRESS` to be '
+                        'set')
+                if _network_sender is None:
+                    atexit.register(close_network_sender)
+                spill = None
+                if SETTINGS['NETWORK_SPILL_DIRECTORY']:
+                    spill = SpillBuffer(SETTINGS['NETWORK_SPILL_DIRECTORY'],
+                                        SETTINGS['NETWORK_SPILL_MAX_BYTES'])
+                _network_sender = NetworkSender(
+                    address if isinstance(address, str) else tuple(address),
+                    connections=SETTINGS['NETWORK_CONNECTIONS'],
+                    timeout=SETTINGS['NETWORK_TIMEOUT'],
+                    backoff=SETTINGS['NETWORK_BACKOFF'],
+                    max_backoff=SETTINGS['NETWORK_MAX_BACKOFF'],
+                    spill=spill,
+                )
+    return _network_sender
+
+
+def close_network_sender():
+    global _network_sender
+    with _network_sender_lock:
+        network_sender, _network_sender = _network_sender, None
+    if network_sender is not None:
+        atexit.unregister(close_network_sender)
+        if network_sender.pid == os.getpid():
+            network_sender.close()
+
+
+class FrameHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                frame = read_frame(self.request)
+            except ConnectionError:
+                return
+            self.server.callback(decode_payload(*frame))
+            self.request.sendall(ACK)
+
+
+class ReceiverMixin(socketserver.ThreadingMixIn):
+    """A reference receiver, which passes the entries of each frame to
+    `callback` before acknowledging the frame."""
+
+    daemon_threads = True
+
+    def __init__(self, address, callback):
+        self.callback = callback
+        super().__init__(address, FrameHandler)
+
+
+class TCPReceiver(ReceiverMixin, socketserver.TCPServer):
+    allow_reuse_address = True
+
+
+class UnixReceiver(ReceiverMixin, socketserver.UnixStreamServer):
+    pass
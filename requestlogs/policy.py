@@ -0,0 +1,83 @@
+from django.test.signals import setting_changed
+from django.utils.module_loading import import_string
+
+from .base import SETTINGS, Secrets
+
+
+class ViewPolicy(object):
+    """The requestlogs options of a view, read once from the
+    `requestlogs_<option>` attributes of the view class (or function).
+    `None` means the option is not set for the view, and the settings
+    apply."""
+
+    options = (
+        'skip',
+        'sample_rate',
+        'max_request_data_bytes',
+        'max_response_data_bytes',
+        'capture_payloads',
+        'secrets',
+        'storage_class',
+        'action_names',
+    )
+
+    def __init__(self, view=None):
+        for option in self.options:
+            setattr(self, option,
+                    getattr(view, f'requestlogs_{option}', None))
+
+        self.skip = bool(self.skip)
+        if self.action_names is None:
+            self.action_names = {}
+        if isinstance(self.storage_class, str):
+            self.storage_class = import_string(self.storage_class)
+        if self.secrets is not None:
+            self.secrets = Secrets(
+                SETTINGS['SECRETS'].keys + tuple(self.secrets),
+                SETTINGS['SECRETS_CASE_INSENSITIVE'])
+
+
+_policies = {}
+
+
+def get_view_policy(view_func, view_class=None):
+    """Return the cached `ViewPolicy` of the view."""
+    view = view_class or view_func
+    try:
+        return _policies[view]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable view
+        return ViewPolicy(view)
+    policy = _policies[view] = ViewPolicy(view)
+    return policy
+
+
+def view_policy(**options):
+    """Decorator setting the `requestlogs_<option>` attributes of a view
+    class or function, e.g. `@view_policy(sample_rate=0.1)`. Apply it on
+    top of `@api_view`."""
+    unknown = set(options) - set(ViewPolicy.options)
+    if unknown:
+        raise TypeError('Unknown view policy options: {}'.format(
+            ', '.join(sorted(unknown))))
+
+    def decorator(view):
+        # `@api_view` functions are served by their `cls`
+        targets = [view] + [t for t in [getattr(view, 'cls', None)] if t]
+        for target in targets:
+            for option, value in options.items():
+                setattr(target, f'requestlogs_{option}', value)
+            _policies.pop(target, None)
+        return view
+
+    return decorator
+
+
+def clear_policies(*args, **kwargs):
+    if kwargs['setting'] == 'REQUESTLOGS':
+        _policies.clear()
+
+
+setting_changed.connect(clear_policies)
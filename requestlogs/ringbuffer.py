@@ -0,0 +1,247 @@
+import fcntl
+import logging
+import mmap
+import os
+import stat
+import struct
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test.signals import setting_changed
+
+from .base import SETTINGS
+
+
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer(object):
+    """A memory-mapped file of `slots` slots of `slot_size` bytes, written
+    by any number of processes and read by one. Each slot is claimed under
+    a record lock which is held only to advance the head; the payload is
+    copied without the lock, after which a commit marker makes the slot
+    visible to the reader. When the buffer is full, the new payload is
+    dropped and counted, so that the writers never wait for the reader.
+
+    The header is the magic, the number of slots, the slot size, the head
+    (the next sequence number to claim), the tail (the next sequence number
+    to read) and the number of dropped payloads. A slot starts with its
+    commit marker (the sequence number plus one) and the payload length.
+    The geometry of an existing file is kept.
+
+    The payloads are unpickled by the reader, so the file must be a regular
+    file owned by the current user and inaccessible to others; an existing
+    file which is not is refused rather than fixed."""
+
+    magic = b'RQLRING1'
+    header = struct.Struct('8sqqqqq')
+    header_size = 64
+    slot_header = struct.Struct('qq')
+    head_offset = 24
+    tail_offset = 32
+    dropped_offset = 40
+    # Seconds after which the reader gives up on a claimed slot whose
+    # writer died before committing it
+    stale_timeout = 10
+    # Seconds between the warnings about dropped payloads, per process
+    warning_interval = 10
+
+    def __init__(self, path, slots=4096, slot_size=16 * 1024):
+        self.path = path
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.fd = os.open(
+            path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            self._check_owner()
+            self._initialize(slots, slot_size)
+            self.mmap = mmap.mmap(
+                self.fd, self.header_size + self.slots * self.slot_size)
+        except Exception:
+            os.close(self.fd)
+            raise
+        self.pending_since = None
+        self.warned_at = None
+        self.unreported = 0
+
+    @property
+    def max_size(self):
+        """The largest payload which fits in a slot."""
+        return self.slot_size - self.slot_header.size
+
+    def _check_owner(self):
+        # The mode passed to `os.open` only applies to a new file
+        st = os.fstat(self.fd)
+        if (not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid() or
+                st.st_mode & 0o077):
+            raise ImproperlyConfigured(
+                f'{self.path} must be a file owned by the current user, and '
+                f'not accessible to other users')
+
+    def _initialize(self, slots, slot_size):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 8, 0)
+        try:
+            data = os.pread(self.fd, self.header.size, 0)
+            if len(data) < self.header.size or data[:8] == bytes(8):
+                os.ftruncate(self.fd, self.header_size + slots * slot_size)
+                data = self.header.pack(self.magic, slots, slot_size, 0, 0, 0)
+                os.pwrite(self.fd, data, 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 8, 0)
+        magic, self.slots, self.slot_size = self.header.unpack(data)[:3]
+        if magic != self.magic:
+            raise ImproperlyConfigured(
+                f'{self.path} is not a requestlogs ring buffer')
+
+    def _slot_offset(self, sequence):
+        return self.header_size + (sequence % self.slots) * self.slot_size
+
+    def _read(self, offset):
+        return struct.unpack_from('q', self.mmap, offset)[0]
+
+    def _write(self, offset, value):
+        struct.pack_into('q', self.mmap, offset, value)
+
+    def _lock_head(self):
+        # Record locks exclude other processes, the lock other threads
+        self.lock.acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 8, self.head_offset)
+
+    def _unlock_head(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 8, self.head_offset)
+        self.lock.release()
+
+    def _count_dropped(self):
+        self._lock_head()
+        try:
+            self._write(self.dropped_offset,
+                        self._read(self.dropped_offset) + 1)
+        finally:
+            self._unlock_head()
+
+    def _warn_dropped(self, reason):
+        """Log the dropped payloads at most once per `warning_interval`."""
+        now = time.monotonic()
+        with self.lock:
+            self.unreported += 1
+            if (self.warned_at is not None and
+                    now - self.warned_at < self.warning_interval):
+                return
+            count, self.unreported = self.unreported, 0
+            self.warned_at = now
+        logger.warning(
+            'Dropped %d requestlog entries, the last one because %s',
+            count, reason)
+
+    def put(self, data):
+        """Copy `data` into the next free slot. Return `False` if it was
+        dropped because the buffer is full or it does not fit in a slot."""
+        if len(data) > self.max_size:
+            self._count_dropped()
+            self._warn_dropped(
+                f'it was {len(data)} bytes, more than the {self.max_size} '
+                f'bytes which fit in a slot')
+            return False
+
+        self._lock_head()
+        try:
+            head = self._read(self.head_offset)
+            full = head - self._read(self.tail_offset) >= self.slots
+            if full:
+                self._write(self.dropped_offset,
+                            self._read(self.dropped_offset) + 1)
+            else:
+                self._write(self.head_offset, head + 1)
+        finally:
+            self._unlock_head()
+        if full:
+            self._warn_dropped('the ring buffer was full')
+            return False
+
+        offset = self._slot_offset(head)
+        start = offset + self.slot_header.size
+        self.mmap[start:start + len(data)] = data
+        self._write(offset + 8, len(data))
+        self._write(offset, head + 1)
+        return True
+
+    def acquire_reader(self):
+        """Take the lock of the only reader. Raise `OSError` if another
+        process holds it."""
+        fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 8,
+                    self.tail_offset)
+
+    def get_many(self, max_count):
+        """Remove and return the committed payloads, up to `max_count`, in
+        the order their slots were claimed."""
+        ret = []
+        tail = self._read(self.tail_offset)
+        head = self._read(self.head_offset)
+        while tail < head and len(ret) < max_count:
+            offset = self._slot_offset(tail)
+            marker, length = self.slot_header.unpack_from(self.mmap, offset)
+            if marker != tail + 1:
+                # Claimed but not committed yet
+                now = time.monotonic()
+                if self.pending_since is None:
+                    self.pending_since = now
+                if now - self.pending_since < self.stale_timeout:
+                    break
+                self._count_dropped()
+            else:
+                start = offset + self.slot_header.size
+                ret.append(bytes(self.mmap[start:start + length]))
+                self._write(offset, 0)
+            self.pending_since = None
+            tail += 1
+        self._write(self.tail_offset, tail)
+        return ret
+
+    def get_stats(self):
+        head = self._read(self.head_offset)
+        tail = self._read(self.tail_offset)
+        return {
+            'slots': self.slots,
+            'slot_size': self.slot_size,
+            'pending': head - tail,
+            'dropped': self._read(self.dropped_offset),
+        }
+
+    def close(self):
+        self.mmap.close()
+        os.close(self.fd)
+
+
+_ring_buffer = None
+_ring_buffer_lock = threading.Lock()
+
+
+def get_ring_buffer():
+    """The `RingBuffer` of `RING_BUFFER_PATH`, opened once per process."""
+    global _ring_buffer
+    if _ring_buffer is None or _ring_buffer.pid != os.getpid():
+        with _ring_buffer_lock:
+            if _ring_buffer is None or _ring_buffer.pid != os.getpid():
+                if not SETTINGS['RING_BUFFER_PATH']:
+                    raise ImproperlyConfigured(
+                        '`RingBufferStorage` requires `RING_BUFFER_PATH` to '
+                        'be set')
+                _ring_buffer = RingBuffer(
+                    SETTINGS['RING_BUFFER_PATH'],
+                    slots=SETTINGS['RING_BUFFER_SLOTS'],
+                    slot_size=SETTINGS['RING_BUFFER_SLOT_SIZE'],
+                )
+    return _ring_buffer
+
+
+def close_ring_buffer(*args, **kwargs):
+    global _ring_buffer
+    if kwargs['setting'] == 'REQUESTLOGS':
+        with _ring_buffer_lock:
+            ring_buffer, _ring_buffer = _ring_buffer, None
+        if ring_buffer is not None and ring_buffer.pid == os.getpid():
+            ring_buffer.close()
+
+
+setting_changed.connect(close_ring_buffer)
@@ -0,0 +1,179 @@
+import random
+import threading
+import time
+
+from django.test.signals import setting_changed
+
+from .base import SETTINGS, IgnorePaths
+
+
+class SamplingRule(object):
+    """One item of `SAMPLING_RULES`. The criteria which are given must all
+    match the entry; the criteria which are left out match any entry."""
+
+    def __init__(self, rate=1.0, paths=None, methods=None, status=None,
+                 action_names=None, users=None, user_field='id'):
+        if not 0 <= rate <= 1:
+            raise ValueError('Sampling `rate` must be between 0 and 1')
+        self.rate = rate
+        self.paths = IgnorePaths(paths) if paths else None
+        self.methods = (frozenset(m.upper() for m in methods) if methods
+                        else None)
+        self.status_codes = None
+        self.status_classes = None
+        if status:
+            # e.g. `[404, '5xx']`
+            status = [str(s).lower() for s in status]
+            self.status_codes = frozenset(
+                int(s) for s in status if not s.endswith('xx'))
+            self.status_classes = frozenset(
+                int(s[0]) for s in status if s.endswith('xx'))
+        self.action_names = frozenset(action_names) if action_names else None
+        self.users = frozenset(users) if users else None
+        self.user_field = user_field
+
+    def matches(self, entry):
+        request = entry.django_request
+        if self.methods is not None and request.method not in self.methods:
+            return False
+        if (self.status_codes is not None and
+                entry.status_code not in self.status_codes and
+                (entry.status_code or 0) // 100 not in self.status_classes):
+            return False
+        if self.paths is not None and not self.paths(request.path):
+            return False
+        if (self.action_names is not None and
+                entry.action_name not in self.action_names):
+            return False
+        if (self.users is not None and
+                entry.get_user_key(self.user_field) not in self.users):
+            return False
+        return True
+
+
+class AdaptiveRate(object):
+    """A factor between `min_factor` and 1 for the sampling rates below 1.
+    At most once per `interval` seconds the factor is halved if the storage
+    queue is fuller than `queue_threshold` (a fraction of its size) or the
+    average storage latency is above `latency_threshold` seconds, and
+    doubled otherwise."""
+
+    # Weight of the latest observation in the moving average
+    alpha = 0.2
+
+    def __init__(self, queue_threshold=None, latency_threshold=None,
+                 min_factor=0.01, interval=1):
+        self.queue_threshold = queue_threshold
+        self.latency_threshold = latency_threshold
+        self.min_factor = min_factor
+        self.interval = interval
+        self.factor = 1.0
+        self.latency = None
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def observe_latency(self, seconds):
+        """Report the time it took to store one entry."""
+        with self.lock:
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency += self.alpha * (seconds - self.latency)
+
+    def get_queue_fill(self):
+        from .storages import _storage_queue
+
+        if _storage_queue is None or not _storage_queue.queue.maxsize:
+            return None
+        return _storage_queue.queue.qsize() / _storage_queue.queue.maxsize
+
+    def is_overloaded(self):
+        if self.queue_threshold is not None:
+            fill = self.get_queue_fill()
+            if fill is not None and fill > self.queue_threshold:
+                return True
+        return (self.latency_threshold is not None and
+                self.latency is not None and
+                self.latency > self.latency_threshold)
+
+    def get_factor(self):
+        now = time.monotonic()
+        if now - self.updated_at >= self.interval:
+            with self.lock:
+                if now - self.updated_at >= self.interval:
+                    self.updated_at = now
+                    if self.is_overloaded():
+                        self.factor = max(self.factor / 2, self.min_factor)
+                    else:
+                        self.factor = min(self.factor * 2, 1.0)
+        return self.factor
+
+
+class Sampler(object):
+    """Decides whether an entry is stored, by the rate of the first rule
+    matching it. Entries which match no rule are stored."""
+
+    def __init__(self, rules, adaptive=None):
+        self.rules = [
+            rule if isinstance(rule, SamplingRule) else SamplingRule(**rule)
+            for rule in rules
+        ]
+        self.adaptive = adaptive
+
+    def adapt(self, rate):
+        # Rates which keep every entry are not adapted
+        if self.adaptive is not None and rate < 1:
+            rate *= self.adaptive.get_factor()
+        return rate
+
+    def get_rate(self, entry):
+        for rule in self.rules:
+            if rule.matches(entry):
+                return self.adapt(rule.rate)
+        return 1.0
+
+    def __call__(self, entry):
+        return keep(self.get_rate(entry))
+
+
+def keep(rate):
+    """Whether to keep an entry sampled at `rate`."""
+    return rate >= 1 or random.random() < rate
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler():
+    """The `Sampler` of `SAMPLING_RULES`, or `None` if sampling is off."""
+    global _sampler
+    if _sampler is None and SETTINGS['SAMPLING_RULES']:
+        with _sampler_lock:
+            if _sampler is None:
+                adaptive = None
+                if SETTINGS['SAMPLING_ADAPTIVE']:
+                    latency = SETTINGS['SAMPLING_LATENCY_THRESHOLD']
+                    adaptive = AdaptiveRate(
+                        queue_threshold=SETTINGS['SAMPLING_QUEUE_THRESHOLD'],
+                        latency_threshold=(
+                            None if latency is None else latency / 1000),
+                        min_factor=SETTINGS['SAMPLING_MIN_FACTOR'],
+                    )
+                _sampler = Sampler(SETTINGS['SAMPLING_RULES'], adaptive)
+    return _sampler
+
+
+def observe_storage_latency(seconds):
+    sampler = _sampler
+    if sampler is not None and sampler.adaptive is not None:
+        sampler.adaptive.observe_latency(seconds)
+
+
+def reset_sampler(*args, **kwargs):
+    global _sampler
+    if kwargs['setting'] == 'REQUESTLOGS':
+        _sampler = None
+
+
+setting_changed.connect(reset_sampler)
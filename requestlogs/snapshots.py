@@ -0,0 +1,73 @@
+import copy
+
+
+def _restore(cls, values):
+    return cls(**dict(zip(cls._fields, values)))
+
+
+class Snapshot(object):
+    """Immutable record of the values of an entry. Holds no references to
+    the request, the response or the view, and is cheap to copy and pickle.
+    Subclasses declare their fields in `__slots__`."""
+
+    __slots__ = ()
+    _fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = cls._fields + tuple(cls.__dict__.get('__slots__', ()))
+
+    def __init__(self, **values):
+        for name in self._fields:
+            object.__setattr__(self, name, values.pop(name, None))
+        if values:
+            raise TypeError(f'Unknown fields: {", ".join(values)}')
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self._fields)
+
+    def replace(self, **values):
+        """Return a copy with the given fields replaced."""
+        return type(self)(**dict(zip(self._fields, self._values()), **values))
+
+    def __reduce__(self):
+        return (_restore, (type(self), self._values()))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        # The fields are immutable, but the dicts and lists in them are not
+        return type(self)(**copy.deepcopy(
+            dict(zip(self._fields, self._values())), memo))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._values() == other._values()
+
+    # Equal by the values, which include dicts
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}'
+                           for name in self._fields)
+        return f'{type(self).__name__}({fields})'
+
+
+class RequestSnapshot(Snapshot):
+    __slots__ = ('method', 'path', 'full_path', 'data', 'query_params',
+                 'request_headers', 'request_id')
+
+
+class ResponseSnapshot(Snapshot):
+    __slots__ = ('status_code', 'data')
+
+
+class EntrySnapshot(Snapshot):
+    __slots__ = ('action_name', 'execution_time', 'timestamp', 'ip_address',
+                 'user', 'request', 'response', 'phase_timings')
@@ -1,30 +1,63 @@
-import json
+import asyncio
+import atexit
+import contextvars
 import logging
+import os
+import pickle
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from django.core.files.uploadedfile import UploadedFile
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
+from django.test.signals import setting_changed
 from rest_framework import serializers
-from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.fields import SkipField
 
 from .base import SETTINGS
+from .compiler import compile_serializer
+from .encoders import RawJSON, encode_structured
+from .instrumentation import encoded_size, instrumented, record
+from .metrics import get_metrics
+from .network import close_network_sender, encode_frame, get_network_sender
+from .sampling import observe_storage_latency
+from .snapshots import Snapshot
+from .utils import LimitedPayload, describe_uploaded_files
 
 
 logger = logging.getLogger('requestlogs')
+error_logger = logging.getLogger(__name__)
 
 
 class JsonDumpField(serializers.Field):
     def to_representation(self, value):
-        if isinstance(value, dict):
-            for field_name, field_value in value.items():
-                if isinstance(field_value, UploadedFile):
-                    value[field_name] = (
-                        f'<{field_value.__class__.__name__}, size={field_value.size}>')
-        return json.dumps(value, cls=JSONEncoder, ensure_ascii=SETTINGS['JSON_ENSURE_ASCII'])
+        if isinstance(value, LimitedPayload):
+            ret, truncated = value.dump()
+            # A truncated document is not valid JSON
+            return ret if truncated else RawJSON(ret)
+        return RawJSON(SETTINGS['JSON_BACKEND'](
+            describe_uploaded_files(value), SETTINGS['JSON_ENSURE_ASCII']))
+
+
+class TruncatedField(serializers.BooleanField):
+    """Whether the size limited data in `source` was truncated. Omitted when
+    no limit applies to the data."""
+
+    def get_attribute(self, instance):
+        value = super().get_attribute(instance)
+        if not isinstance(value, LimitedPayload):
+            raise SkipField()
+        return value.truncated
 
 
 class BaseRequestSerializer(serializers.Serializer):
     method = serializers.CharField(read_only=True)
     full_path = serializers.CharField(read_only=True)
     data = JsonDumpField(read_only=True)
+    data_truncated = TruncatedField(source='data', read_only=True)
     query_params = JsonDumpField(read_only=True)
     request_headers = JsonDumpField(read_only=True)
 
@@ -33,6 +66,7 @@ class BaseEntrySerializer(serializers.Serializer):
     class ResponseSerializer(serializers.Serializer):
         status_code = serializers.IntegerField(read_only=True)
         data = JsonDumpField(read_only=True)
+        data_truncated = TruncatedField(source='data', read_only=True)
 
     class UserSerializer(serializers.Serializer):
         id = serializers.IntegerField()
@@ -54,6 +88,11 @@ class RequestIdEntrySerializer(BaseEntrySerializer):
     request = RequestSerializer()
 
 
+class PhaseTimingsEntrySerializer(BaseEntrySerializer):
+    phase_timings = serializers.DictField(
+        child=serializers.DurationField(), read_only=True)
+
+
 class BaseStorage(object):
     serializer_class = None
 
@@ -61,10 +100,604 @@ class BaseStorage(object):
         return (self.serializer_class if self.serializer_class else
                 SETTINGS['SERIALIZER_CLASS'])
 
+    def get_compiled_serializer(self):
+        if SETTINGS['COMPILED_SERIALIZER']:
+            return compile_serializer(self.get_serializer_class())
+
+    @instrumented('prepare')
     def prepare(self, entry):
-        return self.get_serializer_class()(entry).data
+        compiled = self.get_compiled_serializer()
+        if compiled:
+            data = compiled(entry)
+        else:
+            data = self.get_serializer_class()(entry).data
+        if SETTINGS['INSTRUMENTATION']:
+            record('entry_bytes', encoded_size(data), 'bytes')
+        return data
+
+    @instrumented('prepare_many')
+    def prepare_many(self, entries):
+        compiled = self.get_compiled_serializer()
+        if compiled:
+            ret = [compiled(entry) for entry in entries]
+        else:
+            ret = self.get_serializer_class()(entries, many=True).data
+        if SETTINGS['INSTRUMENTATION']:
+            for data in ret:
+                record('entry_bytes', encoded_size(data), 'bytes')
+        return ret
+
+    def observe(self, entry):
+        """Called with every entry which passes the skip checks, before it
+        is sampled (see `SAMPLING_RULES`) and stored. The entry is not
+        snapshotted yet."""
+
+    def store_many(self, entries):
+        """Store a batch of entries. Storages which can write several
+        entries at once should override this."""
+        for entry in entries:
+            self.store(entry)
+
+    async def astore(self, entry):
+        """Store the entry when serving async requests. Storages which can
+        await their I/O should override this. By default `store()` is run in
+        a thread pool shared by all the storages."""
+        context = contextvars.copy_context()
+        await asyncio.get_running_loop().run_in_executor(
+            get_executor(), context.run, self.store, entry)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    thread_name_prefix='requestlogs-executor')
+    return _executor
 
 
 class LoggingStorage(BaseStorage):
+    def log(self, data):
+        if SETTINGS['LOGGING_STORAGE_FORMAT'] == 'json':
+            logger.info(
+                encode_structured(data, SETTINGS['JSON_ENSURE_ASCII']),
+                extra={'requestlog': data})
+        else:
+            logger.info(data)
+
+    def store(self, entry):
+        self.log(self.prepare(entry))
+
+    def store_many(self, entries):
+        for data in self.prepare_many(entries):
+            self.log(data)
+
+
+class DatabaseStorage(BaseStorage):
+    """Stores the entries to `DATABASE_MODEL` using `bulk_create`. Use as
+    `QUEUED_STORAGE_CLASS` to insert the entries in batches."""
+
+    def get_model(self):
+        return apps.get_model(SETTINGS['DATABASE_MODEL'])
+
+    def dump(self, value):
+        return None if value is None else str(
+            JsonDumpField().to_representation(value))
+
+    def to_instance(self, model, entry):
+        user = entry.user
+        user_id = user.get('id')
+        return model(
+            timestamp=entry.timestamp,
+            action_name=entry.action_name,
+            execution_time=entry.execution_time,
+            ip_address=entry.ip_address,
+            user_id=None if user_id is None else str(user_id),
+            username=user.get(get_user_model().USERNAME_FIELD,
+                              user.get('username')),
+            request_id=entry.request.request_id or None,
+            method=entry.request.method,
+            full_path=entry.request.full_path,
+            request_data=self.dump(entry.request.data),
+            query_params=self.dump(entry.request.query_params),
+            request_headers=self.dump(entry.request.request_headers),
+            status_code=entry.response.status_code,
+            response_data=self.dump(entry.response.data),
+        )
+
     def store(self, entry):
-        logger.info(self.prepare(entry))
+        self.store_many([entry])
+
+    def close_old_connection(self, model):
+        """Close the connection if it is broken or has outlived
+        `CONN_MAX_AGE`, as Django does between requests, so that the next
+        batch reconnects. The batches are stored outside of the request
+        cycle, e.g. in the `QueuedStorage` workers or in the collector.
+        Connections in a transaction are left to their owner."""
+        connection = connections[
+            router.db_for_write(model)
+            if SETTINGS['DATABASE_ALIAS'] is None
+            else SETTINGS['DATABASE_ALIAS']]
+        if not connection.in_atomic_block:
+            connection.close_if_unusable_or_obsolete()
+
+    def store_many(self, entries):
+        model = self.get_model()
+        self.close_old_connection(model)
+        try:
+            model.objects.using(SETTINGS['DATABASE_ALIAS']).bulk_create(
+                [self.to_instance(model, entry) for entry in entries],
+                batch_size=SETTINGS['DATABASE_BATCH_SIZE'])
+        finally:
+            self.close_old_connection(model)
+
+
+class MetricsStorage(BaseStorage):
+    """Counts the entries and their execution times per action name, method
+    and status class (see `requestlogs.metrics`), and passes them on to
+    `METRICS_STORAGE_CLASS`, if set. The entries are not serialized for
+    the metrics.
+
+    As `STORAGE_CLASS` the entries are counted in `observe()`, before
+    sampling, so the metrics include the entries which are not stored.
+    Batches passed to `store_many()`, e.g. as `QUEUED_STORAGE_CLASS`, are
+    counted as they are stored."""
+
+    def observe(self, entry):
+        get_metrics().observe(
+            entry.action_name, entry.request.method,
+            entry.response.status_code, entry.execution_time.total_seconds())
+
+    def get_next_storage(self):
+        storage_class = SETTINGS['METRICS_STORAGE_CLASS']
+        return storage_class() if storage_class else None
+
+    def store(self, entry):
+        storage = self.get_next_storage()
+        if storage is not None:
+            storage.store(entry)
+
+    def store_many(self, entries):
+        for entry in entries:
+            self.observe(entry)
+        storage = self.get_next_storage()
+        if storage is not None:
+            storage.store_many(entries)
+
+
+class FileWriter(object):
+    """Appends lines to the segment files of the current process, named
+    `<prefix>-<pid>-<time>-<n>.ndjson`, through a userspace buffer. The
+    buffer is flushed when it is full, before an `fsync`, when the segment
+    is closed, and once `flush_interval` seconds have passed since the
+    previous flush: after a write, or by a daemon thread when no more lines
+    are written. A new segment is started once the current one has reached
+    `max_bytes` or is older than `rotate_interval` seconds."""
+
+    def __init__(self, directory, prefix='requestlogs', buffer_size=-1,
+                 max_bytes=None, rotate_interval=None, fsync='never',
+                 fsync_interval=1, flush_interval=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.buffer_size = buffer_size
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.flush_interval = flush_interval
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.file = None
+        self.path = None
+        self.segments = 0
+        os.makedirs(directory, exist_ok=True)
+        self.closed = threading.Event()
+        self.flusher = None
+        if flush_interval is not None:
+            self.flusher = threading.Thread(
+                target=self._run_flusher, name='requestlogs-file-flusher',
+                daemon=True)
+            self.flusher.start()
+
+    def _open(self, now):
+        self.segments += 1
+        name = '{}-{}-{}-{}.ndjson'.format(
+            self.prefix, self.pid,
+            time.strftime('%Y%m%dT%H%M%S', time.gmtime()), self.segments)
+        self.path = os.path.join(self.directory, name)
+        self.file = open(self.path, 'ab', buffering=self.buffer_size)
+        self.size = self.file.tell()
+        self.opened_at = self.synced_at = self.flushed_at = now
+
+    def _close(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        if self.fsync != 'never':
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+
+    def _should_rotate(self, now):
+        return (
+            self.max_bytes is not None and self.size >= self.max_bytes
+            or self.rotate_interval is not None
+            and now - self.opened_at >= self.rotate_interval
+        )
+
+    def _should_sync(self, now):
+        return (self.fsync == 'batch' or self.fsync == 'interval' and
+                now - self.synced_at >= self.fsync_interval)
+
+    def _should_flush(self, now):
+        return (self.flush_interval is not None and
+                now - self.flushed_at >= self.flush_interval)
+
+    def write_lines(self, lines):
+        """Write the encoded lines, which must end in a newline."""
+        with self.lock:
+            now = time.monotonic()
+            if self.file is not None and self._should_rotate(now):
+                self._close()
+            if self.file is None:
+                self._open(now)
+            for line in lines:
+                self.size += self.file.write(line)
+            if self._should_sync(now):
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.synced_at = self.flushed_at = now
+            elif self._should_flush(now):
+                self.file.flush()
+                self.flushed_at = now
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                self.flushed_at = time.monotonic()
+
+    def _run_flusher(self):
+        # Flushes the lines which a low traffic process would otherwise
+        # keep in the buffer until the next write
+        while not self.closed.wait(self.flush_interval):
+            with self.lock:
+                now = time.monotonic()
+                if self.file is None or not self._should_flush(now):
+                    continue
+                try:
+                    self.file.flush()
+                except OSError:
+                    error_logger.exception('Failed to flush %s', self.path)
+                self.flushed_at = now
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            self._close()
+
+
+_file_writer = None
+_file_writer_lock = threading.Lock()
+
+
+def get_file_writer():
+    """The `FileWriter` of the current process. A forked process starts
+    its own segment files."""
+    global _file_writer
+    if _file_writer is None or _file_writer.pid != os.getpid():
+        with _file_writer_lock:
+            if _file_writer is None or _file_writer.pid != os.getpid():
+                if not SETTINGS['FILE_DIRECTORY']:
+                    raise ImproperlyConfigured(
+                        '`FileStorage` requires `FILE_DIRECTORY` to be set')
+                if _file_writer is None:
+                    atexit.register(close_file_writer)
+                # The buffer of the parent's writer is flushed before a
+                # fork, so it is left as is
+                _file_writer = FileWriter(
+                    SETTINGS['FILE_DIRECTORY'],
+                    prefix=SETTINGS['FILE_PREFIX'],
+                    buffer_size=SETTINGS['FILE_BUFFER_SIZE'],
+                    max_bytes=SETTINGS['FILE_MAX_BYTES'],
+                    rotate_interval=SETTINGS['FILE_ROTATE_INTERVAL'],
+                    fsync=SETTINGS['FILE_FSYNC'],
+                    fsync_interval=SETTINGS['FILE_FSYNC_INTERVAL'],
+                    flush_interval=SETTINGS['FILE_FLUSH_INTERVAL'],
+                )
+    return _file_writer
+
+
+def close_file_writer():
+    global _file_writer
+    with _file_writer_lock:
+        file_writer, _file_writer = _file_writer, None
+    if file_writer is not None:
+        atexit.unregister(close_file_writer)
+        file_writer.close()
+
+
+def _flush_file_writer_before_fork():
+    # The child would otherwise write the parent's buffered lines again
+    _file_writer_lock.acquire()
+    if _file_writer is not None:
+        _file_writer.lock.acquire()
+        if _file_writer.file is not None:
+            try:
+                _file_writer.file.flush()
+            except OSError:
+                error_logger.exception('Failed to flush %s',
+                                       _file_writer.path)
+
+
+def _release_file_writer_after_fork():
+    if _file_writer is not None:
+        _file_writer.lock.release()
+    _file_writer_lock.release()
+
+
+def _drop_file_writer_after_fork():
+    global _file_writer
+    _release_file_writer_after_fork()
+    # The child starts its own segment files
+    _file_writer = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_flush_file_writer_before_fork,
+                        after_in_parent=_release_file_writer_after_fork,
+                        after_in_child=_drop_file_writer_after_fork)
+
+
+class FileStorage(BaseStorage):
+    """Writes the entries as newline-delimited JSON to the files in
+    `FILE_DIRECTORY`. Each process writes to its own segment files."""
+
+    def encode(self, data):
+        return (encode_structured(data, SETTINGS['JSON_ENSURE_ASCII'])
+                + '\n').encode()
+
+    def store(self, entry):
+        self.store_many([entry])
+
+    def store_many(self, entries):
+        get_file_writer().write_lines(
+            [self.encode(data) for data in self.prepare_many(entries)])
+
+
+class NetworkStorage(BaseStorage):
+    """Sends the entries to the receiver at `NETWORK_ADDRESS` in one frame
+    per batch, over persistent connections. Use as `QUEUED_STORAGE_CLASS`
+    to send the entries in batches."""
+
+    def store(self, entry):
+        self.store_many([entry])
+
+    def store_many(self, entries):
+        get_network_sender().send(encode_frame(
+            self.prepare_many(entries), SETTINGS['NETWORK_FORMAT'],
+            SETTINGS['JSON_ENSURE_ASCII']))
+
+
+class RingBufferStorage(BaseStorage):
+    """Copies the entries into the shared memory ring buffer at
+    `RING_BUFFER_PATH`, from which the `requestlogs_collector` command
+    stores them with `COLLECTOR_STORAGE_CLASS`. The entries are passed as
+    pickled snapshots and serialized by the collector."""
+
+    def without_payloads(self, snapshot):
+        """The snapshot with the request and response data replaced by the
+        truncation marker, and flagged as truncated."""
+        def strip(handler):
+            if handler.data is None:
+                return handler
+            # Nothing fits in zero bytes
+            return handler.replace(data=LimitedPayload(None, 0))
+
+        return snapshot.replace(request=strip(snapshot.request),
+                                response=strip(snapshot.response))
+
+    def dump(self, entry, max_size=None):
+        """Pickle the entry's snapshot. If it is larger than `max_size`, the
+        entry is kept without its payloads."""
+        if not isinstance(entry, Snapshot):
+            entry = entry.snapshot()
+        data = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        if max_size is not None and len(data) > max_size:
+            data = pickle.dumps(self.without_payloads(entry),
+                                pickle.HIGHEST_PROTOCOL)
+        return data
+
+    def get_ring_buffer(self):
+        # `fcntl` is not available on Windows
+        from .ringbuffer import get_ring_buffer
+        return get_ring_buffer()
+
+    def store(self, entry):
+        self.store_many([entry])
+
+    def store_many(self, entries):
+        ring_buffer = self.get_ring_buffer()
+        for entry in entries:
+            ring_buffer.put(self.dump(entry, ring_buffer.max_size))
+
+    async def astore(self, entry):
+        # Never waits for the collector
+        self.store(entry)
+
+
+class StorageQueue(object):
+    """Bounded queue of entries, drained by worker threads which hand the
+    entries over to the actual storage."""
+
+    _stop = object()
+
+    def __init__(self, storage_class, maxsize=0, overflow='block', workers=1,
+                 shutdown_timeout=None, batch_size=1, batch_interval=0):
+        self.storage_class = storage_class
+        self.overflow = overflow
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.shutdown_timeout = shutdown_timeout
+        self.dropped = 0
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize)
+        self.threads = [
+            threading.Thread(target=self._run, name=f'requestlogs-{i}',
+                             daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, entry):
+        if self.overflow == 'block':
+            self.queue.put(entry)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(entry)
+                return
+            except queue.Full:
+                if self.overflow == 'drop_newest':
+                    self.dropped += 1
+                    return
+
+            # 'drop_oldest': make room by discarding the head of the queue
+            try:
+                oldest = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            self.queue.task_done()
+            if oldest is self._stop:
+                # Shutting down: the worker threads must still be stopped
+                self.queue.put(oldest)
+                self.dropped += 1
+                return
+            self.dropped += 1
+
+    def flush(self):
+        """Block until every queued entry has been stored."""
+        self.queue.join()
+
+    def shutdown(self):
+        """Store the pending entries and stop the worker threads."""
+        for _ in self.threads:
+            try:
+                self.queue.put(self._stop, timeout=self.shutdown_timeout)
+            except queue.Full:
+                break
+        for thread in self.threads:
+            thread.join(self.shutdown_timeout)
+
+    def _get_batch(self):
+        """Wait for the next entry, and then collect more entries until
+        the batch is full or `batch_interval` seconds have passed."""
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_interval
+        while len(batch) < self.batch_size and batch[-1] is not self._stop:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        storage = self.storage_class()
+        while True:
+            batch = self._get_batch()
+            entries = [entry for entry in batch if entry is not self._stop]
+            try:
+                if entries:
+                    started_at = time.monotonic()
+                    storage.store_many(entries)
+                    observe_storage_latency(
+                        (time.monotonic() - started_at) / len(entries))
+            except Exception:
+                error_logger.exception('Failed to store requestlog entries')
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if len(entries) < len(batch):
+                return
+
+
+_storage_queue = None
+_storage_queue_lock = threading.Lock()
+
+
+def get_storage_queue():
+    """The `StorageQueue` of the current process. A forked process starts
+    its own worker threads; the entries queued in the parent are left to
+    the parent."""
+    global _storage_queue
+    if _storage_queue is None or _storage_queue.pid != os.getpid():
+        with _storage_queue_lock:
+            if _storage_queue is None or _storage_queue.pid != os.getpid():
+                if _storage_queue is not None:
+                    atexit.unregister(_storage_queue.shutdown)
+                _storage_queue = StorageQueue(
+                    SETTINGS['QUEUED_STORAGE_CLASS'],
+                    maxsize=SETTINGS['QUEUE_MAX_SIZE'],
+                    overflow=SETTINGS['QUEUE_OVERFLOW'],
+                    workers=SETTINGS['QUEUE_WORKERS'],
+                    shutdown_timeout=SETTINGS['QUEUE_SHUTDOWN_TIMEOUT'],
+                    batch_size=SETTINGS['QUEUE_BATCH_SIZE'],
+                    batch_interval=SETTINGS['QUEUE_BATCH_INTERVAL'] / 1000,
+                )
+                atexit.register(_storage_queue.shutdown)
+    return _storage_queue
+
+
+def flush_storage_queue():
+    if _storage_queue is not None and _storage_queue.pid == os.getpid():
+        _storage_queue.flush()
+
+
+def shutdown_storage_queue():
+    global _storage_queue
+    with _storage_queue_lock:
+        storage_queue, _storage_queue = _storage_queue, None
+    if storage_queue is not None:
+        atexit.unregister(storage_queue.shutdown)
+        if storage_queue.pid == os.getpid():
+            storage_queue.shutdown()
+
+
+class QueuedStorage(BaseStorage):
+    """Stores the entries in background threads, using
+    `QUEUED_STORAGE_CLASS` as the actual storage. The entries are queued
+    as snapshots, taken on the thread handling the request."""
+
+    def snapshot(self, entry):
+        return entry if isinstance(entry, Snapshot) else entry.snapshot()
+
+    def store(self, entry):
+        get_storage_queue().put(self.snapshot(entry))
+
+    async def astore(self, entry):
+        entry = self.snapshot(entry)
+        if SETTINGS['QUEUE_OVERFLOW'] == 'block':
+            # Waiting for room in the queue must not block the event loop
+            await super().astore(entry)
+        else:
+            self.store(entry)
+
+
+def reload_storage_queue(*args, **kwargs):
+    if kwargs['setting'] == 'REQUESTLOGS':
+        shutdown_storage_queue()
+        close_file_writer()
+        close_network_sender()
+
+
+setting_changed.connect(reload_storage_queue)
@@ -2,14 +2,79 @@ try:
     from ipware import get_client_ip as _get_client_ip
 except ModuleNotFoundError:
     _get_client_ip = lambda r: (None, None)
+from django.core.files.uploadedfile import UploadedFile
+from django.utils.datastructures import MultiValueDict
+
 from .base import SETTINGS
+from .encoders import dumps_limited
+
+
+def remove_secrets(data, secrets=None):
+    return (secrets or SETTINGS['SECRETS']).scrub(data)
+
+
+class LimitedPayload(object):
+    """Request or response data which is to be encoded only up to
+    `max_bytes`. Truncated data ends with `TRUNCATED_MARKER`, and
+    `truncated` tells whether it was cut."""
+
+    __slots__ = ('value', 'max_bytes', '_dumped')
+
+    def __init__(self, value, max_bytes):
+        self.value = value
+        self.max_bytes = max_bytes
+        self._dumped = None
+
+    def dump(self):
+        """Return the encoded data and whether it was truncated. The result
+        is cached, as both the data and the flag are serialized."""
+        if self._dumped is None:
+            self._dumped = dumps_limited(
+                describe_uploaded_files(self.value), self.max_bytes,
+                SETTINGS['JSON_ENSURE_ASCII'], SETTINGS['JSON_BACKEND'])
+        return self._dumped
+
+    @property
+    def truncated(self):
+        return self.dump()[1]
+
+
+def limit_payload(data, max_bytes):
+    if data is None or max_bytes is None:
+        return data
+    return LimitedPayload(data, max_bytes)
+
+
+def describe_uploaded_file(value):
+    return f'<{value.__class__.__name__}, size={value.size}>'
+
+
+def describe_uploaded_files(data):
+    """Replace uploaded files in the dict with a short description."""
+    if not isinstance(data, dict) or not any(
+            isinstance(v, UploadedFile) for v in data.values()):
+        return data
+    return {
+        k: describe_uploaded_file(v) if isinstance(v, UploadedFile) else v
+        for k, v in data.items()
+    }
 
 
-def remove_secrets(data):
-    data = data.copy()
-    for key in SETTINGS['SECRETS']:
-        if key in data:
-            data[key] = '***'
+def to_primitive(data):
+    """Detach the request or response data from the request, e.g. for
+    pickling. Dict and list subclasses, such as DRF's `ReturnDict` which
+    refers to its serializer and through it to the request, are copied
+    into plain dicts and lists at any depth."""
+    if isinstance(data, LimitedPayload):
+        return LimitedPayload(to_primitive(data.value), data.max_bytes)
+    if isinstance(data, MultiValueDict):
+        data = dict(data.items())
+    if isinstance(data, dict):
+        return {k: to_primitive(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [to_primitive(v) for v in data]
+    if isinstance(data, UploadedFile):
+        return describe_uploaded_file(data)
     return data
 
 
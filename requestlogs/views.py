@@ -1,9 +1,17 @@
+from django.http import HttpResponse
 from rest_framework.views import exception_handler as drf_exception_handler
 
 from requestlogs import get_requestlog_entry
+from .metrics import get_metrics
 
 
 def exception_handler(exc, context):
     drf_request = context['request']
     get_requestlog_entry(drf_request).drf_request = drf_request
     return drf_exception_handler(exc, context)
+
+
+def metrics(request):
+    """The metrics of `MetricsStorage` in the Prometheus text format."""
+    return HttpResponse(get_metrics().exposition(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -25,6 +25,8 @@ def run_tests():
                 'django.contrib.auth',
                 'django.contrib.sites',
                 'django.contrib.sessions',
+                'requestlogs',
+                'requestlogs.contrib.db',
             ),
             MIDDLEWARE=[],
             SECRET_KEY='1234',
@@ -27,11 +27,15 @@ setup(
     author_email='teemu.husso@gmail.com',
     url='https://github.com/Raekkeri/django-requestlogs',
     download_url=f'https://github.com/raekkeri/django-requestlogs/tarball/{VERSION}',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     install_requires=requirements,
     extras_require={
         'dev': dev_requirements,
-        'ipware': ['django-ipware']
+        'ipware': ['django-ipware'],
+        'orjson': ['orjson'],
+        'ujson': ['ujson'],
+        'msgspec': ['msgspec'],
+        'msgpack': ['msgpack'],
     },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -1,7 +1,28 @@
+import copy
+import datetime
+import gc
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from decimal import Decimal
 from io import BytesIO
-from unittest.mock import patch
+from unittest.mock import Mock, patch
 
 import django
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.http import HttpRequest, QueryDict
 from django.urls import reverse_lazy
 from django.test import override_settings, modify_settings, TestCase
 if django.VERSION[0] < 2:
@@ -11,9 +32,27 @@ else:
 from rest_framework import serializers
 from rest_framework.response import Response
 from rest_framework.decorators import api_view
+from rest_framework.request import Request
 from rest_framework.test import APITestCase
 
-from requestlogs.storages import JsonDumpField, BaseStorage
+from requestlogs.compiler import compile_serializer
+from requestlogs.encoders import (
+    RawJSON, _is_installed, dumps_limited, encode_structured)
+from requestlogs.metrics import Metrics
+from requestlogs.network import (
+    NetworkSender, SpillBuffer, TCPReceiver, UnixReceiver, encode_frame,
+    get_network_sender)
+from requestlogs.contrib.db.models import RequestLog
+from requestlogs.ringbuffer import RingBuffer
+from requestlogs.snapshots import EntrySnapshot
+from requestlogs.storages import (
+    JsonDumpField, BaseStorage, BaseEntrySerializer, DatabaseStorage,
+    FileStorage, FileWriter, LoggingStorage, NetworkStorage,
+    RequestIdEntrySerializer,
+    StorageQueue, close_file_writer, flush_storage_queue, get_storage_queue,
+    shutdown_storage_queue)
+from requestlogs.utils import LimitedPayload
+from requestlogs.views import metrics as metrics_view
 
 
 @api_view(['POST'])
@@ -26,9 +65,23 @@ def upload_view(request):
     return Response({'status': 'ok'})
 
 
+@api_view(['GET'])
+def serialized_view(request):
+    class ItemSerializer(serializers.Serializer):
+        name = serializers.CharField()
+
+    class ListSerializer(serializers.Serializer):
+        items = ItemSerializer(many=True)
+
+    return Response(ListSerializer(
+        {'items': [{'name': 'a'}, {'name': 'b'}]},
+        context={'request': request}).data)
+
+
 urlpatterns = [
     url(r'^/?$', lambda r: None, name='home'),
     url(r'^upload/?$', upload_view),
+    url(r'^serialized/?$', serialized_view),
 ]
 
 
@@ -45,6 +98,116 @@ class TestSerializeProxyObject(TestCase):
         assert s == {'blob': '{"url": "/"}'}
 
 
+@override_settings(ROOT_URLCONF=__name__)
+class TestJsonBackends(TestCase):
+    value = {
+        'text': 'öú 汉 \U0001f600',
+        'decimal': Decimal('1.5'),
+        'url': reverse_lazy('home'),
+        'list': [1, None, True],
+        1: 'int key',
+    }
+
+    def dump(self, value, backend, ensure_ascii=True):
+        with override_settings(REQUESTLOGS={
+                'JSON_BACKEND': backend, 'JSON_ENSURE_ASCII': ensure_ascii}):
+            return JsonDumpField().to_representation(value)
+
+    def test_backends(self):
+        expected = json.loads(self.dump(self.value, 'json'))
+        for backend in ('orjson', 'ujson', 'msgspec'):
+            if not _is_installed(backend):
+                continue
+            dumped = self.dump(self.value, backend)
+            assert dumped.isascii(), backend
+            assert json.loads(dumped) == expected, backend
+            dumped = self.dump(self.value, backend, ensure_ascii=False)
+            assert 'öú 汉 \U0001f600' in dumped, backend
+            assert json.loads(dumped) == expected, backend
+
+            querydict = QueryDict('a=1&a=2&b=3')
+            assert json.loads(self.dump(querydict, backend)) == \
+                {'a': '2', 'b': '3'}, backend
+
+    def test_fallback_to_json(self):
+        value = {'big': 2 ** 70, 'list': [-2 ** 64]}
+        expected = self.dump(value, 'json')
+        for backend in ('orjson', 'ujson', 'msgspec'):
+            if not _is_installed(backend):
+                continue
+            assert json.loads(self.dump(value, backend)) == \
+                json.loads(expected), backend
+
+    def test_datetimes(self):
+        utc = datetime.timezone.utc
+        value = {
+            'utc': datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=utc),
+            'micro': datetime.datetime(2024, 1, 2, 3, 4, 5, 678901,
+                                       tzinfo=utc),
+            'offset': datetime.datetime(
+                2024, 1, 2, 3, 4, 5,
+                tzinfo=datetime.timezone(datetime.timedelta(hours=2))),
+            'naive': datetime.datetime(2024, 1, 2, 3, 4, 5),
+            'date': datetime.date(2024, 1, 2),
+        }
+        expected = json.loads(self.dump(value, 'json'))
+        assert expected['utc'] == '2024-01-02T03:04:05Z'
+        for backend in ('orjson', 'ujson', 'msgspec'):
+            if not _is_installed(backend):
+                continue
+            assert json.loads(self.dump(value, backend)) == expected, backend
+
+    def test_auto_backend(self):
+        expected = json.loads(self.dump(self.value, 'json'))
+        assert json.loads(self.dump(self.value, 'auto')) == expected
+
+    def test_backend_not_installed(self):
+        with patch('requestlogs.encoders._is_installed', return_value=False):
+            with self.assertRaises(ImproperlyConfigured):
+                self.dump({}, 'orjson')
+
+    def test_custom_backend(self):
+        assert self.dump({'a': 1}, 'tests.test_storages.repr_dumps') == \
+            "{'a': 1}"
+
+
+class TestDumpsLimited(TestCase):
+    def test_stop_at_limit(self):
+        def items():
+            yield 'a'
+            yield 'b'
+            raise AssertionError('Should stop encoding before this')
+
+        class Items(list):
+            def __iter__(self):
+                return items()
+
+        ret, truncated = dumps_limited(Items([1]), 6, True)
+        assert (ret, truncated) == ('["a", ...<truncated>', True)
+
+    def test_limit_in_bytes(self):
+        assert dumps_limited(['öö'], 5, False) == ('["ö...<truncated>', True)
+        assert dumps_limited(['öö'], 8, False) == ('["öö"]', False)
+
+    def test_backend_within_estimate(self):
+        dumps = Mock(side_effect=lambda value, ensure_ascii: '[1, 2, 3]')
+        assert dumps_limited([1, 2, 3], 9, True, dumps) == (
+            '[1, 2, 3]', False)
+        assert dumps_limited([1, 2, 3], 8, True, dumps) == (
+            '[1, 2, 3...<truncated>', True)
+        assert dumps.call_count == 2
+
+    def test_backend_skipped_over_estimate(self):
+        dumps = Mock()
+        assert dumps_limited(['x' * 10], 5, True, dumps) == (
+            '["xxx...<truncated>', True)
+        dumps.assert_not_called()
+
+
+def repr_dumps(value, ensure_ascii):
+    return repr(value)
+
+
 @override_settings(
     ROOT_URLCONF=__name__,
     REQUESTLOGS={'STORAGE_CLASS': 'tests.test_views.TestStorage'},
@@ -60,3 +223,886 @@ class TestWithFileUpload(APITestCase):
 
         assert mocked_store.call_args[0][0]['request']['data'] == \
             '{"file": "<InMemoryUploadedFile, size=4>"}'
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    REQUESTLOGS={'STORAGE_CLASS': 'tests.test_storages.CollectingStorage',
+                 'SNAPSHOT_ENTRIES': True},
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestEntrySnapshot(APITestCase):
+    def test_snapshot(self):
+        CollectingStorage.entries = []
+        self.client.post('/upload?q=1', data={'file': BytesIO(b'\x89PNG')})
+        snapshot, = CollectingStorage.entries
+
+        assert isinstance(snapshot, EntrySnapshot)
+        assert snapshot.request.data == {
+            'file': '<InMemoryUploadedFile, size=4>'}
+        assert snapshot.request.query_params == {'q': '1'}
+        assert snapshot.response.status_code == 200
+        assert snapshot.user == {'id': None, 'username': None}
+
+        restored = pickle.loads(pickle.dumps(snapshot))
+        assert restored == snapshot
+        assert restored.execution_time == snapshot.execution_time
+        assert copy.copy(snapshot) is snapshot
+        copied = copy.deepcopy(snapshot)
+        assert copied == snapshot
+        assert copied.request.query_params is not \
+            snapshot.request.query_params
+        with self.assertRaises(TypeError):
+            hash(snapshot)
+
+        with self.assertRaises(AttributeError):
+            snapshot.action_name = 'changed'
+        with self.assertRaises(AttributeError):
+            snapshot.request.full_path = 'changed'
+
+        data = BaseStorage().prepare(restored)
+        assert data['request']['data'] == \
+            '{"file": "<InMemoryUploadedFile, size=4>"}'
+        assert data['request']['full_path'] == '/upload?q=1'
+
+    def test_detached_from_serializer(self):
+        CollectingStorage.entries = []
+        self.client.get('/serialized')
+        snapshot, = CollectingStorage.entries
+
+        assert snapshot.response.data == {
+            'items': [{'name': 'a'}, {'name': 'b'}]}
+        assert type(snapshot.response.data) is dict
+        assert type(snapshot.response.data['items']) is list
+        assert type(snapshot.response.data['items'][0]) is dict
+
+        seen = set()
+        pending = [snapshot]
+        while pending:
+            obj = pending.pop()
+            if id(obj) in seen or isinstance(obj, (type, types.ModuleType)):
+                continue
+            seen.add(id(obj))
+            assert not isinstance(
+                obj, (HttpRequest, Request, serializers.BaseSerializer)), obj
+            pending.extend(gc.get_referents(obj))
+
+
+@override_settings(
+    ROOT_URLCONF='tests.test_views',
+    REQUESTLOGS={
+        'STORAGE_CLASS': 'requestlogs.storages.QueuedStorage',
+        'QUEUED_STORAGE_CLASS': 'tests.test_views.TestStorage',
+    },
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestQueuedStorage(APITestCase):
+    def test_store_in_background(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            response = self.client.get('/?q=a')
+            flush_storage_queue()
+
+        stored = mocked_store.call_args[0][0]
+        assert stored['request']['full_path'] == '/?q=a'
+        assert stored['response']['status_code'] == 200
+        assert stored['user'] == {'id': None, 'username': None}
+
+    @override_settings(REQUESTLOGS={
+        'STORAGE_CLASS': 'requestlogs.storages.QueuedStorage',
+        'QUEUED_STORAGE_CLASS': 'tests.test_storages.CollectingStorage',
+    })
+    def test_queue_snapshots(self):
+        CollectingStorage.entries = []
+        self.client.post('/', data={'test': 1})
+        flush_storage_queue()
+
+        snapshot, = CollectingStorage.entries
+        assert isinstance(snapshot, EntrySnapshot)
+        assert snapshot.request.data == {'test': '1'}
+
+
+class BlockingStorage(BaseStorage):
+    started = None
+    release = None
+    stored = None
+
+    def store(self, entry):
+        self.stored.append(entry)
+        self.started.set()
+        self.release.wait()
+
+
+class BatchRecordingStorage(BaseStorage):
+    batches = []
+
+    def store_many(self, entries):
+        self.batches.append(entries)
+
+
+class TestStorageQueue(TestCase):
+    def setUp(self):
+        BlockingStorage.started = threading.Event()
+        BlockingStorage.release = threading.Event()
+        BlockingStorage.stored = []
+
+    def _fill(self, overflow):
+        storage_queue = StorageQueue(
+            BlockingStorage, maxsize=2, overflow=overflow)
+        storage_queue.put(1)
+        # Wait until the worker is busy storing the first entry
+        BlockingStorage.started.wait()
+        for entry in (2, 3, 4):
+            storage_queue.put(entry)
+        BlockingStorage.release.set()
+        storage_queue.shutdown()
+        return storage_queue
+
+    def test_drop_newest(self):
+        storage_queue = self._fill('drop_newest')
+        assert BlockingStorage.stored == [1, 2, 3]
+        assert storage_queue.dropped == 1
+
+    def test_drop_oldest(self):
+        storage_queue = self._fill('drop_oldest')
+        assert BlockingStorage.stored == [1, 3, 4]
+        assert storage_queue.dropped == 1
+
+    def test_store_in_batches(self):
+        BatchRecordingStorage.batches = []
+        storage_queue = StorageQueue(
+            BatchRecordingStorage, batch_size=3, batch_interval=10)
+        for entry in range(1, 6):
+            storage_queue.put(entry)
+        storage_queue.shutdown()
+        assert BatchRecordingStorage.batches == [[1, 2, 3], [4, 5]]
+
+    def test_drop_oldest_keeps_stop(self):
+        storage_queue = StorageQueue(
+            BlockingStorage, maxsize=2, overflow='drop_oldest')
+        storage_queue.put(1)
+        BlockingStorage.started.wait()
+        storage_queue.put(2)
+        # As if `shutdown()` had queued the stop signal
+        storage_queue.queue.put(StorageQueue._stop)
+        storage_queue.put(3)
+        storage_queue.put(4)
+        BlockingStorage.release.set()
+        storage_queue.threads[0].join(5)
+
+        assert not storage_queue.threads[0].is_alive()
+        assert BlockingStorage.stored == [1, 3]
+        assert storage_queue.dropped == 2
+
+    @override_settings(REQUESTLOGS={
+        'QUEUED_STORAGE_CLASS': 'tests.test_storages.BatchRecordingStorage',
+    })
+    def test_queue_per_process(self):
+        BatchRecordingStorage.batches = []
+        parent_queue = get_storage_queue()
+        with patch('requestlogs.storages.os.getpid', return_value=1):
+            child_queue = get_storage_queue()
+            assert child_queue is not parent_queue
+            assert child_queue.pid == 1
+            child_queue.put(1)
+            flush_storage_queue()
+            shutdown_storage_queue()
+        parent_queue.shutdown()
+        assert BatchRecordingStorage.batches == [[1]]
+
+
+class SimpleLoggingStorage(LoggingStorage):
+    serializer_class = SimpleStorage.serializer_class
+
+
+class TestStoreMany(TestCase):
+    def test_logging_storage_store_many(self):
+        entries = [{'blob': {'a': 1}}, {'blob': [2]}]
+        with self.assertLogs('requestlogs', 'INFO') as logs:
+            SimpleLoggingStorage().store_many(entries)
+        assert logs.records[0].msg == {'blob': '{"a": 1}'}
+        assert logs.records[1].msg == {'blob': '[2]'}
+
+
+class SimpleFileStorage(FileStorage):
+    serializer_class = SimpleStorage.serializer_class
+
+
+class TestFileStorage(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(close_file_writer)
+
+    def read_segments(self):
+        ret = []
+        for name in sorted(os.listdir(self.tmp.name)):
+            with open(os.path.join(self.tmp.name, name)) as f:
+                ret.append((name, [json.loads(line) for line in f]))
+        return ret
+
+    def test_store_many(self):
+        with override_settings(REQUESTLOGS={'FILE_DIRECTORY': self.tmp.name}):
+            SimpleFileStorage().store_many([{'blob': {'a': 1}}, {'blob': 'ö'}])
+            SimpleFileStorage().store({'blob': [2]})
+
+        (name, lines), = self.read_segments()
+        assert name.startswith(f'requestlogs-{os.getpid()}-')
+        assert name.endswith('-1.ndjson')
+        assert lines == [{'blob': {'a': 1}}, {'blob': 'ö'}, {'blob': [2]}]
+
+    def test_flush_interval(self):
+        writer = FileWriter(self.tmp.name, flush_interval=60)
+        for now in (0, 59, 60):
+            with patch('requestlogs.storages.time.monotonic',
+                       return_value=now):
+                writer.write_lines([f'{now}\n'.encode()])
+            if now == 59:
+                # Still in the buffer
+                assert self.read_segments()[0][1] == []
+        assert self.read_segments()[0][1] == [0, 59, 60]
+        writer.close()
+
+    def test_flush_without_writes(self):
+        writer = FileWriter(self.tmp.name, flush_interval=0.01)
+        writer.write_lines([b'1\n'])
+        deadline = time.monotonic() + 5
+        while (not self.read_segments()[0][1] and
+                time.monotonic() < deadline):
+            time.sleep(0.01)
+        assert self.read_segments()[0][1] == [1]
+        writer.close()
+        writer.flusher.join(5)
+        assert not writer.flusher.is_alive()
+
+    def test_fork(self):
+        with override_settings(REQUESTLOGS={'FILE_DIRECTORY': self.tmp.name}):
+            SimpleFileStorage().store({'blob': 'parent'})
+            process = multiprocessing.get_context('fork').Process(
+                target=store_in_child)
+            process.start()
+            process.join()
+            assert process.exitcode == 0
+
+        lines = sorted(line['blob'] for name, lines in self.read_segments()
+                       for line in lines)
+        assert lines == ['child', 'parent']
+
+    def test_rotate_by_size(self):
+        with override_settings(REQUESTLOGS={
+                'FILE_DIRECTORY': self.tmp.name, 'FILE_MAX_BYTES': 22}):
+            for i in range(3):
+                SimpleFileStorage().store({'blob': i})
+
+        segments = self.read_segments()
+        assert [lines for name, lines in segments] == [
+            [{'blob': 0}, {'blob': 1}], [{'blob': 2}]]
+
+    def test_rotate_by_time(self):
+        writer = FileWriter(self.tmp.name, rotate_interval=60)
+        with patch('requestlogs.storages.time.monotonic', return_value=0):
+            writer.write_lines([b'1\n'])
+        with patch('requestlogs.storages.time.monotonic', return_value=59):
+            writer.write_lines([b'2\n'])
+        with patch('requestlogs.storages.time.monotonic', return_value=60):
+            writer.write_lines([b'3\n'])
+        writer.close()
+
+        segments = self.read_segments()
+        assert [lines for name, lines in segments] == [[1, 2], [3]]
+
+    def test_fsync(self):
+        def count_fsyncs(writer, times):
+            with patch('requestlogs.storages.os.fsync') as mocked_fsync:
+                for now in times:
+                    with patch('requestlogs.storages.time.monotonic',
+                               return_value=now):
+                        writer.write_lines([b'1\n'])
+                return mocked_fsync.call_count
+
+        assert count_fsyncs(FileWriter(self.tmp.name), [0, 1, 2]) == 0
+        assert count_fsyncs(
+            FileWriter(self.tmp.name, fsync='batch'), [0, 1, 2]) == 3
+        assert count_fsyncs(
+            FileWriter(self.tmp.name, fsync='interval', fsync_interval=2),
+            [0, 1, 2, 3, 4]) == 2
+
+    def test_segment_per_process(self):
+        with override_settings(REQUESTLOGS={'FILE_DIRECTORY': self.tmp.name}):
+            SimpleFileStorage().store({'blob': 1})
+            with patch('requestlogs.storages.os.getpid', return_value=1):
+                SimpleFileStorage().store({'blob': 2})
+
+        names = [name for name, lines in self.read_segments()]
+        assert len(names) == 2
+        assert any(name.startswith('requestlogs-1-') for name in names)
+
+    def test_directory_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            SimpleFileStorage().store({'blob': 1})
+
+
+def store_in_child():
+    SimpleFileStorage().store({'blob': 'child'})
+    close_file_writer()
+
+
+def put_many(path, prefix, count):
+    ring_buffer = RingBuffer(path)
+    for i in range(count):
+        assert ring_buffer.put(f'{prefix}-{i}'.encode())
+
+
+@override_settings(ROOT_URLCONF='tests.test_views')
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestRingBufferStorage(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'requestlogs.ring')
+
+    def test_collector(self):
+        with override_settings(REQUESTLOGS={
+                'STORAGE_CLASS': 'requestlogs.storages.RingBufferStorage',
+                'RING_BUFFER_PATH': self.path,
+                'COLLECTOR_STORAGE_CLASS':
+                    'requestlogs.storages.DatabaseStorage'}):
+            self.client.post('/?q=a', data={'test': 1})
+            self.client.get('/func')
+            assert not RequestLog.objects.exists()
+
+            stdout = io.StringIO()
+            call_command('requestlogs_collector', '--once', stdout=stdout)
+
+        assert stdout.getvalue() == 'Stored 2 entries, 0 dropped by the ' \
+            'writers\n'
+        first, second = RequestLog.objects.order_by('id')
+        assert first.full_path == '/?q=a'
+        assert first.request_data == '{"test": "1"}'
+        assert first.action_name == 'post-other-stuff'
+        assert second.full_path == '/func'
+
+    def test_entry_larger_than_slot(self):
+        with override_settings(REQUESTLOGS={
+                'STORAGE_CLASS': 'requestlogs.storages.RingBufferStorage',
+                'RING_BUFFER_PATH': self.path,
+                'RING_BUFFER_SLOT_SIZE': 2048,
+                'COLLECTOR_STORAGE_CLASS':
+                    'requestlogs.storages.DatabaseStorage'}):
+            self.client.post('/', data={'test': 'x' * 4096})
+            call_command('requestlogs_collector', '--once',
+                         stdout=io.StringIO())
+
+        log, = RequestLog.objects.all()
+        assert log.full_path == '/'
+        assert log.request_data == '...<truncated>'
+
+    def test_collector_retries(self):
+        FlakyStorage.batches = []
+        with override_settings(REQUESTLOGS={
+                'STORAGE_CLASS': 'requestlogs.storages.RingBufferStorage',
+                'RING_BUFFER_PATH': self.path,
+                'COLLECTOR_STORAGE_CLASS': 'tests.test_storages.FlakyStorage',
+                'COLLECTOR_BATCH_INTERVAL': 10}), \
+                patch('requestlogs.management.commands.requestlogs_collector.'
+                      'Command.retry_interval', 0), \
+                patch('requestlogs.management.commands.requestlogs_collector.'
+                      'signal.signal') as mocked_signal, \
+                patch('requestlogs.management.commands.requestlogs_collector.'
+                      'logger') as mocked_logger:
+            self.client.get('/?q=a')
+            # Stop the collector once the entry is stored
+            FlakyStorage.stored = lambda: mocked_signal.call_args[0][1](
+                signal.SIGTERM, None)
+            call_command('requestlogs_collector', stdout=io.StringIO())
+
+        assert mocked_logger.exception.call_count == 1
+        batch, = FlakyStorage.batches
+        assert batch[0].request.full_path == '/?q=a'
+
+    def test_refuse_file_of_other_users(self):
+        RingBuffer(self.path).close()
+        with patch('requestlogs.ringbuffer.os.geteuid',
+                   return_value=os.geteuid() + 1):
+            with self.assertRaises(ImproperlyConfigured):
+                RingBuffer(self.path)
+
+        os.chmod(self.path, 0o666)
+        with self.assertRaises(ImproperlyConfigured):
+            RingBuffer(self.path)
+
+        os.remove(self.path)
+        os.symlink(os.path.join(self.tmp.name, 'other'), self.path)
+        with self.assertRaises(OSError):
+            RingBuffer(self.path)
+
+    def test_dropped_warning(self):
+        ring_buffer = RingBuffer(self.path, slots=1, slot_size=32)
+        with patch('requestlogs.ringbuffer.logger') as mocked_logger:
+            assert ring_buffer.put(b'1')
+            assert not ring_buffer.put(b'2')
+            assert not ring_buffer.put(b'x' * 17)
+        mocked_logger.warning.assert_called_once()
+        assert ring_buffer.unreported == 1
+        ring_buffer.close()
+
+    def test_full_buffer(self):
+        ring_buffer = RingBuffer(self.path, slots=2, slot_size=32)
+        assert ring_buffer.put(b'1')
+        assert ring_buffer.put(b'2')
+        assert not ring_buffer.put(b'3')
+        assert not ring_buffer.put(b'x' * 17)
+        assert ring_buffer.get_stats()['dropped'] == 2
+
+        assert ring_buffer.get_many(1) == [b'1']
+        assert ring_buffer.put(b'4')
+        assert ring_buffer.get_many(10) == [b'2', b'4']
+        assert ring_buffer.get_many(10) == []
+        ring_buffer.close()
+
+        # The geometry of the existing file is kept
+        ring_buffer = RingBuffer(self.path)
+        assert ring_buffer.get_stats() == {
+            'slots': 2, 'slot_size': 32, 'pending': 0, 'dropped': 2}
+        ring_buffer.close()
+
+    def test_uncommitted_slot(self):
+        ring_buffer = RingBuffer(self.path, slots=4, slot_size=32)
+        # A writer which claimed the slot and died
+        ring_buffer._write(ring_buffer.head_offset, 1)
+        assert ring_buffer.put(b'1')
+
+        with patch('requestlogs.ringbuffer.time.monotonic', return_value=0):
+            assert ring_buffer.get_many(10) == []
+        with patch('requestlogs.ringbuffer.time.monotonic',
+                   return_value=RingBuffer.stale_timeout):
+            assert ring_buffer.get_many(10) == [b'1']
+        assert ring_buffer.get_stats()['dropped'] == 1
+        ring_buffer.close()
+
+    def test_multiple_processes(self):
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(target=put_many, args=(self.path, i, 100))
+            for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0
+
+        ring_buffer = RingBuffer(self.path)
+        ring_buffer.acquire_reader()
+        payloads = ring_buffer.get_many(1000)
+        assert len(payloads) == 400
+        assert set(payloads) == {
+            f'{i}-{j}'.encode() for i in range(4) for j in range(100)}
+        # Each process wrote its payloads in order
+        for i in range(4):
+            prefix = f'{i}-'.encode()
+            assert [p for p in payloads if p.startswith(prefix)] == [
+                f'{i}-{j}'.encode() for j in range(100)]
+
+        # Only one collector reads the buffer
+        result = context.Queue()
+        collector = context.Process(
+            target=run_collector, args=(self.path, result))
+        collector.start()
+        collector.join()
+        assert 'Another collector' in result.get(timeout=5)
+        ring_buffer.close()
+
+    def test_path_required(self):
+        with override_settings(REQUESTLOGS={
+                'STORAGE_CLASS': 'requestlogs.storages.RingBufferStorage'}):
+            with self.assertRaises(ImproperlyConfigured):
+                self.client.get('/')
+            with self.assertRaises(CommandError):
+                call_command('requestlogs_collector', '--once')
+
+
+class FlakyStorage(BaseStorage):
+    """Fails to store the first batch."""
+
+    batches = []
+    stored = None
+
+    def store_many(self, entries):
+        self.batches.append(entries)
+        if len(self.batches) == 1:
+            raise OSError('Not available')
+        self.batches.pop(0)
+        FlakyStorage.stored()
+
+
+def run_collector(path, result):
+    try:
+        call_command('requestlogs_collector', '--once', '--path', path,
+                     stdout=io.StringIO())
+        result.put('')
+    except CommandError as e:
+        result.put(str(e))
+
+
+class SimpleNetworkStorage(NetworkStorage):
+    serializer_class = SimpleStorage.serializer_class
+
+
+class CountingReceiver(TCPReceiver):
+    connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+
+class TestNetworkStorage(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.received = []
+
+    def start_receiver(self, receiver):
+        thread = threading.Thread(target=receiver.serve_forever)
+        thread.start()
+
+        def stop():
+            receiver.shutdown()
+            receiver.server_close()
+            thread.join()
+
+        self.addCleanup(stop)
+        return receiver
+
+    def test_store_many(self):
+        receiver = self.start_receiver(
+            CountingReceiver(('127.0.0.1', 0), self.received.append))
+        with override_settings(REQUESTLOGS={
+                'NETWORK_ADDRESS': list(receiver.server_address)}):
+            SimpleNetworkStorage().store_many([{'blob': {'a': 1}},
+                                               {'blob': 'ö'}])
+            SimpleNetworkStorage().store({'blob': [2]})
+            assert len(get_network_sender().idle) == 1
+
+        assert self.received == [
+            [{'blob': {'a': 1}}, {'blob': 'ö'}], [{'blob': [2]}]]
+        # One persistent connection
+        assert receiver.connections == 1
+
+    @unittest.skipUnless(_is_installed('msgpack'), 'requires msgpack')
+    def test_msgpack(self):
+        receiver = self.start_receiver(
+            TCPReceiver(('127.0.0.1', 0), self.received.append))
+        with override_settings(REQUESTLOGS={
+                'NETWORK_ADDRESS': list(receiver.server_address),
+                'NETWORK_FORMAT': 'msgpack'}):
+            SimpleNetworkStorage().store_many([{'blob': {'a': 1}}])
+
+        # The dumped data is sent as a string
+        assert self.received == [[{'blob': '{"a": 1}'}]]
+
+    def test_spill_and_resend(self):
+        path = os.path.join(self.tmp.name, 'receiver.sock')
+        spill = SpillBuffer(os.path.join(self.tmp.name, 'spill'), 1000)
+        sender = NetworkSender(path, spill=spill)
+
+        with patch('requestlogs.network.logger') as mocked_logger:
+            assert not sender.send(encode_frame([1]))
+            # No connection is attempted during the backoff
+            with patch('requestlogs.network.connect') as mocked_connect:
+                assert not sender.send(encode_frame([2]))
+            assert mocked_connect.call_count == 0
+        assert mocked_logger.warning.call_count == 1
+        assert len(spill.get_paths()) == 1
+
+        self.start_receiver(UnixReceiver(path, self.received.append))
+        sender.retry_at = 0
+        assert sender.send(encode_frame([3]))
+        assert self.received == [[1], [2], [3]]
+        assert spill.get_paths() == []
+        sender.close()
+
+    def test_spill_limit(self):
+        spill = SpillBuffer(self.tmp.name, 20)
+        sender = NetworkSender(os.path.join(self.tmp.name, 'missing.sock'),
+                               spill=spill)
+        with patch('requestlogs.network.logger'):
+            sender.send(encode_frame(['x' * 10]))
+            sender.retry_at = 0
+            sender.send(encode_frame(['x' * 10]))
+        assert spill.get_size() == 18
+        assert sender.dropped == 1
+        sender.close()
+
+    def test_spill_in_bounded_files(self):
+        spill = SpillBuffer(self.tmp.name, 1000, file_max_bytes=20)
+        with patch.object(spill, 'get_size') as mocked_get_size:
+            for i in range(4):
+                assert spill.add(encode_frame(['x' * 10]))
+        # The size is counted, not read from the directory
+        assert mocked_get_size.call_count == 0
+        assert spill.size == 72
+        assert len(spill.get_paths()) == 2
+
+        sent = []
+        assert spill.drain(sent.append, max_files=1)
+        assert len(sent) == 2
+        assert spill.size == 36
+        assert not spill.drain(sent.append, max_files=1)
+        assert len(sent) == 4
+        assert spill.size == 0
+        assert spill.get_paths() == []
+
+    def test_backoff(self):
+        sender = NetworkSender(os.path.join(self.tmp.name, 'missing.sock'),
+                               backoff=0.5, max_backoff=2)
+        delays = []
+        with patch('requestlogs.network.logger'), \
+                patch('requestlogs.network.random.uniform', return_value=1):
+            for now in range(5):
+                with patch('requestlogs.network.time.monotonic',
+                           return_value=now * 10):
+                    sender.send(encode_frame([1]))
+                    delays.append(sender.retry_at - now * 10)
+        assert delays == [0.5, 1, 2, 2, 2]
+        assert sender.dropped == 5
+
+    def test_import_without_fcntl(self):
+        # As on Windows, where `fcntl` does not exist
+        code = (
+            'import sys; sys.modules["fcntl"] = None\n'
+            'import django; from django.conf import settings\n'
+            'settings.configure(INSTALLED_APPS=["django.contrib.auth", '
+            '"django.contrib.contenttypes", "requestlogs"])\n'
+            'django.setup()\n'
+            'import requestlogs.storages, requestlogs.middleware\n'
+        )
+        subprocess.run([sys.executable, '-c', code], check=True)
+
+
+class TestStructuredLogging(TestCase):
+    def test_encode_structured(self):
+        data = {'a': RawJSON('{"b": [1, "ö"]}'), 'c': ['ö', None],
+                'd': {'e': 1.5}}
+        assert encode_structured(data, True) == (
+            '{"a":{"b": [1, "ö"]},"c":["\\u00f6",null],"d":{"e":1.5}}')
+        assert json.loads(encode_structured(data, False)) == {
+            'a': {'b': [1, 'ö']}, 'c': ['ö', None], 'd': {'e': 1.5}}
+
+    def test_truncated_payload_is_string(self):
+        field = JsonDumpField()
+        assert isinstance(field.to_representation({'a': 1}), RawJSON)
+        payload = LimitedPayload({'a': 'x' * 10}, 5)
+        truncated = field.to_representation(payload)
+        assert payload.truncated
+        assert type(truncated) is str
+        assert encode_structured({'data': truncated}, True) == (
+            '{"data":"{\\"a\\":...<truncated>"}')
+
+    @override_settings(REQUESTLOGS={'LOGGING_STORAGE_FORMAT': 'json'})
+    def test_logging_storage_json(self):
+        entries = [{'blob': {'a': 1}}, {'blob': [2]}]
+        with self.assertLogs('requestlogs', 'INFO') as logs:
+            SimpleLoggingStorage().store_many(entries)
+            SimpleLoggingStorage().store({'blob': 'ö'})
+        assert [r.getMessage() for r in logs.records] == [
+            '{"blob":{"a": 1}}', '{"blob":[2]}', '{"blob":"\\u00f6"}']
+        assert logs.records[0].requestlog == {'blob': '{"a": 1}'}
+
+
+@override_settings(
+    ROOT_URLCONF='tests.test_views',
+    REQUESTLOGS={
+        'STORAGE_CLASS': 'requestlogs.storages.MetricsStorage',
+        'METRICS_STORAGE_CLASS': 'tests.test_views.TestStorage',
+        'METRICS_BUCKETS': [0.1, 1],
+    },
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestMetricsStorage(APITestCase):
+    def test_metrics(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            self.client.get('/')
+            self.client.get('/')
+            self.client.post('/')
+            self.client.get('/user')
+        assert mocked_store.call_count == 4
+
+        exposition = metrics_view(None).content.decode()
+        assert (
+            'requestlogs_requests_total{action_name="get-some-resources",'
+            'method="GET",status="2xx"} 2\n') in exposition
+        assert (
+            'requestlogs_requests_total{action_name="get-some-resources",'
+            'method="GET",status="4xx"} 1\n') in exposition
+        assert (
+            'requestlogs_request_duration_seconds_bucket{'
+            'action_name="post-other-stuff",method="POST",status="2xx",'
+            'le="+Inf"} 1\n') in exposition
+        assert (
+            'requestlogs_request_duration_seconds_count{'
+            'action_name="post-other-stuff",method="POST",status="2xx"} 1\n'
+        ) in exposition
+
+    @override_settings(REQUESTLOGS={
+        'STORAGE_CLASS': 'requestlogs.storages.MetricsStorage',
+        'METRICS_STORAGE_CLASS': 'tests.test_views.TestStorage',
+        'SAMPLING_RULES': [{'methods': ['GET'], 'rate': 0}],
+    })
+    def test_count_before_sampling(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            self.client.get('/')
+            self.client.get('/')
+            self.client.post('/')
+        assert mocked_store.call_count == 1
+
+        exposition = metrics_view(None).content.decode()
+        assert (
+            'requestlogs_requests_total{action_name="get-some-resources",'
+            'method="GET",status="2xx"} 2\n') in exposition
+        assert (
+            'requestlogs_requests_total{action_name="post-other-stuff",'
+            'method="POST",status="2xx"} 1\n') in exposition
+
+    def test_histogram(self):
+        metrics = Metrics([0.1, 1])
+        for seconds in (0.05, 0.1, 0.5, 2):
+            metrics.observe(None, 'GET', 200, seconds)
+        lines = metrics.exposition().splitlines()
+        labels = 'action_name="",method="GET",status="2xx"'
+        assert [l for l in lines if 'duration' in l and labels in l] == [
+            f'requestlogs_request_duration_seconds_bucket{{{labels},le="0.1"}} 2',
+            f'requestlogs_request_duration_seconds_bucket{{{labels},le="1.0"}} 3',
+            f'requestlogs_request_duration_seconds_bucket{{{labels},le="+Inf"}} 4',
+            f'requestlogs_request_duration_seconds_sum{{{labels}}} 2.65',
+            f'requestlogs_request_duration_seconds_count{{{labels}}} 4',
+        ]
+
+    def test_multiprocess(self):
+        with tempfile.TemporaryDirectory() as directory:
+            metrics = Metrics([1], directory)
+            with patch('requestlogs.metrics.os.getpid', return_value=1):
+                other = Metrics([1], directory)
+            metrics.observe('a', 'GET', 200, 0.5)
+            other.observe('a', 'GET', 201, 2)
+            # Enough rows to grow the file
+            for i in range(2000):
+                other.observe(f'action-{i}', 'POST', 500, 0.5)
+
+            collected = metrics.collect()
+            assert collected[('a', 'GET', '2xx')] == [1, 1, 2.5]
+            assert collected[('action-1999', 'POST', '5xx')] == [1, 0, 0.5]
+            assert len(collected) == 2001
+            other.close()
+
+            # The file of a restarted process is continued
+            with patch('requestlogs.metrics.os.getpid', return_value=1):
+                other = Metrics([1], directory)
+            other.observe('a', 'GET', 200, 0.5)
+            assert metrics.collect()[('a', 'GET', '2xx')] == [2, 1, 3.0]
+            other.close()
+            metrics.close()
+
+
+class CollectingStorage(BaseStorage):
+    entries = []
+
+    def store(self, entry):
+        self.entries.append(entry)
+
+
+@override_settings(ROOT_URLCONF='tests.test_views')
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestDatabaseStorage(APITestCase):
+    @override_settings(
+        REQUESTLOGS={'STORAGE_CLASS': 'requestlogs.storages.DatabaseStorage'})
+    def test_store(self):
+        response = self.client.post('/?q=a', data={'test': 1})
+
+        log = RequestLog.objects.get()
+        assert log.action_name == 'post-other-stuff'
+        assert log.method == 'POST'
+        assert log.full_path == '/?q=a'
+        assert log.request_data == '{"test": "1"}'
+        assert log.query_params == '{"q": "a"}'
+        assert log.status_code == 200
+        assert log.response_data == (
+            '{"status": "ok", "unicode_test": "\\u00f6\\u00fa \\u6c49"}')
+        assert log.user_id is None
+        assert log.timestamp
+        assert log.execution_time
+
+    @override_settings(
+        REQUESTLOGS={
+            'STORAGE_CLASS': 'tests.test_storages.CollectingStorage'})
+    def test_store_many_in_single_query(self):
+        CollectingStorage.entries = []
+        self.client.get('/')
+        self.client.get('/func')
+
+        with self.assertNumQueries(1):
+            DatabaseStorage().store_many(CollectingStorage.entries)
+
+        assert sorted(RequestLog.objects.values_list('full_path', flat=True)) \
+            == ['/', '/func']
+
+    def test_close_old_connection(self):
+        with patch.object(connection, 'in_atomic_block', False), \
+                patch.object(connection, 'close_if_unusable_or_obsolete') \
+                as mocked_close:
+            DatabaseStorage().store_many([])
+        assert mocked_close.call_count == 2
+
+    def test_keep_connection_in_transaction(self):
+        with patch.object(connection, 'close_if_unusable_or_obsolete') \
+                as mocked_close:
+            DatabaseStorage().store_many([])
+        mocked_close.assert_not_called()
+
+
+class ReprSerializer(serializers.Serializer):
+    blob = JsonDumpField()
+
+    def to_representation(self, instance):
+        return {'repr': repr(instance)}
+
+
+@override_settings(
+    ROOT_URLCONF='tests.test_views',
+    REQUESTLOGS={'STORAGE_CLASS': 'tests.test_storages.CollectingStorage'},
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestCompiledSerializer(APITestCase):
+    def test_same_output_as_serializer(self):
+        from tests.test_views import RequestHeaderEntry
+
+        CollectingStorage.entries = []
+        self.client.post('/?q=a', data={'test': 1}, HTTP_ACCEPT='*/*')
+        self.client.get('/viewset/1', HTTP_ACCEPT='*/*')
+        self.client.get('/django', HTTP_ACCEPT='*/*')
+
+        for serializer_class in (BaseEntrySerializer, RequestHeaderEntry,
+                                 RequestIdEntrySerializer):
+            compiled = compile_serializer(serializer_class)
+            for entry in CollectingStorage.entries:
+                assert compiled(entry) == serializer_class(entry).data
+
+    def test_fallback(self):
+        assert compile_serializer(ReprSerializer) is None
+
+        class ReprStorage(BaseStorage):
+            serializer_class = ReprSerializer
+
+        with override_settings(REQUESTLOGS={'COMPILED_SERIALIZER': True}):
+            assert ReprStorage().prepare(1) == {'repr': '1'}
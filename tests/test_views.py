@@ -1,11 +1,23 @@
+import asyncio
+import datetime
 import io
+import json
 import logging
+import os
+import pickle
+import re
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, Mock
 
 import django
 from django.contrib.auth import get_user_model
-from django.http import HttpResponse
-from django.test import override_settings, modify_settings
+from django.core.management import call_command
+from django.http import HttpResponse, QueryDict
+from django.test import (
+    override_settings, modify_settings, RequestFactory, SimpleTestCase)
 if django.VERSION[0] < 2:
     from django.conf.urls import url
 else:
@@ -21,8 +33,17 @@ from rest_framework.test import APITestCase
 from rest_framework.views import APIView
 
 from requestlogs import get_requestlog_entry
-from requestlogs.logging import RequestIdContext
+from requestlogs.base import IgnorePaths, Secrets
+from requestlogs.entries import RequestLogEntry, RequestTiming
+from requestlogs.instrumentation import aggregator, stage_measured
+from requestlogs.logging import (
+    RequestIdContext, bind_context, bind_request_id, get_request_id,
+    request_id_context)
+from requestlogs.middleware import RequestLogsMiddleware
+from requestlogs.policy import ViewPolicy, view_policy
+from requestlogs.sampling import AdaptiveRate, Sampler
 from requestlogs.storages import BaseEntrySerializer, BaseRequestSerializer, BaseStorage
+from requestlogs.utils import get_client_ip, remove_secrets
 
 
 class View(APIView):
@@ -97,6 +118,14 @@ class ServerErrorView(APIView):
         {'one': 1}['two']
 
 
+class LimitedView(View):
+    requestlogs_max_request_data_bytes = 5
+
+
+class CapturedView(View):
+    requestlogs_capture_payloads = True
+
+
 class BasicDjangoView(DjangoView):
     def get(self, request):
         return HttpResponse('')
@@ -110,6 +139,22 @@ def api_view_function(request):
     return Response({'status': 'ok'})
 
 
+@view_policy(skip=True)
+@api_view(['GET'])
+def skipped_view_function(request):
+    return Response({'status': 'ok'})
+
+
+class SampledOutView(View):
+    requestlogs_sample_rate = 0
+
+
+@view_policy(secrets=['test'], storage_class='tests.test_views.OtherStorage',
+             action_names={'post': 'post-policy'})
+class PolicyView(View):
+    pass
+
+
 urlpatterns = [
     url(r'^/?$', View.as_view()),
     url(r'^django/?$', BasicDjangoView.as_view()),
@@ -120,6 +165,11 @@ urlpatterns = [
     url(r'^viewset/1/?$', ViewSet.as_view({'get': 'retrieve'})),
     url(r'^func/?$', api_view_function),
     url(r'^error/?$', ServerErrorView.as_view()),
+    url(r'^limited/?$', LimitedView.as_view()),
+    url(r'^captured/?$', CapturedView.as_view()),
+    url(r'^skipped/?$', skipped_view_function),
+    url(r'^sampled-out/?$', SampledOutView.as_view()),
+    url(r'^policy/?$', PolicyView.as_view()),
     url(r'^logging/?$', ViewSet.as_view({'get': 'w_logging'})),
 ]
 
@@ -308,6 +358,64 @@ class TestStoredData(RequestLogsTestMixin, APITestCase):
             })
 
 
+@override_settings(
+    REQUESTLOGS={'STORAGE_CLASS': 'tests.test_views.TestStorage',
+                 'COMPILED_SERIALIZER': True},
+)
+class TestStoredDataCompiledSerializer(TestStoredData):
+    pass
+
+
+@override_settings(
+    REQUESTLOGS={'STORAGE_CLASS': 'tests.test_views.TestStorage',
+                 'SNAPSHOT_ENTRIES': True},
+)
+class TestStoredDataSnapshot(TestStoredData):
+    pass
+
+
+@override_settings(ROOT_URLCONF=__name__)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestRequestHeaders(APITestCase):
+    @override_settings(
+        REQUESTLOGS={
+            'STORAGE_CLASS': 'tests.test_views.TestStorage',
+            'CAPTURE_HEADERS': ['User-Agent', 'HTTP_ACCEPT', 'X-Token',
+                                'X-Forwarded-For', 'Content-Type'],
+            'EXCLUDE_HEADERS': ['x-forwarded-for'],
+            'SECRETS': ['HTTP_X_TOKEN'],
+        },
+    )
+    def test_capture_headers(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            response = self.client.post(
+                '/', data={}, HTTP_ACCEPT='application/json',
+                HTTP_X_TOKEN='abc', HTTP_X_FORWARDED_FOR='127.0.0.1',
+                HTTP_X_OTHER='1')
+            headers = mocked_store.call_args[0][0]['request']['request_headers']
+            headers = json.loads(headers)
+            assert list(headers) == [
+                'HTTP_ACCEPT', 'HTTP_X_TOKEN', 'CONTENT_TYPE']
+            assert headers['HTTP_X_TOKEN'] == '*****'
+            assert headers['CONTENT_TYPE'].startswith('multipart/form-data')
+
+    @override_settings(
+        REQUESTLOGS={
+            'STORAGE_CLASS': 'tests.test_views.TestStorage',
+            'EXCLUDE_HEADERS': ['Cookie', 'X-Forwarded-For'],
+        },
+    )
+    def test_exclude_headers(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            response = self.client.get(
+                '/', HTTP_ACCEPT='application/json',
+                HTTP_X_FORWARDED_FOR='127.0.0.1')
+            headers = mocked_store.call_args[0][0]['request']['request_headers']
+            assert headers == '{"HTTP_ACCEPT": "application/json"}'
+
+
 @override_settings(
     ROOT_URLCONF=__name__,
     REQUESTLOGS={'STORAGE_CLASS': 'tests.test_views.TestStorage',
@@ -326,6 +434,142 @@ class TestDataTypes(APITestCase):
             assert mocked_store.call_args[0][0]['response']['data'] == '"ok"'
 
 
+@override_settings(
+    ROOT_URLCONF=__name__,
+    REQUESTLOGS={'STORAGE_CLASS': 'tests.test_views.TestStorage',
+                 'MAX_RESPONSE_DATA_BYTES': 10},
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestPayloadLimits(APITestCase):
+    def test_truncate_response(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store, \
+                patch('tests.test_views.View.get_response_data') as \
+                mocked_get_data:
+            mocked_get_data.return_value = {'items': list(range(100))}
+            response = self.client.get('/')
+            assert len(response.json()['items']) == 100
+            data = mocked_store.call_args[0][0]['response']['data']
+            assert data == '{"items": ...<truncated>'
+            assert mocked_store.call_args[0][0]['response'][
+                'data_truncated'] is True
+
+    def test_within_limit(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            response = self.client.get('/')
+            stored = mocked_store.call_args[0][0]['response']
+            assert stored['data'] == '{}'
+            assert stored['data_truncated'] is False
+
+    def test_view_limit(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            response = self.client.post('/limited', data={'test': 1})
+            stored = mocked_store.call_args[0][0]
+            assert stored['request']['data'] == '{"tes...<truncated>'
+            assert stored['response']['data'] == '{"status":...<truncated>'
+            assert stored['request']['data_truncated'] is True
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    REQUESTLOGS={
+        'STORAGE_CLASS': 'tests.test_views.TestStorage',
+        'CAPTURE_PAYLOADS': 'tail',
+    },
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestTailCapture(APITestCase):
+    def get_stored(self, method, path, **extra):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store, \
+                patch('requestlogs.entries.remove_secrets',
+                      wraps=remove_secrets) as mocked_remove_secrets:
+            getattr(self.client, method)(path, data={'test': 1}, **extra)
+            stored = mocked_store.call_args[0][0]
+        return (stored['request']['data'], stored['response']['data'],
+                mocked_remove_secrets.call_count)
+
+    def test_metadata_only(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            self.client.post('/', data={'test': 1})
+            stored = mocked_store.call_args[0][0]
+        assert stored['request']['data'] is None
+        assert stored['request']['full_path'] == '/'
+        assert stored['response'] == {'status_code': 200, 'data': None}
+        assert stored['action_name'] == 'post-other-stuff'
+
+    def test_capture(self):
+        assert self.get_stored('post', '/') == (None, None, 0)
+        assert self.get_stored('post', '/captured') == (
+            '{"test": "1"}',
+            '{"status": "ok", "unicode_test": "\\u00f6\\u00fa \\u6c49"}',
+            2)
+        assert self.get_stored('post', '/user') == (
+            '{"test": "1"}',
+            '{"detail": "Authentication credentials were not provided."}',
+            2)
+
+    def test_slow_request(self):
+        with override_settings(REQUESTLOGS={
+                'STORAGE_CLASS': 'tests.test_views.TestStorage',
+                'CAPTURE_PAYLOADS': 'tail',
+                'CAPTURE_PAYLOADS_THRESHOLD': 0}):
+            assert self.get_stored('post', '/')[0] == '{"test": "1"}'
+
+    def test_always(self):
+        with override_settings(REQUESTLOGS={
+                'STORAGE_CLASS': 'tests.test_views.TestStorage'}):
+            assert self.get_stored('post', '/')[0] == '{"test": "1"}'
+
+
+class OtherStorage(TestStorage):
+    pass
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    REQUESTLOGS={
+        'STORAGE_CLASS': 'tests.test_views.TestStorage',
+        'SECRETS': ['passwd'],
+    },
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestViewPolicy(APITestCase):
+    def test_skip(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            assert self.client.get('/skipped').status_code == 200
+            assert self.client.get('/sampled-out').status_code == 200
+            self.client.get('/func')
+        assert mocked_store.call_count == 1
+
+    def test_policy(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store, \
+                patch('tests.test_views.OtherStorage.do_store') as \
+                mocked_other_store:
+            self.client.post('/policy', data={'test': 1, 'passwd': 2})
+        assert mocked_store.call_count == 0
+        stored = mocked_other_store.call_args[0][0]
+        assert stored['action_name'] == 'post-policy'
+        assert stored['request']['data'] == '{"test": "***", "passwd": "***"}'
+
+    def test_resolved_once(self):
+        with patch('tests.test_views.TestStorage.do_store'), \
+                patch('requestlogs.policy.ViewPolicy', wraps=ViewPolicy) as \
+                mocked_policy:
+            self.client.get('/limited')
+            self.client.get('/limited')
+            self.client.post('/limited')
+        assert mocked_policy.call_count == 1
+
+    def test_unknown_option(self):
+        with self.assertRaises(TypeError):
+            view_policy(sample=1)
+
+
 class ActionNameStorage(TestStorage):
     class serializer_class(serializers.Serializer):
         action_name = serializers.CharField()
@@ -384,6 +628,14 @@ class TestRemoveSecrets(APITestCase):
             d = '{"passwd": "***"}'
             assert mocked_store.call_args[0][0]['request']['data'] == d
 
+    def test_remove_nested_password_from_request(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            response = self.client.post(
+                '/', data={'user': {'passwd': 1}, 'items': [{'passwd': 2}]},
+                format='json')
+            d = '{"user": {"passwd": "***"}, "items": [{"passwd": "***"}]}'
+            assert mocked_store.call_args[0][0]['request']['data'] == d
+
     def test_remove_password_from_response(self):
         with patch('tests.test_views.TestStorage.do_store') as mocked_store, \
                 patch('tests.test_views.View.get_response_data') as \
@@ -393,6 +645,63 @@ class TestRemoveSecrets(APITestCase):
             d = '{"passwd": "***"}'
             assert mocked_store.call_args[0][0]['response']['data'] == d
 
+    def test_remove_password_from_list_response(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store, \
+                patch('tests.test_views.View.get_response_data') as \
+                mocked_get_data:
+            mocked_get_data.return_value = [{'passwd': 'test'}, 1]
+            response = self.client.get('/')
+            d = '[{"passwd": "***"}, 1]'
+            assert mocked_store.call_args[0][0]['response']['data'] == d
+
+
+class TestSecrets(unittest.TestCase):
+    def test_nested(self):
+        secrets = Secrets(['passwd'])
+        data = {
+            'user': {'name': 'bob', 'passwd': 'x'},
+            'items': [{'passwd': 'y'}, 1, 'passwd'],
+            'passwd': {'nested': 'z'},
+        }
+        assert secrets.scrub(data) == {
+            'user': {'name': 'bob', 'passwd': '***'},
+            'items': [{'passwd': '***'}, 1, 'passwd'],
+            'passwd': '***',
+        }
+        assert data['user']['passwd'] == 'x'
+        assert data['items'][0]['passwd'] == 'y'
+
+    def test_copy_only_changed_branches(self):
+        secrets = Secrets(['passwd'])
+        unchanged = {'a': [1, {'b': 2}]}
+        data = {'unchanged': unchanged, 'changed': {'passwd': 1}}
+        scrubbed = secrets.scrub(data)
+        assert scrubbed is not data
+        assert scrubbed['unchanged'] is unchanged
+        assert secrets.scrub(unchanged) is unchanged
+
+    def test_patterns(self):
+        secrets = Secrets(['*_token', re.compile(r'^secret\d+$'), 'passwd'])
+        assert secrets.scrub({
+            'access_token': 1, 'token': 2, 'secret1': 3, 'secrets': 4,
+            'passwd': 5, 'PASSWD': 6,
+        }) == {
+            'access_token': '***', 'token': 2, 'secret1': '***', 'secrets': 4,
+            'passwd': '***', 'PASSWD': 6,
+        }
+
+    def test_case_insensitive(self):
+        secrets = Secrets(['Passwd', '*_token'], case_insensitive=True)
+        assert secrets.scrub({'PASSWD': 1, 'Access_TOKEN': 2, 3: 4}) == {
+            'PASSWD': '***', 'Access_TOKEN': '***', 3: 4}
+
+    def test_query_dict(self):
+        secrets = Secrets(['passwd'])
+        data = QueryDict('passwd=1&a=2')
+        scrubbed = secrets.scrub(data)
+        assert dict(scrubbed.items()) == {'passwd': '***', 'a': '2'}
+        assert data['passwd'] == '1'
+
 
 class UserStorage(TestStorage):
     class serializer_class(serializers.Serializer):
@@ -524,7 +833,7 @@ class TestIgnorePath(APITestCase):
             'IGNORE_PATHS': ['*unc'],
         },
     )
-    def test_ignore_trailing_wildcard(self):
+    def test_ignore_leading_wildcard(self):
         self._test_with_func_path()
 
     def test_ignore_using_custom_function(self):
@@ -659,6 +968,11 @@ class TestServerError(RequestLogsTestMixin, APITestCase):
             self.assert_stored(mocked_store, self.expected)
 
 
+class RequestIdLoggingStorage(BaseStorage):
+    def store(self, entry):
+        logging.getLogger('request_id_test').info('Stored %s', entry.request.path)
+
+
 class RequestIdSerializer(serializers.Serializer):
     request_id = serializers.CharField(source='request.request_id')
 
@@ -704,6 +1018,13 @@ class TestRequestIdMiddleware(LoggingMixin, RequestLogsTestMixin, APITestCase):
             response = self.client.get('/')
             assert mocked_store.call_args[0][0] == {'request_id': '12345dcba'}
 
+    def test_request_id_reset_after_request(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            self.client.get('/')
+            assert mocked_store.call_args[0][0]['request_id']
+
+        assert get_request_id() == ''
+
     def test_python_logging_with_request_id(self):
         # First build logging setup which outputs entries with request_id.
         # We cannot use `self.assertLogs`, because it uses the default
@@ -738,6 +1059,22 @@ class TestRequestIdMiddleware(LoggingMixin, RequestLogsTestMixin, APITestCase):
             'INFO ffc999123 GET with logging (2)',
         ])
 
+    @override_settings(
+        REQUESTLOGS={
+            'STORAGE_CLASS': 'tests.test_views.RequestIdLoggingStorage'},
+    )
+    def test_python_logging_in_storage(self):
+        self._setup_logging()
+
+        with patch('uuid.uuid4') as mocked_uuid:
+            mocked_uuid.side_effect = [Mock(hex='12345dcba')]
+            self.client.get('/logging?q=1')
+
+        self._assert_logged_lines([
+            'INFO 12345dcba GET with logging (1)',
+            'INFO 12345dcba Stored /logging',
+        ])
+
     @override_settings(
         REQUESTLOGS={
             'STORAGE_CLASS': 'tests.test_views.TestStorage',
@@ -819,5 +1156,485 @@ class TestReuseRequestId(LoggingMixin, APITestCase):
             assert mocked_store.call_args[0][0] == {'request_id': '12345dcba'}
 
 
+class TestIgnorePathsMatcher(SimpleTestCase):
+    def test_several_wildcards(self):
+        ignore = IgnorePaths(['/admin/*', '/static/*', '*.png', '*.css'])
+        for path in ('/admin/', '/admin/x', '/static/a.js', '/a.png', '/b.css'):
+            assert ignore(path), path
+        for path in ('/admin', '/api/', '/a.png/', '/css'):
+            assert not ignore(path), path
+
+    def test_exact_and_wildcard_everything(self):
+        assert not IgnorePaths(['/a'])('/a/')
+        assert IgnorePaths(['/a'])('/a')
+        assert IgnorePaths(['*'])('/anything')
+
+    def test_regexes(self):
+        ignore = IgnorePaths([
+            re.compile(r'/foo/?$'),
+            re.compile(r'/bar/(?P<id>\d+)'),
+            re.compile(r'/baz/(?P<id>\w+)/(?P=id)'),
+            re.compile(r'/CASE', re.IGNORECASE),
+        ])
+        for path in ('/foo', '/foo/', '/bar/12', '/baz/a/a', '/case'):
+            assert ignore(path), path
+        for path in ('/foo/x', '/bar/x', '/baz/a/b', '/x/foo'):
+            assert not ignore(path), path
+
+
+class CountingEntry(RequestLogEntry):
+    instances = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingEntry.instances += 1
+        super().__init__(*args, **kwargs)
+
+    @classmethod
+    def skip_request(cls, request):
+        return ('HTTP_X_HEALTH_CHECK' in request.META or
+                super().skip_request(request))
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    REQUESTLOGS={
+        'STORAGE_CLASS': 'tests.test_views.TestStorage',
+        'ENTRY_CLASS': 'tests.test_views.CountingEntry',
+        'IGNORE_PATHS': ['/func'],
+        'METHODS': ['post', 'get'],
+    },
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestSkipRequest(APITestCase):
+    def _assert_skipped(self, method, path, **extra):
+        CountingEntry.instances = 0
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            response = getattr(self.client, method)(path, **extra)
+            assert response.status_code == 200
+
+        assert mocked_store.call_args_list == []
+        assert CountingEntry.instances == 0
+
+    def test_no_entry_for_skipped_requests(self):
+        self._assert_skipped('get', '/func')
+        self._assert_skipped('post', '/', HTTP_X_HEALTH_CHECK='1')
+        with override_settings(REQUESTLOGS={
+                'ENTRY_CLASS': 'tests.test_views.CountingEntry',
+                'METHODS': ['post']}):
+            self._assert_skipped('get', '/')
+
+    def test_stored(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            response = self.client.post('/')
+
+        assert mocked_store.call_count == 1
+        assert CountingEntry.instances == 1
+
+    def test_get_entry_in_skipped_request(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            response = self.client.get(
+                '/set-user-manually', HTTP_X_HEALTH_CHECK='1')
+            assert response.status_code == 200
+
+        assert mocked_store.call_args_list == []
+
+
+class SkipByHandlersEntry(RequestLogEntry):
+    def skip_entry(self):
+        return (self.request.method == 'GET' and
+                self.response.status_code == 200 or super().skip_entry())
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    REQUESTLOGS={
+        'STORAGE_CLASS': 'tests.test_views.TestStorage',
+        'ENTRY_CLASS': 'tests.test_views.SkipByHandlersEntry',
+    },
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestSkipEntry(APITestCase):
+    def test_handlers_in_skip_entry(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            self.client.get('/')
+            self.client.post('/')
+
+        assert mocked_store.call_count == 1
+        assert mocked_store.call_args[0][0]['request']['method'] == 'POST'
+
+
+class RepeatedFieldsEntrySerializer(BaseEntrySerializer):
+    class RequestSerializer(BaseRequestSerializer):
+        data_again = serializers.SerializerMethodField()
+
+        def get_data_again(self, request):
+            return str(request.data) + str(request.query_params)
+
+    request = RequestSerializer()
+    ip_address_again = serializers.CharField(source='ip_address')
+    action_name_again = serializers.CharField(source='action_name')
+    user_again = serializers.SerializerMethodField()
+
+    def get_user_again(self, entry):
+        return entry.user['id']
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    REQUESTLOGS={
+        'STORAGE_CLASS': 'tests.test_views.TestStorage',
+        'SERIALIZER_CLASS': 'tests.test_views.RepeatedFieldsEntrySerializer',
+        'IGNORE_USER_FIELD': 'id',
+    },
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestEntryPropertiesEvaluatedOnce(APITestCase):
+    def test_evaluated_once(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store, \
+                patch('requestlogs.entries.remove_secrets',
+                      wraps=remove_secrets) as mocked_remove_secrets, \
+                patch('requestlogs.entries.get_client_ip',
+                      wraps=get_client_ip) as mocked_get_client_ip, \
+                patch.object(RequestLogEntry, 'get_user_info', autospec=True,
+                             side_effect=RequestLogEntry.get_user_info
+                             ) as mocked_get_user_info:
+            self.client.post('/?q=a', data={'test': 1})
+
+        assert mocked_store.call_count == 1
+        # Request data and response data
+        assert mocked_remove_secrets.call_count == 2
+        assert mocked_get_client_ip.call_count == 1
+        assert mocked_get_user_info.call_count == 1
+
+    def test_user_setter_invalidates_cache(self):
+        entry = RequestLogEntry(Mock(user=None), None)
+        assert entry.user == {'id': None, 'username': None}
+        entry.user = get_user_model()(pk=5, username='bob')
+        assert entry.user == {'id': 5, 'username': 'bob'}
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    REQUESTLOGS={
+        'STORAGE_CLASS': 'tests.test_views.TestStorage',
+        'SAMPLING_RULES': [
+            {'action_names': ['list-stuffs'], 'rate': 1},
+            {'users': ['u1'], 'user_field': 'username', 'rate': 1},
+            {'methods': ['get'], 'status': ['2xx', 304], 'rate': 0},
+            {'paths': ['/viewset*'], 'rate': 0},
+        ],
+    },
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestSampling(APITestCase):
+    def assert_stored(self, method, path, stored, **extra):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store, \
+                patch('tests.test_views.TestStorage.prepare') as mocked_prepare:
+            getattr(self.client, method)(path, **extra)
+        assert mocked_store.call_count == int(stored)
+        # Sampled out entries are not serialized
+        assert mocked_prepare.call_count == int(stored)
+
+    def test_rules(self):
+        self.assert_stored('get', '/', False)
+        self.assert_stored('post', '/', True)
+        self.assert_stored('get', '/user', True)  # 403
+        self.assert_stored('get', '/viewset', True)
+        self.assert_stored('get', '/viewset/1', False)
+        self.assert_stored('post', '/viewset', False)
+
+    def test_user_rule(self):
+        get_user_model().objects.create(username='u1', password='pw1')
+        self.assert_stored('get', '/user', True, HTTP_AUTHORIZATION='pw1')
+        self.assert_stored('get', '/set-user-manually', True)
+
+    def test_rate(self):
+        entry = Mock(status_code=200, django_request=Mock(method='GET'))
+        sampler = Sampler([{'rate': 0.25}])
+        with patch('requestlogs.sampling.random.random', return_value=0.2):
+            assert sampler(entry)
+        with patch('requestlogs.sampling.random.random', return_value=0.3):
+            assert not sampler(entry)
+
+    def test_adaptive_rate(self):
+        entry = Mock(status_code=200, django_request=Mock(method='GET'))
+        adaptive = AdaptiveRate(latency_threshold=0.1, min_factor=0.25)
+        sampler = Sampler([{'methods': ['GET'], 'rate': 0.5}, {'rate': 1}],
+                          adaptive)
+
+        def get_rates(now):
+            with patch('requestlogs.sampling.time.monotonic',
+                       return_value=now):
+                return (sampler.get_rate(entry),
+                        sampler.get_rate(Mock(django_request=Mock(
+                            method='POST'))))
+
+        adaptive.updated_at = 0
+        adaptive.observe_latency(0.2)
+        assert get_rates(0.5) == (0.5, 1)
+        assert get_rates(1) == (0.25, 1)
+        assert get_rates(2) == (0.125, 1)
+        assert get_rates(3) == (0.125, 1)
+        for _ in range(20):
+            adaptive.observe_latency(0.01)
+        assert get_rates(4) == (0.25, 1)
+        assert get_rates(5) == (0.5, 1)
+        assert get_rates(6) == (0.5, 1)
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    REQUESTLOGS={
+        'STORAGE_CLASS': 'tests.test_views.TestStorage',
+        'INSTRUMENTATION': True,
+    },
+)
+@modify_settings(MIDDLEWARE={
+    'append': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestInstrumentation(APITestCase):
+    def setUp(self):
+        aggregator.reset()
+        self.addCleanup(aggregator.reset)
+
+    def test_record_stages(self):
+        measured = []
+
+        def receiver(sender, stage, value, unit, **kwargs):
+            measured.append((stage, unit))
+
+        stage_measured.connect(receiver)
+        self.addCleanup(stage_measured.disconnect, receiver)
+        self.client.post('/', data={'test': 1})
+
+        stats = aggregator.snapshot()
+        assert set(stats) == {'skip_request', 'skip_entry', 'finalize',
+                              'store', 'prepare', 'entry_bytes', 'middleware'}
+        assert all(h['count'] == 1 for h in stats.values())
+        assert stats['entry_bytes']['unit'] == 'bytes'
+        assert stats['entry_bytes']['sum'] > len('{"test": "1"}')
+        assert stats['finalize']['min'] > stats['prepare']['min']
+        assert stats['middleware']['min'] > stats['finalize']['min']
+        assert ('finalize', 'ns') in measured
+        assert ('entry_bytes', 'bytes') in measured
+
+    def test_disabled(self):
+        with override_settings(REQUESTLOGS={
+                'STORAGE_CLASS': 'tests.test_views.TestStorage'}):
+            self.client.post('/', data={'test': 1})
+        assert aggregator.snapshot() == {}
+
+    def test_stats_command(self):
+        self.client.get('/')
+        self.client.get('/')
+        with tempfile.TemporaryDirectory() as directory:
+            aggregator.dump(directory)
+            aggregator.reset()
+            out = io.StringIO()
+            call_command('requestlogs_stats', directory=directory, stdout=out)
+            lines = out.getvalue().splitlines()
+            assert lines[0].split() == [
+                'stage', 'count', 'mean', 'p50', 'p99', 'max']
+            finalize = next(l for l in lines if l.startswith('finalize'))
+            assert finalize.split()[1] == '2'
+
+            out = io.StringIO()
+            call_command('requestlogs_stats', directory=directory,
+                         json=True, reset=True, stdout=out)
+            assert json.loads(out.getvalue())['store']['count'] == 2
+            assert os.listdir(directory) == []
+
+    def test_dump_in_background(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+                REQUESTLOGS={
+                    'STORAGE_CLASS': 'tests.test_views.TestStorage',
+                    'INSTRUMENTATION': True,
+                    'INSTRUMENTATION_DUMP_DIRECTORY': directory,
+                    'INSTRUMENTATION_DUMP_INTERVAL': 0,
+                }), \
+                patch.object(aggregator, 'dumper_pid', None), \
+                patch('requestlogs.instrumentation.threading.Thread') as \
+                mocked_thread:
+            self.client.get('/')
+            self.client.get('/')
+            # Not dumped on the request thread
+            assert os.listdir(directory) == []
+        mocked_thread.assert_called_once()
+        assert mocked_thread.call_args[1]['target'] == aggregator._run_dumper
+        mocked_thread.return_value.start.assert_called_once_with()
+
+    def test_dump_error(self):
+        with tempfile.NamedTemporaryFile() as f, \
+                patch('requestlogs.instrumentation.logger') as mocked_logger:
+            # Not a directory
+            aggregator.dump(f.name)
+        assert mocked_logger.exception.call_count == 1
+
+
+async def async_get_response(request):
+    return HttpResponse('')
+
+
+@unittest.skipIf(django.VERSION < (3, 1), 'Async middleware not supported')
+@override_settings(
+    ROOT_URLCONF=__name__,
+    REQUESTLOGS={
+        'STORAGE_CLASS': 'tests.test_views.TestStorage',
+        'SERIALIZER_CLASS': 'requestlogs.storages.RequestIdEntrySerializer',
+    },
+)
+@modify_settings(MIDDLEWARE={
+    'append': [
+        'requestlogs.middleware.RequestLogsMiddleware',
+        'requestlogs.middleware.RequestIdMiddleware',
+    ],
+})
+class TestAsyncMiddleware(RequestLogsTestMixin, APITestCase):
+    def test_async_mode(self):
+        middleware = RequestLogsMiddleware(async_get_response)
+        assert asyncio.iscoroutinefunction(middleware)
+        assert asyncio.iscoroutinefunction(middleware.process_view)
+
+        middleware = RequestLogsMiddleware(lambda request: None)
+        assert not asyncio.iscoroutinefunction(middleware)
+        assert not asyncio.iscoroutinefunction(middleware.process_view)
+
+    async def test_get(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store, \
+                patch('uuid.uuid4') as mocked_uuid:
+            mocked_uuid.side_effect = [Mock(hex='12345dcba')]
+            response = await self.async_client.get('/viewset?q=a')
+            assert response.status_code == 200
+
+        self.assert_stored(mocked_store, {
+            'action_name': 'list-stuffs',
+            'request': {
+                'method': 'GET',
+                'full_path': '/viewset?q=a',
+                'data': '{}',
+                'query_params': '{"q": "a"}',
+                'request_headers':
+                    '{"HTTP_HOST": "testserver", "HTTP_COOKIE": ""}',
+                'request_id': '12345dcba',
+            },
+            'response': {
+                'status_code': 200,
+                'data': '{}',
+            },
+            'user': {'id': None, 'username': None},
+        })
+
+    async def test_ignored_path(self):
+        with override_settings(REQUESTLOGS={
+                'STORAGE_CLASS': 'tests.test_views.TestStorage',
+                'IGNORE_PATHS': ['/viewset']}):
+            with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+                response = await self.async_client.get('/viewset')
+                assert response.status_code == 200
+
+        assert mocked_store.call_args_list == []
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    REQUESTLOGS={
+        'STORAGE_CLASS': 'tests.test_views.TestStorage',
+        'SERIALIZER_CLASS': 'requestlogs.storages.PhaseTimingsEntrySerializer',
+        'PHASE_TIMINGS': True,
+    },
+)
+@modify_settings(MIDDLEWARE={
+    'prepend': 'requestlogs.middleware.RequestLogsMiddleware',
+})
+class TestTiming(APITestCase):
+    def get_stored(self, path):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            self.client.get(path)
+        return mocked_store.call_args[0][0]
+
+    def test_rendered_response(self):
+        stored = self.get_stored('/viewset')
+        assert set(stored['phase_timings']) == {'view', 'render'}
+
+    def test_django_response(self):
+        stored = self.get_stored('/django')
+        assert set(stored['phase_timings']) == {'view'}
+
+    def test_phase_timings_off(self):
+        with override_settings(REQUESTLOGS={
+                'STORAGE_CLASS': 'tests.test_views.TestStorage',
+                'SERIALIZER_CLASS':
+                    'requestlogs.storages.PhaseTimingsEntrySerializer'}):
+            stored = self.get_stored('/viewset')
+        assert stored['phase_timings'] == {}
+
+    async def test_async(self):
+        with patch('tests.test_views.TestStorage.do_store') as mocked_store:
+            await self.async_client.get('/viewset')
+        stored = mocked_store.call_args[0][0]
+        assert set(stored['phase_timings']) == {'view', 'render'}
+
+    @override_settings(USE_TZ=True)
+    def test_started_at_middleware(self):
+        request = RequestFactory().get('/')
+        request.user = None
+        request._requestlog_timing = RequestTiming(
+            started_ns=time.perf_counter_ns() - 5000000,
+            started_at=1562000000.0)
+        entry = RequestLogEntry(request, None)
+        entry.collect(HttpResponse(''))
+
+        assert entry.timestamp == datetime.datetime(
+            2019, 7, 1, 16, 53, 20, tzinfo=datetime.timezone.utc)
+        execution_time = entry.execution_time
+        assert execution_time >= datetime.timedelta(milliseconds=5)
+        # Stopped when the response was collected
+        time.sleep(0.001)
+        assert entry.execution_time == execution_time
+
+
+def get_request_id_with_arg(arg):
+    return get_request_id(), arg
+
+
+class TestRequestIdPropagation(SimpleTestCase):
+    def test_bind_context(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with request_id_context('abc'):
+                future = executor.submit(
+                    bind_context(get_request_id_with_arg), 1)
+            assert future.result() == ('abc', 1)
+            assert executor.submit(get_request_id).result() == ''
+
+    def test_bind_request_id(self):
+        with request_id_context('abc'):
+            func = pickle.loads(pickle.dumps(
+                bind_request_id(get_request_id_with_arg)))
+        assert get_request_id() == ''
+        assert func(2) == ('abc', 2)
+        assert get_request_id() == ''
+
+    def test_concurrent_tasks(self):
+        async def task(_uuid):
+            with request_id_context(_uuid):
+                await asyncio.sleep(0)
+                first = get_request_id()
+                await asyncio.sleep(0)
+                return first, get_request_id()
+
+        async def main():
+            return await asyncio.gather(task('a'), task('b'))
+
+        assert asyncio.run(main()) == [('a', 'a'), ('b', 'b')]
+
+
 def ignore_path_func(path):
     return 'fun' in path